@@ -0,0 +1,274 @@
+import csv
+import os
+import random
+
+# Names and places of the generated family book
+MALE_NAMES = ['Juho', 'Matti', 'Antti', 'Heikki', 'Pekka', 'Olli', 'Lauri', 'Erkki',
+              'Johan', 'Karl', 'Tuomas', 'Mikko', 'Paavo', 'Aapeli', 'Kalle']
+FEMALE_NAMES = ['Maria', 'Anna', 'Kaisa', 'Liisa', 'Helena', 'Sofia', 'Elina', 'Aino',
+                'Katariina', 'Saara', 'Hedvig', 'Brita', 'Maija', 'Lyydia', 'Hilma']
+LAST_NAMES = ['Tossavainen', 'Tossawainen', 'Hyvönen', 'Kärkkäinen', 'Räsänen',
+              'Kettunen', 'Huttunen', 'Miettinen', 'Savolainen', 'Korhonen',
+              'Heikkinen', 'Rytkönen', 'Partanen', 'Väisänen', 'Pitkänen']
+PLACES = ['Kuopio', 'Iisalmi', 'Lapinlahti', 'Nilsiä', 'Pielavesi', 'Maaninka',
+          'Leppävirta', 'Kiuruvesi', 'Helsinki', 'Varkaus']
+
+
+def partial_date(rng, year, partial_dates):
+    """
+    Generates a YYYY-MM-DD date with unknown parts as XX
+
+    Args:
+        (Random) rng - Random number generator
+        (integer) year - Year
+        (float) partial_dates - Share of dates with unknown day or month
+    Returns:
+        (string) date - Date
+    """
+
+    if rng.random() < partial_dates:
+        if rng.random() < 0.5:
+            return '{:04d}-XX-XX'.format(year)
+        return '{:04d}-{:02d}-XX'.format(year, rng.randint(1, 12))
+    return '{:04d}-{:02d}-{:02d}'.format(year, rng.randint(1, 12), rng.randint(1, 28))
+
+
+def date_to_dmy(date):
+    """
+    Converts a YYYY-MM-DD date to the DD.MM.YYYY format typed in prompts
+
+    Args:
+        (string) date - Date in YYYY-MM-DD format
+    Returns:
+        (string) date - Date in DD.MM.YYYY, MM.YYYY or YYYY format
+    """
+
+    if not date:
+        return ''
+
+    year, month, day = date.split('-')
+    if month == 'XX':
+        return year
+    if day == 'XX':
+        return '{}.{}'.format(month, year)
+    return '{}.{}.{}'.format(day, month, year)
+
+
+def generate_book(persons=5000, generations=8, spouses=2, children=4, page_size=12,
+                  partial_dates=0.3, first_year=1700, seed=1):
+    """
+    Generates a synthetic family book in the bulk import file format
+
+    Founders are added until the book has enough persons. Each person gets
+    up to the given number of spouses and each relationship up to the given
+    number of children. A page holds one family line branch: when it is
+    full, families continue on a new page with page_from and page_to
+    references between the pages.
+
+    Args:
+        (integer) persons - How many persons (approximately)
+        (integer) generations - Generations below each founder
+        (integer) spouses - Most spouses per person
+        (integer) children - Most children per relationship
+        (integer) page_size - Persons on one page
+        (float) partial_dates - Share of dates with unknown day or month
+        (integer) first_year - Birth year of founders
+        (integer) seed - Random seed
+    Returns:
+        (dict) book - Rows by table name ('persons', 'relationships',
+                      'children') and 'families' for the add_family path
+    """
+
+    rng = random.Random(seed)
+    book = {'persons': [], 'relationships': [], 'children': [], 'families': []}
+    page = {'number': 0, 'persons': page_size, 'relationships': 0}
+
+    def new_page():
+        page['number'] += 1
+        page['persons'] = 0
+        page['relationships'] = 0
+
+    def add_person(last_name, birth_year, gender=None):
+        if page['persons'] >= page_size:
+            new_page()
+        page['persons'] += 1
+
+        if gender is None:
+            gender = rng.choice(['Male', 'Female'])
+        names = MALE_NAMES if gender == 'Male' else FEMALE_NAMES
+        first_names = ' '.join(rng.sample(names, rng.randint(1, 2)))
+
+        death_date = None
+        if birth_year < 1920 or rng.random() < 0.2:
+            death_date = partial_date(rng, birth_year + rng.randint(0, 90), partial_dates)
+
+        person = {'page_number': page['number'], 'row': page['persons'],
+                  'first_names': first_names, 'last_name': last_name, 'gender': gender,
+                  'birth_date': partial_date(rng, birth_year, partial_dates),
+                  'birth_place': rng.choice(PLACES), 'death_date': death_date,
+                  'death_place': rng.choice(PLACES) if death_date else None,
+                  'page_from': None, 'page_to': None, 'comments': None}
+        book['persons'].append(person)
+        return len(book['persons']) - 1
+
+    def reference(row):
+        return '{}:{}'.format(row['page_number'], row['row'])
+
+    def add_family(head, generation):
+        head_row = book['persons'][head]
+        head_year = int(head_row['birth_date'][0:4])
+        family = {'head': head, 'spouses': []}
+        book['families'].append(family)
+
+        child_families = []
+        for spouse_number in range(rng.randint(1, spouses)):
+            spouse_gender = 'Female' if head_row['gender'] == 'Male' else 'Male'
+            spouse = add_person(rng.choice(LAST_NAMES), head_year + rng.randint(-5, 5),
+                                spouse_gender)
+
+            page['relationships'] += 1
+            marriage_date = partial_date(rng, head_year + rng.randint(18, 35), partial_dates)
+            book['relationships'].append({
+                'page_number': page['number'], 'row': page['relationships'],
+                'partner1': reference(head_row), 'partner2': reference(book['persons'][spouse]),
+                'marriage_date': marriage_date, 'marriage_place': rng.choice(PLACES),
+                'divorce_date': None, 'divorce_place': None, 'comments': None})
+            relationship = book['relationships'][-1]
+
+            child_indexes = []
+            for child_number in range(rng.randint(0, children)):
+                if len(book['persons']) >= persons:
+                    break
+                child = add_person(head_row['last_name'], head_year + rng.randint(20, 45))
+                child_indexes.append(child)
+                book['children'].append({'page_number': page['number'],
+                                         'relationship': reference(relationship),
+                                         'person': reference(book['persons'][child])})
+                if generation + 1 < generations and rng.random() < 0.7:
+                    child_families.append(child)
+
+            family['spouses'].append({'spouse': spouse,
+                                      'relationship': len(book['relationships']) - 1,
+                                      'children': child_indexes})
+
+        # Families of children continue on the following pages
+        for child in child_families:
+            if len(book['persons']) >= persons:
+                break
+            child_row = book['persons'][child]
+            new_page()
+            child_row['page_to'] = page['number']
+            # The person is repeated as the head of the new page
+            head_copy = add_person(child_row['last_name'], int(child_row['birth_date'][0:4]),
+                                   child_row['gender'])
+            copy_row = book['persons'][head_copy]
+            for column_name in ('first_names', 'birth_date', 'birth_place', 'death_date',
+                                'death_place'):
+                copy_row[column_name] = child_row[column_name]
+            copy_row['page_from'] = child_row['page_number']
+            add_family(head_copy, generation + 1)
+
+    while len(book['persons']) < persons:
+        new_page()
+        founder = add_person(rng.choice(LAST_NAMES), first_year + rng.randint(0, 50), 'Male')
+        add_family(founder, 0)
+
+    return book
+
+
+def person_answers(person):
+    """
+    Lists the answers add_person asks for a generated person
+
+    Args:
+        (dict) person - Generated person row
+    Returns:
+        (list) answers - Typed answers in prompt order
+    """
+
+    from extract_genealogy import infer_deceased
+
+    answers = [person['first_names'], person['last_name'], person['gender'],
+               date_to_dmy(person['birth_date']), person['birth_place'] or '',
+               date_to_dmy(person['death_date']), person['death_place'] or '']
+    if infer_deceased(person['birth_date'] or '', person['death_date'] or '') is None:
+        answers.append('y' if person['death_date'] else 'n')
+    if person['page_from'] or person['page_to']:
+        answers += ['y', str(person['page_from'] or ''), str(person['page_to'] or '')]
+    else:
+        answers.append('n')
+    answers += [person['comments'] or '', 'y']
+
+    return answers
+
+
+def relationship_answers(relationship):
+    """
+    Lists the answers add_relationship asks for a generated relationship
+
+    Args:
+        (dict) relationship - Generated relationship row
+    Returns:
+        (list) answers - Typed answers in prompt order
+    """
+
+    return ['y', date_to_dmy(relationship['marriage_date']),
+            relationship['marriage_place'] or '', date_to_dmy(relationship['divorce_date']),
+            relationship['divorce_place'] or '', relationship['comments'] or '', 'y']
+
+
+def family_answers(book, family):
+    """
+    Lists the answers add_family asks for a generated family
+
+    Families of children are not followed, so each family is one add_family
+    call with its spouses and children.
+
+    Args:
+        (dict) book - Generated book
+        (dict) family - Generated family
+    Returns:
+        (list) answers - Typed answers in prompt order
+    """
+
+    answers = []
+    for spouse_number, spouse in enumerate(family['spouses']):
+        answers += ['y', '']
+        answers += person_answers(book['persons'][spouse['spouse']])
+        answers += relationship_answers(book['relationships'][spouse['relationship']])
+        answers.append('y' if spouse['children'] else 'n')
+        for child_number, child in enumerate(spouse['children']):
+            answers.append('')
+            answers += person_answers(book['persons'][child])
+            answers.append('n')
+            answers.append('y' if child_number + 1 < len(spouse['children']) else 'n')
+        answers.append('y' if spouse_number + 1 < len(family['spouses']) else 'n')
+
+    return answers
+
+
+def write_book(book, directory):
+    """
+    Writes a generated book as CSV files for the import command
+
+    Args:
+        (dict) book - Generated book
+        (string) directory - Output directory
+    Returns:
+        (dict) filenames - File names by table name
+    """
+
+    filenames = {}
+    for table_name in ('persons', 'relationships', 'children'):
+        rows = book[table_name]
+        if not rows:
+            continue
+        filenames[table_name] = os.path.join(directory, '{}.csv'.format(table_name))
+        with open(filenames[table_name], 'w', newline='', encoding='utf-8') as output_file:
+            writer = csv.DictWriter(output_file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            for row in rows:
+                writer.writerow({column_name: '' if value is None else value
+                                 for column_name, value in row.items()})
+
+    return filenames
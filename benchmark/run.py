@@ -0,0 +1,382 @@
+import argparse
+import builtins
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+# Benchmarks run from the repository root import the tool modules directly
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache
+import db
+import extract_genealogy
+import storage
+from benchmark.generator import generate_book, write_book, person_answers, family_answers
+
+
+@contextlib.contextmanager
+def scripted_input(answers):
+    """
+    Answers input() prompts from a list and hides printed output
+
+    Args:
+        (list) answers - Typed answers in prompt order
+    """
+
+    remaining = iter(answers)
+
+    def answer(prompt=''):
+        try:
+            return next(remaining)
+        except StopIteration:
+            raise RuntimeError('No scripted answer for prompt: {}'.format(prompt))
+
+    original_input = builtins.input
+    builtins.input = answer
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            yield
+    finally:
+        builtins.input = original_input
+
+
+def percentile(sorted_values, share):
+    """
+    Returns a nearest-rank percentile
+
+    Args:
+        (list) sorted_values - Values in ascending order
+        (float) share - Percentile from 0 to 1
+    Returns:
+        (float) value - Percentile value
+    """
+
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(share * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, rows=None):
+    """
+    Calculates throughput and latency percentiles of an operation
+
+    Args:
+        (list) latencies - Seconds taken by each call
+        (integer) rows - Rows handled in total (calls if None)
+    Returns:
+        (dict) result - Calls, rows, throughput and p50/p99 in milliseconds
+    """
+
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    if rows is None:
+        rows = len(latencies)
+
+    return {'calls': len(latencies), 'rows': rows, 'seconds': round(total, 6),
+            'rows_per_second': round(rows / total, 1) if total else None,
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 3)}
+
+
+def timed(function, *args):
+    """
+    Calls a function and measures how long it takes
+
+    Args:
+        (function) function - Function to call
+        (tuple) args - Arguments of the function
+    Returns:
+        (float) seconds - Elapsed time
+        (object) result - Return value of the function
+    """
+
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def reset_database():
+    """
+    Empties the tables and restarts the ID sequences
+
+    Tables referring to persons (e.g. person_links) are emptied as well.
+    """
+
+    db.execute('TRUNCATE children, relationships, persons RESTART IDENTITY CASCADE')
+    cache.clear()
+
+
+def sample_ids(table_name, id_name, count, rng):
+    """
+    Picks random saved IDs of a table
+
+    Args:
+        (string) table_name - Table name
+        (string) id_name - Name of ID column
+        (integer) count - How many IDs
+        (Random) rng - Random number generator
+    Returns:
+        (list) id_numbers - IDs
+    """
+
+    columns, rows = db.fetch_all('SELECT {} FROM {}'.format(id_name, table_name))
+    id_numbers = [values[0] for values in rows]
+    return rng.sample(id_numbers, min(count, len(id_numbers)))
+
+
+def benchmark_import(book, directory):
+    """
+    Times the bulk import of the whole book
+    """
+
+    from bulk_import import import_files
+
+    filenames = write_book(book, directory)
+    seconds, row_counts = timed(import_files, filenames.get('persons'),
+                                filenames.get('relationships'), filenames.get('children'))
+    return summarize([seconds], sum(row_counts.values()))
+
+
+def benchmark_add_person(book, samples, rng):
+    """
+    Times the add_person path from typed answers to the saved row
+    """
+
+    latencies = []
+    for person in rng.sample(book['persons'], min(samples, len(book['persons']))):
+        with scripted_input(person_answers(person)):
+            # Persons are saved in a transaction as in interactive mode
+            start = time.perf_counter()
+            with storage.transaction():
+                extract_genealogy.add_person(person['page_number'])
+            latencies.append(time.perf_counter() - start)
+
+    return summarize(latencies)
+
+
+def benchmark_add_family(book, samples, rng):
+    """
+    Times the add_family path: spouses, relationships and children of a head
+    """
+
+    families = [family for family in book['families'] if family['spouses']]
+    latencies = []
+    rows = 0
+    for family in rng.sample(families, min(samples, len(families))):
+        head = book['persons'][family['head']]
+        with scripted_input(person_answers(head)):
+            with storage.transaction():
+                head_id = extract_genealogy.add_person(head['page_number'])
+
+        with scripted_input(family_answers(book, family)):
+            start = time.perf_counter()
+            extract_genealogy.add_family(head_id, head['page_number'])
+            latencies.append(time.perf_counter() - start)
+
+        for spouse in family['spouses']:
+            rows += 2 + 2 * len(spouse['children'])
+
+    return summarize(latencies, rows)
+
+
+def benchmark_print(function, id_numbers):
+    """
+    Times a print function on rows that are not cached
+    """
+
+    cache.clear()
+    latencies = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for id_number in id_numbers:
+            latencies.append(timed(function, id_number)[0])
+
+    return summarize(latencies)
+
+
+def benchmark_traversal(function, id_numbers):
+    """
+    Times a traversal and counts the persons found
+    """
+
+    latencies = []
+    rows = 0
+    for id_number in id_numbers:
+        seconds, persons = timed(function, id_number)
+        latencies.append(seconds)
+        rows += len(persons)
+
+    return summarize(latencies, rows)
+
+
+def benchmark_export(directory):
+    """
+    Times the GEDCOM export of the whole database
+    """
+
+    from gedcom import export_gedcom
+
+    filename = os.path.join(directory, 'export.ged')
+    with open(filename, 'w', encoding='utf-8', buffering=1024 * 1024) as output_file:
+        seconds, record_counts = timed(export_gedcom, output_file)
+
+    return summarize([seconds], sum(record_counts.values()))
+
+
+def run_benchmarks(args):
+    """
+    Generates a book, runs all benchmarks and collects the results
+
+    Args:
+        (Namespace) args - Command line arguments
+    Returns:
+        (dict) results - Parameters and results by operation
+    """
+
+    from traversal import get_descendants, get_ancestors
+
+    rng = random.Random(args.seed)
+    book = generate_book(args.persons, args.generations, args.spouses, args.children,
+                         args.page_size, args.partial_dates, seed=args.seed)
+
+    if args.init_db:
+        import schema
+        schema.migrate()
+    if args.reset:
+        reset_database()
+
+    operations = {}
+    with tempfile.TemporaryDirectory() as directory:
+        operations['bulk_import'] = benchmark_import(book, directory)
+
+        person_ids = sample_ids('persons', 'person_id', args.samples, rng)
+        relationship_ids = sample_ids('relationships', 'relationship_id', args.samples, rng)
+
+        operations['print_person'] = benchmark_print(extract_genealogy.print_person,
+                                                     person_ids)
+        operations['print_relationship'] = benchmark_print(
+            extract_genealogy.print_relationship, relationship_ids)
+        operations['descendants'] = benchmark_traversal(get_descendants, person_ids)
+        operations['ancestors'] = benchmark_traversal(get_ancestors, person_ids)
+        operations['export_gedcom'] = benchmark_export(directory)
+
+        operations['add_person'] = benchmark_add_person(book, args.samples, rng)
+        operations['add_family'] = benchmark_add_family(book, args.family_samples, rng)
+
+    return {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'version': git_version(), 'python': platform.python_version(),
+            'parameters': {'persons': len(book['persons']),
+                           'relationships': len(book['relationships']),
+                           'children': len(book['children']),
+                           'generations': args.generations, 'spouses': args.spouses,
+                           'max_children': args.children, 'page_size': args.page_size,
+                           'partial_dates': args.partial_dates, 'samples': args.samples,
+                           'family_samples': args.family_samples, 'seed': args.seed},
+            'operations': operations}
+
+
+def git_version():
+    """
+    Returns the checked out commit for comparing results between versions
+
+    Returns:
+        (string/none) version - Commit description or None outside git
+    """
+
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, previous=None):
+    """
+    Prints results as a table, with changes from previous results if given
+
+    Args:
+        (dict) results - Benchmark results
+        (dict) previous - Earlier results to compare with
+    """
+
+    print('{:<20} {:>7} {:>9} {:>12} {:>10} {:>10}'.format(
+        'Operation', 'Calls', 'Rows', 'Rows/s', 'p50 ms', 'p99 ms'))
+    for name, result in results['operations'].items():
+        line = '{:<20} {:>7} {:>9} {:>12} {:>10} {:>10}'.format(
+            name, result['calls'], result['rows'], result['rows_per_second'],
+            result['p50_ms'], result['p99_ms'])
+
+        old = (previous or {}).get('operations', {}).get(name)
+        if old and old['p50_ms']:
+            line += '  p50 {:+.0%} vs {}'.format(result['p50_ms'] / old['p50_ms'] - 1,
+                                                 previous.get('version'))
+        print(line)
+
+
+def parse_arguments(argv=None):
+    """
+    Parses command line arguments
+
+    Args:
+        (list) argv - Arguments (defaults to sys.argv)
+    Returns:
+        (Namespace) args - Parsed arguments
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the database paths of the extraction tool with a synthetic '
+                    'family book. Use a scratch database (e.g. POSTGRESQL_DATABASE).')
+    parser.add_argument('--persons', type=int, default=5000, help='persons in the book')
+    parser.add_argument('--generations', type=int, default=8,
+                        help='generations below each founder')
+    parser.add_argument('--spouses', type=int, default=2, help='most spouses per person')
+    parser.add_argument('--children', type=int, default=4,
+                        help='most children per relationship')
+    parser.add_argument('--page-size', type=int, default=12, help='persons on one page')
+    parser.add_argument('--partial-dates', type=float, default=0.3,
+                        help='share of dates with unknown day or month')
+    parser.add_argument('--samples', type=int, default=200,
+                        help='calls of each single-row operation')
+    parser.add_argument('--family-samples', type=int, default=20,
+                        help='calls of add_family')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--init-db', action='store_true',
+                        help='create or upgrade the schema first')
+    parser.add_argument('--reset', action='store_true',
+                        help='empty the tables first (deletes all data)')
+    parser.add_argument('--output', metavar='FILE', help='save results as JSON')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with results saved by an earlier run')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """ Main function """
+
+    args = parse_arguments(argv)
+
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as input_file:
+            previous = json.load(input_file)
+
+    results = run_benchmarks(args)
+    print_results(results, previous)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, indent=2)
+        print('Results saved to {}.'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
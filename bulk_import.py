@@ -0,0 +1,482 @@
+import csv
+import json
+import os
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+import db
+import ids
+from extract_genealogy import (convert_date_dmy_to_ymd, normalize_gender, infer_deceased,
+                               prepare_columns, PERSON_INTEGER_COLUMNS,
+                               PERSON_BOOLEAN_COLUMNS, PERSON_STRING_COLUMNS,
+                               RELATIONSHIP_INTEGER_COLUMNS, RELATIONSHIP_BOOLEAN_COLUMNS,
+                               RELATIONSHIP_STRING_COLUMNS)
+
+# Rows sent to the database in one multi-row INSERT
+BATCH_SIZE = 1000
+
+# Imported person and relationship columns (in addition to page_number)
+PERSON_COLUMNS = ['first_names', 'last_name', 'gender', 'birth_date', 'birth_place',
+                  'death_date', 'death_place', 'deceased', 'page_from', 'page_to',
+                  'comments']
+RELATIONSHIP_COLUMNS = ['marriage_date', 'marriage_place', 'divorce_date',
+                        'divorce_place', 'comments']
+DATE_COLUMNS = ['birth_date', 'death_date', 'marriage_date', 'divorce_date']
+
+
+def read_rows(filename):
+    """
+    Streams rows from a CSV, JSON Lines or JSON file
+
+    Args:
+        (string) filename - File name (.csv, .jsonl, .ndjson or .json)
+    Yields:
+        (dict) row - Row values by column name
+    """
+
+    extension = os.path.splitext(filename)[1].lower()
+
+    with open(filename, newline='', encoding='utf-8') as input_file:
+        if extension == '.csv':
+            for row in csv.DictReader(input_file):
+                yield row
+        elif extension in ('.jsonl', '.ndjson'):
+            for line in input_file:
+                if line.strip():
+                    yield json.loads(line)
+        elif extension == '.json':
+            # JSON arrays cannot be streamed, prefer JSON Lines for large files
+            for row in json.load(input_file):
+                yield row
+        else:
+            raise ValueError('Unsupported file type: {}'.format(filename))
+
+
+def prepare_rows(filename, prepare, *args):
+    """
+    Streams prepared rows of a file and reports the row number of invalid rows
+
+    Args:
+        (string) filename - File name
+        (function) prepare - prepare_person, prepare_relationship or prepare_child
+        (tuple) args - ID maps passed to prepare
+    Yields:
+        (any) prepared_row - Row prepared for saving
+    """
+
+    for row_number, row in enumerate(read_rows(filename), 1):
+        try:
+            yield prepare(row, *args)
+        except (ValueError, TypeError) as error:
+            raise ValueError('{} row {}: {}'.format(filename, row_number, error))
+
+
+def batches(rows, batch_size=BATCH_SIZE):
+    """
+    Groups rows into lists of given size
+
+    Args:
+        (iterable) rows - Rows
+        (integer) batch_size - Rows in one batch
+    Yields:
+        (list) batch - Rows
+    """
+
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parse_value(value):
+    """
+    Converts an empty or missing file value to None and strips strings
+
+    Args:
+        (any) value - Value read from file
+    Returns:
+        (any) value - Cleaned value
+    """
+
+    if isinstance(value, str):
+        value = value.strip()
+        if len(value) == 0:
+            value = None
+    return value
+
+
+def parse_integer(value):
+    """
+    Converts a file value to an integer
+
+    Args:
+        (any) value - Value read from file
+    Returns:
+        (integer/none) value - Integer value or None if empty
+    """
+
+    value = parse_value(value)
+    if value is not None:
+        value = int(value)
+    return value
+
+
+def parse_boolean(value):
+    """
+    Converts a file value such as y/n or true/false to a boolean
+
+    Args:
+        (any) value - Value read from file
+    Returns:
+        (boolean/none) value - Boolean value or None if empty
+    """
+
+    value = parse_value(value)
+    if isinstance(value, str):
+        if value.lower() in ('y', 'yes', 'true', 't', '1'):
+            value = True
+        elif value.lower() in ('n', 'no', 'false', 'f', '0'):
+            value = False
+        else:
+            raise ValueError('Not a valid boolean: {}'.format(value))
+    elif value is not None:
+        value = bool(value)
+    return value
+
+
+def parse_text(value, column_name):
+    """
+    Checks that a file value of a text column is a string
+
+    Args:
+        (any) value - Value read from file
+        (string) column_name - Column name for error messages
+    Returns:
+        (string/none) value - Stripped string or None if empty
+    """
+
+    value = parse_value(value)
+    if value is not None and not isinstance(value, str):
+        raise ValueError('Not a valid text value for {}: {}'.format(column_name, value))
+    return value
+
+
+def parse_date(value):
+    """
+    Converts a DD.MM.YYYY file date to YYYY-MM-DD (ISO dates are kept)
+
+    Args:
+        (any) value - Value read from file
+    Returns:
+        (string/none) date - Date in YYYY-MM-DD format
+    """
+
+    value = parse_value(value)
+    if value is not None:
+        value = str(value)
+        if '-' not in value:
+            value = convert_date_dmy_to_ymd(value)
+    return value
+
+
+def parse_reference(value, page_number=None):
+    """
+    Parses a row reference
+
+    References are written as PAGE:ROW (e.g. '42:17'), as ROW for a row on
+    the same page, or as #ID for a row already saved in the database.
+
+    Args:
+        (any) value - Reference read from file
+        (integer) page_number - Page number of the referring row
+    Returns:
+        (tuple/integer/none) reference - (page, row) key, database ID or None
+    """
+
+    value = parse_value(value)
+    if value is None:
+        return None
+
+    value = str(value)
+    if value.startswith('#'):
+        return int(value[1:])
+
+    if ':' in value:
+        page, row = value.split(':', 1)
+        return (int(page), int(row))
+
+    if page_number is None:
+        raise ValueError('Reference without page number: {}'.format(value))
+
+    return (page_number, int(value))
+
+
+def resolve_reference(reference, id_map, description):
+    """
+    Converts a parsed reference to a database ID
+
+    Args:
+        (tuple/integer/none) reference - Parsed reference
+        (dict) id_map - Database IDs by (page, row)
+        (string) description - Referenced row type for error messages
+    Returns:
+        (integer/none) id_number - Database ID
+    """
+
+    if reference is None or isinstance(reference, int):
+        return reference
+
+    if reference not in id_map:
+        raise ValueError('Unknown {} reference {}:{}'.format(description, *reference))
+
+    return id_map[reference]
+
+
+def prepare_person(row):
+    """
+    Converts a persons file row to saved column values
+
+    Args:
+        (dict) row - Row read from file
+    Returns:
+        (tuple) key - (page, row) key (None if row not given)
+        (list) column_names - Names of columns
+        (list) column_values - Values of columns
+    """
+
+    page_number = parse_integer(row.get('page_number'))
+    if page_number is None:
+        raise ValueError('Person without page number: {}'.format(row))
+
+    values = {}
+    for column_name in PERSON_COLUMNS:
+        if column_name in DATE_COLUMNS:
+            values[column_name] = parse_date(row.get(column_name))
+        elif column_name in PERSON_STRING_COLUMNS:
+            values[column_name] = parse_text(row.get(column_name), column_name)
+        else:
+            values[column_name] = parse_value(row.get(column_name))
+
+    if values['gender'] is not None:
+        values['gender'] = normalize_gender(values['gender'])
+    values['page_from'] = parse_integer(values['page_from'])
+    values['page_to'] = parse_integer(values['page_to'])
+    values['deceased'] = parse_boolean(values['deceased'])
+    if values['deceased'] is None:
+        values['deceased'] = infer_deceased(values['birth_date'], values['death_date'])
+
+    column_names, column_values = prepare_columns(
+        ['page_number'] + PERSON_COLUMNS,
+        [page_number] + [values[column_name] for column_name in PERSON_COLUMNS],
+        PERSON_INTEGER_COLUMNS, PERSON_BOOLEAN_COLUMNS, PERSON_STRING_COLUMNS)
+
+    key = None
+    row_number = parse_integer(row.get('row'))
+    if row_number is not None:
+        key = (page_number, row_number)
+
+    return key, column_names, column_values
+
+
+def prepare_relationship(row, person_ids):
+    """
+    Converts a relationships file row to saved column values
+
+    Args:
+        (dict) row - Row read from file
+        (dict) person_ids - Person IDs by (page, row)
+    Returns:
+        (tuple) key - (page, row) key (None if row not given)
+        (list) column_names - Names of columns
+        (list) column_values - Values of columns
+    """
+
+    page_number = parse_integer(row.get('page_number'))
+
+    partner1_id = resolve_reference(parse_reference(row.get('partner1'), page_number),
+                                    person_ids, 'person')
+    partner2_id = resolve_reference(parse_reference(row.get('partner2'), page_number),
+                                    person_ids, 'person')
+
+    values = {}
+    for column_name in RELATIONSHIP_COLUMNS:
+        if column_name in DATE_COLUMNS:
+            values[column_name] = parse_date(row.get(column_name))
+        else:
+            values[column_name] = parse_text(row.get(column_name), column_name)
+
+    column_names, column_values = prepare_columns(
+        ['person_id_partner1', 'person_id_partner2'] + RELATIONSHIP_COLUMNS,
+        [partner1_id, partner2_id] + [values[column_name]
+                                      for column_name in RELATIONSHIP_COLUMNS],
+        RELATIONSHIP_INTEGER_COLUMNS, RELATIONSHIP_BOOLEAN_COLUMNS,
+        RELATIONSHIP_STRING_COLUMNS)
+
+    key = None
+    row_number = parse_integer(row.get('row'))
+    if page_number is not None and row_number is not None:
+        key = (page_number, row_number)
+
+    return key, column_names, column_values
+
+
+def prepare_child(row, person_ids, relationship_ids):
+    """
+    Converts a children file row to saved column values
+
+    Args:
+        (dict) row - Row read from file
+        (dict) person_ids - Person IDs by (page, row)
+        (dict) relationship_ids - Relationship IDs by (page, row)
+    Returns:
+        (list) column_values - Relationship ID and person ID
+    """
+
+    page_number = parse_integer(row.get('page_number'))
+
+    relationship_id = resolve_reference(
+        parse_reference(row.get('relationship'), page_number),
+        relationship_ids, 'relationship')
+    person_id = resolve_reference(parse_reference(row.get('person'), page_number),
+                                  person_ids, 'person')
+
+    if relationship_id is None or person_id is None:
+        raise ValueError('Child without relationship or person: {}'.format(row))
+
+    return [relationship_id, person_id]
+
+
+def insert_batch(cur, table_name, id_name, column_names, rows):
+    """
+    Inserts rows with one multi-row INSERT statement
+
+    The rows get IDs reserved ahead from the table sequence (see ids.py),
+    so no generated IDs have to be read back.
+
+    Args:
+        (cursor) cur - Database cursor
+        (string) table_name - Table name
+        (string) id_name - Name of ID column
+        (list) column_names - Names of columns
+        (list) rows - Column values for each row
+    Returns:
+        (list) id_numbers - Saved IDs in the order of rows
+    """
+
+    id_numbers = ids.take(table_name, len(rows))
+
+    query = sql.SQL('INSERT INTO {} ({}) VALUES %s').format(
+        sql.Identifier(table_name),
+        sql.SQL(', ').join(map(sql.Identifier, [id_name] + list(column_names))))
+
+    execute_values(cur, query.as_string(cur),
+                   [[id_number] + list(values) for id_number, values in zip(id_numbers, rows)],
+                   page_size=len(rows))
+
+    return id_numbers
+
+
+def import_rows(cur, table_name, id_name, prepared_rows, batch_size=BATCH_SIZE):
+    """
+    Inserts prepared rows in batches
+
+    Args:
+        (cursor) cur - Database cursor
+        (string) table_name - Table name
+        (string) id_name - Name of ID column
+        (iterable) prepared_rows - (key, column_names, column_values) tuples
+        (integer) batch_size - Rows in one INSERT statement
+    Returns:
+        (dict) id_map - Saved IDs by (page, row)
+        (int) row_count - How many rows inserted
+    """
+
+    id_map = {}
+    row_count = 0
+
+    for batch in batches(prepared_rows, batch_size):
+        # Rows with the same columns are inserted together
+        groups = {}
+        for key, column_names, column_values in batch:
+            groups.setdefault(tuple(column_names), []).append((key, column_values))
+
+        for column_names, group in groups.items():
+            id_numbers = insert_batch(cur, table_name, id_name, list(column_names),
+                                      [column_values for key, column_values in group])
+            for (key, column_values), id_number in zip(group, id_numbers):
+                if key is not None:
+                    if key in id_map:
+                        raise ValueError('Duplicate {} row {}:{}'.format(table_name, *key))
+                    id_map[key] = id_number
+            row_count += len(group)
+
+    return id_map, row_count
+
+
+def import_files(persons_file=None, relationships_file=None, children_file=None,
+                 batch_size=BATCH_SIZE):
+    """
+    Imports persons, relationships and children in one transaction
+
+    Args:
+        (string) persons_file - Persons file name
+        (string) relationships_file - Relationships file name
+        (string) children_file - Children file name
+        (integer) batch_size - Rows in one INSERT statement
+    Returns:
+        (dict) row_counts - How many rows inserted by table
+    """
+
+    row_counts = {'persons': 0, 'relationships': 0, 'children': 0}
+    person_ids = {}
+    relationship_ids = {}
+
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            if persons_file:
+                prepared_rows = prepare_rows(persons_file, prepare_person)
+                person_ids, row_counts['persons'] = import_rows(
+                    cur, 'persons', 'person_id', prepared_rows, batch_size)
+
+            if relationships_file:
+                prepared_rows = prepare_rows(relationships_file, prepare_relationship,
+                                             person_ids)
+                relationship_ids, row_counts['relationships'] = import_rows(
+                    cur, 'relationships', 'relationship_id', prepared_rows, batch_size)
+
+            if children_file:
+                for rows in batches(prepare_rows(children_file, prepare_child, person_ids,
+                                                 relationship_ids), batch_size):
+                    execute_values(cur, 'INSERT INTO children (relationship_id, person_id) '
+                                   'VALUES %s', rows, page_size=len(rows))
+                    row_counts['children'] += len(rows)
+
+    return row_counts
+
+
+def import_command(args):
+    """
+    Runs the import command
+
+    Args:
+        (Namespace) args - Command line arguments
+    """
+
+    if not (args.persons or args.relationships or args.children):
+        print('ERROR: Provide at least one file to import.')
+        return
+
+    try:
+        row_counts = import_files(args.persons, args.relationships, args.children,
+                                  args.batch_size)
+    except (Exception, psycopg2.DatabaseError) as error:
+        print('Import failed, nothing was saved: {}'.format(error))
+    else:
+        print('Imported {} persons, {} relationships and {} children.'.format(
+            row_counts['persons'], row_counts['relationships'], row_counts['children']))
@@ -0,0 +1,244 @@
+import threading
+from collections import OrderedDict
+
+# Rows kept per table before the least recently used are dropped
+MAX_ROWS = 2000
+
+
+class RowCache:
+    """
+    Bounded least-recently-used cache of database rows by ID
+
+    Rows saved in an open transaction are kept apart for the thread that
+    saved them, and are shared with other threads (daemon sessions) only
+    when the transaction commits.
+    """
+
+    def __init__(self, max_rows=MAX_ROWS):
+        """
+        Args:
+            (integer) max_rows - How many rows are kept
+        """
+
+        self.max_rows = max_rows
+        self.rows = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.modified = {} # Changes not yet committed by row ID
+        self.local = threading.local() # Uncommitted rows by thread
+
+    def uncommitted(self):
+        """
+        Returns the uncommitted rows of this thread
+
+        Returns:
+            (dict) rows - (columns, values) by row ID
+        """
+
+        rows = getattr(self.local, 'rows', None)
+        if rows is None:
+            rows = self.local.rows = {}
+        return rows
+
+    def get(self, id_value):
+        """
+        Gets a cached row
+
+        Args:
+            (integer) id_value - Row ID
+        Returns:
+            (tuple/none) row - (columns, values) or None if not cached
+        """
+
+        row = self.uncommitted().get(id_value)
+        with self.lock:
+            if row is not None:
+                self.hits += 1
+                return row
+            row = self.rows.get(id_value)
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.rows.move_to_end(id_value)
+            return row
+
+    def contains(self, id_value):
+        """
+        Tells whether a row is cached (without counting a hit or miss)
+
+        Args:
+            (integer) id_value - Row ID
+        Returns:
+            (boolean) cached - True if the row is cached
+        """
+
+        if id_value in self.uncommitted():
+            return True
+        with self.lock:
+            return id_value in self.rows
+
+    def put(self, id_value, columns, values):
+        """
+        Caches a row
+
+        Args:
+            (integer) id_value - Row ID
+            (list) columns - Data columns
+            (tuple) values - Data values
+        """
+
+        if id_value is None or values is None:
+            return
+
+        with self.lock:
+            self.rows[id_value] = (list(columns), tuple(values))
+            self.rows.move_to_end(id_value)
+            while len(self.rows) > self.max_rows:
+                self.rows.popitem(last=False)
+
+    def put_uncommitted(self, id_value, columns, values):
+        """
+        Caches a row saved in an open transaction for this thread only
+
+        Args:
+            (integer) id_value - Row ID
+            (list) columns - Data columns
+            (tuple) values - Data values
+        """
+
+        if id_value is None or values is None:
+            return
+
+        self.uncommitted()[id_value] = (list(columns), tuple(values))
+
+    def publish(self, id_value):
+        """
+        Shares an uncommitted row of this thread after its transaction commits
+
+        Args:
+            (integer) id_value - Row ID
+        """
+
+        row = self.uncommitted().pop(id_value, None)
+        if row is not None:
+            self.put(id_value, *row)
+
+    def discard(self, id_value):
+        """
+        Drops an uncommitted row of this thread after a rollback
+
+        Args:
+            (integer) id_value - Row ID
+        """
+
+        self.uncommitted().pop(id_value, None)
+
+    def put_prefetched(self, id_value, columns, values, invalidations):
+        """
+        Caches a row read ahead on another connection
+
+        The row is not cached if a change to it is not committed yet
+        (another connection does not see the change), or if rows were
+        invalidated while it was read.
+
+        Args:
+            (integer) id_value - Row ID
+            (list) columns - Data columns
+            (tuple) values - Data values
+            (integer) invalidations - Value of invalidations before the read
+        Returns:
+            (boolean) cached - True if the row was cached
+        """
+
+        if id_value is None or values is None:
+            return False
+
+        with self.lock:
+            if (invalidations != self.invalidations or id_value in self.modified
+                    or id_value in self.rows):
+                return False
+            self.rows[id_value] = (list(columns), tuple(values))
+            while len(self.rows) > self.max_rows:
+                self.rows.popitem(last=False)
+            return True
+
+    def invalidate(self, id_value):
+        """
+        Drops a modified row from the cache until the change is settled
+
+        Args:
+            (integer) id_value - Row ID
+        """
+
+        self.uncommitted().pop(id_value, None)
+        with self.lock:
+            self.rows.pop(id_value, None)
+            self.modified[id_value] = self.modified.get(id_value, 0) + 1
+            self.invalidations += 1
+
+    def settle(self, id_value):
+        """
+        Drops a modified row again after its change commits or rolls back
+
+        Other connections see the row as saved from now on, so it can be
+        read ahead again.
+
+        Args:
+            (integer) id_value - Row ID
+        """
+
+        with self.lock:
+            self.rows.pop(id_value, None)
+            if self.modified.get(id_value, 0) > 1:
+                self.modified[id_value] -= 1
+            else:
+                self.modified.pop(id_value, None)
+            self.invalidations += 1
+
+    def clear(self):
+        """
+        Drops all rows from the cache
+        """
+
+        self.uncommitted().clear()
+        with self.lock:
+            self.rows.clear()
+            self.invalidations += 1
+
+    def info(self):
+        """
+        Returns cache counters
+
+        Returns:
+            (dict) info - Hits, misses and cached rows
+        """
+
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'rows': len(self.rows)}
+
+
+persons = RowCache()
+relationships = RowCache()
+
+
+def clear():
+    """
+    Drops all cached rows (e.g. after a rolled back transaction)
+    """
+
+    persons.clear()
+    relationships.clear()
+
+
+def info():
+    """
+    Returns counters of all caches
+
+    Returns:
+        (dict) info - Counters by table name
+    """
+
+    return {'persons': persons.info(), 'relationships': relationships.info()}
@@ -0,0 +1,95 @@
+import json
+import os
+import socket
+import sys
+
+
+def socket_path():
+    """
+    Returns the Unix socket path of the entry daemon
+
+    Returns:
+        (string) path - GENEALOGY_SOCKET, or a socket in the runtime or home directory
+    """
+
+    if os.environ.get('GENEALOGY_SOCKET'):
+        return os.environ['GENEALOGY_SOCKET']
+    directory = os.environ.get('XDG_RUNTIME_DIR') or os.path.expanduser('~')
+    return os.path.join(directory, 'genealogy.sock')
+
+
+def send(output_file, message):
+    """
+    Sends a message to the daemon
+
+    Args:
+        (file) output_file - Socket file
+        (dict) message - Message
+    """
+
+    output_file.write(json.dumps(message) + '\n')
+    output_file.flush()
+
+
+def main(argv=None):
+    """
+    Runs extract_genealogy.py arguments in the entry daemon
+
+    Returns:
+        (int) exit_code - Exit code of the session
+    """
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path())
+    except OSError:
+        print('The entry daemon is not running. Start it with: '
+              'python extract_genealogy.py daemon', file=sys.stderr)
+        return 1
+
+    with connection, connection.makefile('r', encoding='utf-8') as input_file, \
+            connection.makefile('w', encoding='utf-8') as output_file:
+        send(output_file, {'argv': argv})
+
+        # Ctrl-C while the daemon works cancels at its next prompt
+        interrupted = False
+        while True:
+            try:
+                line = input_file.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if 'out' in message:
+                    sys.stdout.write(message['out'])
+                    sys.stdout.flush()
+                elif 'err' in message:
+                    sys.stderr.write(message['err'])
+                    sys.stderr.flush()
+                elif 'input' in message and interrupted:
+                    interrupted = False
+                    send(output_file, {'interrupt': True})
+                elif 'input' in message:
+                    try:
+                        send(output_file, {'line': input()})
+                    except EOFError:
+                        send(output_file, {'eof': True})
+                    except KeyboardInterrupt:
+                        send(output_file, {'interrupt': True})
+                elif 'exit' in message:
+                    return message['exit'] or 0
+            except KeyboardInterrupt:
+                if interrupted:
+                    # Second Ctrl-C leaves the daemon session
+                    print('\nDisconnected from the entry daemon.', file=sys.stderr)
+                    return 130
+                interrupted = True
+
+    print('\nThe entry daemon closed the connection.', file=sys.stderr)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,6 +1,26 @@
+import os
 from configparser import ConfigParser
 
+# Parsed sections by (filename, section)
+_config_cache = {}
+
 def config(filename='database.ini', section='postgresql'):
+    # read and parse the config file only once per process
+    key = (filename, section)
+    if key not in _config_cache:
+        _config_cache[key] = read_config(filename, section)
+
+    db = dict(_config_cache[key])
+
+    # environment variables override file values, e.g. POSTGRESQL_HOST
+    for param in list(db) + ['host', 'port', 'database', 'user', 'password']:
+        env_name = '{}_{}'.format(section, param).upper()
+        if env_name in os.environ:
+            db[param] = os.environ[env_name]
+
+    return db
+
+def read_config(filename='database.ini', section='postgresql'):
     # create a parser
     parser = ConfigParser()
     # read config file
@@ -16,3 +36,9 @@ def config(filename='database.ini', section='postgresql'):
         raise Exception('Section {0} not found in the {1} file'.format(section, filename))
 
     return db
+
+def reload_config(filename=None, section=None):
+    # forget cached sections so the next config() call reads the file again
+    for key in list(_config_cache):
+        if filename in (None, key[0]) and section in (None, key[1]):
+            del _config_cache[key]
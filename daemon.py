@@ -0,0 +1,273 @@
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+import db
+from client import socket_path
+
+# Commands served by the daemon (None is interactive entry)
+SESSION_COMMANDS = [None, 'relationships', 'descendants', 'ancestors', 'pages',
+                    'search']
+
+# Options that change the whole process and cannot be used in a shared daemon
+PROCESS_OPTIONS = ['journal', 'local', 'profile', 'record', 'replay']
+
+# Client session of the current thread
+_local = threading.local()
+
+
+class Session:
+    """
+    Terminal of a connected client
+
+    Output is sent to the client as it is written, and reading a line asks
+    the client for the next answer.
+    """
+
+    def __init__(self, input_file, output_file):
+        """
+        Args:
+            (file) input_file - Socket file for reading
+            (file) output_file - Socket file for writing
+        """
+
+        self.input_file = input_file
+        self.output_file = output_file
+        self.connected = True
+
+    def send(self, message):
+        """
+        Sends a message to the client (ignored after the client has left)
+
+        Args:
+            (dict) message - Message
+        """
+
+        if not self.connected:
+            return
+        try:
+            self.output_file.write((json.dumps(message) + '\n').encode('utf-8'))
+            self.output_file.flush()
+        except OSError:
+            self.connected = False
+
+    def readline(self):
+        """
+        Reads the next answer from the client
+
+        Returns:
+            (string) line - Answer with a newline ('' at end of input)
+        """
+
+        self.send({'input': True})
+        if not self.connected:
+            return ''
+
+        line = self.input_file.readline()
+        if not line:
+            self.connected = False
+            return ''
+
+        message = json.loads(line)
+        if message.get('interrupt'):
+            raise KeyboardInterrupt
+        if message.get('eof'):
+            return ''
+        return message['line'] + '\n'
+
+
+class SessionStream:
+    """
+    Standard stream that goes to the client of the current thread
+
+    Threads without a client session use the original stream.
+    """
+
+    def __init__(self, stream, message_type):
+        """
+        Args:
+            (file) stream - Original stream
+            (string) message_type - 'out' or 'err' for output streams
+        """
+
+        self.stream = stream
+        self.message_type = message_type
+
+    def write(self, text):
+        session = getattr(_local, 'session', None)
+        if session is None:
+            return self.stream.write(text)
+        session.send({self.message_type: text})
+        return len(text)
+
+    def readline(self):
+        session = getattr(_local, 'session', None)
+        if session is None:
+            return self.stream.readline()
+        return session.readline()
+
+    def flush(self):
+        if getattr(_local, 'session', None) is None:
+            self.stream.flush()
+
+    def isatty(self):
+        if getattr(_local, 'session', None) is None:
+            return self.stream.isatty()
+        return False
+
+    def fileno(self):
+        # input() must not read the daemon's own terminal for a client
+        if getattr(_local, 'session', None) is not None:
+            raise OSError('Client session has no file descriptor')
+        return self.stream.fileno()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def run_client_session(argv):
+    """
+    Runs extract_genealogy.py arguments for a client
+
+    Args:
+        (list) argv - Command line arguments
+    """
+
+    from extract_genealogy import parse_arguments, run_session
+
+    args = parse_arguments(argv)
+
+    if args.command not in SESSION_COMMANDS:
+        print('ERROR: Run {} without the daemon.'.format(args.command))
+        return
+    for option in PROCESS_OPTIONS:
+        if getattr(args, option):
+            print('ERROR: Run --{} without the daemon.'.format(option))
+            return
+
+    run_session(args)
+
+
+class SessionHandler(socketserver.StreamRequestHandler):
+    """
+    Serves one client connection in its own thread
+    """
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+
+        session = Session(self.rfile, self.wfile)
+        _local.session = session
+        exit_code = 0
+        try:
+            run_client_session(json.loads(line)['argv'])
+        except SystemExit as error:
+            # argparse exits on --help and invalid arguments
+            exit_code = error.code if isinstance(error.code, int) else 1
+        except (KeyboardInterrupt, EOFError):
+            print()
+            exit_code = 1
+        except Exception as error:
+            print('ERROR: {}'.format(error))
+            exit_code = 1
+        finally:
+            session.send({'exit': exit_code})
+            _local.session = None
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix socket server with a thread per client
+    """
+
+    daemon_threads = True
+
+
+def remove_stale_socket(path):
+    """
+    Removes a socket file left by a daemon that is not running
+
+    Args:
+        (string) path - Socket path
+    Returns:
+        (boolean) removed - False if another daemon is listening
+    """
+
+    if not os.path.exists(path):
+        return True
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.remove(path)
+        return True
+    finally:
+        probe.close()
+    return False
+
+
+def serve(path=None):
+    """
+    Serves client sessions until interrupted
+
+    The connection pool, row caches, configuration and imported modules
+    stay warm between sessions and are shared by all clients.
+
+    Args:
+        (string) path - Socket path (see client.socket_path)
+    """
+
+    import extract_genealogy # Imported once for all sessions
+    import traversal
+
+    if path is None:
+        path = socket_path()
+    if not remove_stale_socket(path):
+        print('ERROR: A daemon is already listening on {}.'.format(path))
+        return
+
+    # Open the pool before clients connect
+    db.get_pool()
+
+    sys.stdin = SessionStream(sys.stdin, None)
+    sys.stdout = SessionStream(sys.stdout, 'out')
+    sys.stderr = SessionStream(sys.stderr, 'err')
+
+    old_umask = os.umask(0o077) # Only the owner can connect
+    try:
+        server = DaemonServer(path, SessionHandler)
+    finally:
+        os.umask(old_umask)
+
+    print('Entry daemon listening on {} (Ctrl-C to stop).'.format(path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('\nEntry daemon stopped.')
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.remove(path)
+        sys.stdin = sys.stdin.stream
+        sys.stdout = sys.stdout.stream
+        sys.stderr = sys.stderr.stream
+
+
+def daemon_command(args):
+    """
+    Runs the daemon command
+
+    Args:
+        (Namespace) args - Command line arguments
+    """
+
+    try:
+        serve(args.socket)
+    except (Exception, db.psycopg2.DatabaseError) as error:
+        print('Entry daemon failed: {}'.format(error))
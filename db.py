@@ -0,0 +1,594 @@
+import atexit
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions, pool, sql
+from config import config
+
+# Pool size limits (one connection is opened when the session starts)
+MIN_CONNECTIONS = 1
+MAX_CONNECTIONS = 8
+
+# Errors raised when the server connection has been lost
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+# Pooled connections idle longer than this are checked before use (seconds)
+IDLE_CHECK_SECONDS = 30
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Time each pooled connection was returned to the pool
+_released_at = weakref.WeakKeyDictionary()
+_released_lock = threading.Lock()
+
+# Connection and deferred statements of the current transaction by thread
+_local = threading.local()
+
+# Connection class of new pooled connections (see set_connection_factory)
+_connection_factory = None
+
+# Write-behind handler that row writes are routed to (see set_write_behind)
+_write_behind = None
+
+
+def get_pool():
+    """
+    Returns the session connection pool, creating it on first use
+
+    Returns:
+        (ThreadedConnectionPool) connection_pool - Shared connection pool
+    """
+
+    global _pool
+
+    if _pool is None or _pool.closed:
+        with _pool_lock:
+            if _pool is None or _pool.closed:
+                # read database configuration
+                params = config()
+                if _connection_factory is not None:
+                    params['connection_factory'] = _connection_factory
+                _pool = pool.ThreadedConnectionPool(MIN_CONNECTIONS, MAX_CONNECTIONS,
+                                                    **params)
+
+    return _pool
+
+
+def close_pool():
+    """
+    Closes all pooled connections (a new pool is opened on next use)
+    """
+
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+        _pool = None
+
+
+atexit.register(close_pool)
+
+
+def set_connection_factory(factory):
+    """
+    Opens pooled connections with another connection class
+
+    The current pool is closed, so every following connection (e.g. an
+    instrumented one) is opened with the factory.
+
+    Args:
+        (class) factory - psycopg2 connection subclass (None for default)
+    """
+
+    global _connection_factory
+
+    close_pool()
+    _connection_factory = factory
+
+
+def set_write_behind(handler):
+    """
+    Routes row inserts, updates and reads through a write-behind handler
+
+    The handler (e.g. a journal.Journal) implements insert_row, update_row
+    and select_row with the signatures of this module and saves the rows
+    to the database later. It also groups rows into transactions of its own
+    (see storage.PostgresStorage.transaction).
+
+    Args:
+        (object) handler - Write-behind handler (None to write directly)
+    """
+
+    global _write_behind
+    _write_behind = handler
+
+
+def write_behind_active():
+    """
+    Checks if row writes are routed through a write-behind handler
+
+    Returns:
+        (boolean) active - True if rows may not be saved yet
+    """
+
+    return _write_behind is not None
+
+
+def get_write_behind():
+    """
+    Returns the write-behind handler row writes are routed to
+
+    Returns:
+        (object) handler - Write-behind handler (None if writing directly)
+    """
+
+    return _write_behind
+
+
+def connection_alive(conn):
+    """
+    Checks a pooled connection that has been idle with a round trip
+
+    A connection dropped by the server or network while idle is noticed
+    only when a statement fails, so it is checked before use.
+
+    Args:
+        (connection) conn - Database connection taken from the pool
+    Returns:
+        (boolean) alive - False if the connection has been lost
+    """
+
+    with _released_lock:
+        released = _released_at.pop(conn, None)
+    if released is None or time.monotonic() - released < IDLE_CHECK_SECONDS:
+        return True
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+    except CONNECTION_ERRORS:
+        return False
+
+    return True
+
+
+def checkout_connection():
+    """
+    Takes a live connection from the pool
+
+    Returns:
+        (connection) conn - Database connection
+    """
+
+    connection_pool = get_pool()
+    conn = connection_pool.getconn()
+
+    # Replace connections the server or network has dropped, the pool opens
+    # a new one when no idle connections are left
+    while conn.closed or not connection_alive(conn):
+        connection_pool.putconn(conn, close=True)
+        conn = connection_pool.getconn()
+
+    return conn
+
+
+def release_connection(conn, discard=False):
+    """
+    Returns a connection to the pool
+
+    Args:
+        (connection) conn - Database connection
+        (boolean) discard - Close the connection instead of reusing it
+    """
+
+    discard = discard or bool(conn.closed)
+    with _released_lock:
+        if discard:
+            _released_at.pop(conn, None)
+        else:
+            _released_at[conn] = time.monotonic()
+
+    connection_pool = get_pool()
+    connection_pool.putconn(conn, close=discard)
+
+
+@contextmanager
+def connection():
+    """
+    Checks out a pooled connection for the duration of a with block
+
+    Changes are committed when the block finishes and rolled back on errors.
+
+    Yields:
+        (connection) conn - Database connection
+    """
+
+    conn = checkout_connection()
+    discard = False
+    try:
+        yield conn
+        conn.commit()
+    except CONNECTION_ERRORS:
+        discard = True
+        raise
+    except BaseException:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        release_connection(conn, discard)
+
+
+@contextmanager
+def transaction():
+    """
+    Runs all statements of a with block in one transaction
+
+    Statements are sent on one connection and committed once when the block
+    finishes. Errors and interrupts (Ctrl-C) roll back every change made in
+    the block. Nested blocks join the outer transaction: their changes are
+    committed with it, and an error in a nested block rolls back only that
+    block (to a savepoint).
+
+    Yields:
+        (connection) conn - Database connection
+    """
+
+    if in_transaction():
+        with savepoint():
+            yield _local.conn
+        return
+
+    conn = checkout_connection()
+    _local.conn = conn
+    _local.deferred = []
+    _local.flushes = 0
+    _local.savepoints = 0
+    discard = False
+    try:
+        yield conn
+        flush()
+        if conn.info.transaction_status == extensions.TRANSACTION_STATUS_INERROR:
+            raise psycopg2.DatabaseError('A statement failed, changes were rolled back')
+        conn.commit()
+    except CONNECTION_ERRORS:
+        discard = True
+        raise
+    except BaseException:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        _local.conn = None
+        _local.deferred = []
+        release_connection(conn, discard)
+
+
+@contextmanager
+def savepoint():
+    """
+    Rolls back changes of a with block inside a transaction on errors
+
+    The SAVEPOINT statement is queued with other deferred statements, and
+    the statements of the block are sent when it finishes, so errors are
+    caught at the block that caused them.
+    """
+
+    _local.savepoints += 1
+    name = sql.Identifier('nested_{}'.format(_local.savepoints))
+    queued = len(_local.deferred)
+    flushes = _local.flushes
+    defer(sql.SQL('SAVEPOINT {}').format(name))
+    try:
+        yield
+        defer(sql.SQL('RELEASE SAVEPOINT {}').format(name))
+        flush()
+    except BaseException:
+        if _local.flushes == flushes:
+            # Nothing of the block was sent yet
+            del _local.deferred[queued:]
+        elif not _local.conn.closed:
+            _local.deferred = []
+            with _local.conn.cursor() as cur:
+                cur.execute(sql.SQL('ROLLBACK TO SAVEPOINT {}').format(name))
+        raise
+
+
+def in_transaction():
+    """
+    Checks if a transaction is open in this thread
+
+    Returns:
+        (boolean) open - True inside a transaction block
+    """
+
+    return getattr(_local, 'conn', None) is not None
+
+
+def defer(query, params=None):
+    """
+    Queues a write statement that has no results to read
+
+    Inside a transaction the statement is sent with other queued statements
+    before the next query or at commit. Outside a transaction it is executed
+    right away.
+
+    Args:
+        (string/Composed) query - SQL statement
+        (tuple/dict) params - Statement parameters
+    """
+
+    if in_transaction():
+        _local.deferred.append((query, params))
+    else:
+        execute(query, params)
+
+
+def flush():
+    """
+    Sends the queued statements of the current transaction in one round trip
+    """
+
+    if not in_transaction() or not _local.deferred:
+        return
+
+    deferred = _local.deferred
+    _local.deferred = []
+    _local.flushes += 1
+    with _local.conn.cursor() as cur:
+        statements = [cur.mogrify(query, params) for query, params in deferred]
+        cur.execute(b';'.join(statements))
+
+
+def run(query, params=None, handler=None, read_only=False):
+    """
+    Executes a statement on a pooled connection and commits it
+
+    Connections idle in the pool are checked before use (see
+    checkout_connection). A read failing because the connection was dropped
+    is still retried once on a new connection. Writes are not retried, since the server may have
+    executed the statement before the connection was lost. Inside a
+    transaction the statement is executed on the transaction connection and
+    not committed.
+
+    Args:
+        (string/Composed) query - SQL statement
+        (tuple/dict) params - Statement parameters
+        (function) handler - Reads the results from the cursor
+        (boolean) read_only - The statement only reads (safe to retry)
+    Returns:
+        (any) result - Value returned by handler (rowcount by default)
+    """
+
+    if handler is None:
+        handler = lambda cur: cur.rowcount
+
+    if in_transaction():
+        flush()
+        with _local.conn.cursor() as cur:
+            cur.execute(query, params)
+            return handler(cur)
+
+    attempts = 2
+    while True:
+        attempts -= 1
+        conn = checkout_connection()
+        discard = False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                result = handler(cur)
+            conn.commit()
+            return result
+        except CONNECTION_ERRORS:
+            discard = True
+            if attempts == 0 or not read_only or not conn.closed:
+                raise
+        except BaseException:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            release_connection(conn, discard)
+
+
+def execute(query, params=None):
+    """
+    Executes a statement
+
+    Args:
+        (string/Composed) query - SQL statement
+        (tuple/dict) params - Statement parameters
+    Returns:
+        (int) rowcount - How many rows affected
+    """
+
+    return run(query, params)
+
+
+def fetch_one(query, params=None, read_only=True):
+    """
+    Executes a statement and fetches the first row
+
+    Args:
+        (string/Composed) query - SQL statement
+        (tuple/dict) params - Statement parameters
+        (boolean) read_only - The statement only reads (safe to retry)
+    Returns:
+        (list) columns - Data columns
+        (tuple) values - Data values (None if no rows)
+    """
+
+    def handler(cur):
+        return [desc[0] for desc in cur.description], cur.fetchone()
+
+    return run(query, params, handler, read_only)
+
+
+def fetch_all(query, params=None, read_only=True):
+    """
+    Executes a statement and fetches all rows
+
+    Args:
+        (string/Composed) query - SQL statement
+        (tuple/dict) params - Statement parameters
+        (boolean) read_only - The statement only reads (safe to retry)
+    Returns:
+        (list) columns - Data columns
+        (list) rows - Data rows as tuples
+    """
+
+    def handler(cur):
+        return [desc[0] for desc in cur.description], cur.fetchall()
+
+    return run(query, params, handler, read_only)
+
+
+def insert_row(table_name, column_names, column_values, returning='*'):
+    """
+    Inserts a row with parameterized values
+
+    Args:
+        (string) table_name - Table name
+        (string list) column_names - Column names
+        (list) column_values - Column values
+        (string) returning - Returned column name ('*' for all columns)
+    Returns:
+        (list) columns - Returned columns
+        (tuple) values - Returned values
+    """
+
+    if _write_behind is not None:
+        return _write_behind.insert_row(table_name, column_names, column_values, returning)
+
+    if returning == '*':
+        returning_sql = sql.SQL('*')
+    else:
+        returning_sql = sql.Identifier(returning)
+
+    if column_names:
+        query = sql.SQL('INSERT INTO {} ({}) VALUES ({}) RETURNING {}').format(
+            sql.Identifier(table_name),
+            sql.SQL(', ').join(map(sql.Identifier, column_names)),
+            sql.SQL(', ').join(sql.Placeholder() * len(column_names)),
+            returning_sql)
+    else:
+        query = sql.SQL('INSERT INTO {} DEFAULT VALUES RETURNING {}').format(
+            sql.Identifier(table_name), returning_sql)
+
+    return fetch_one(query, list(column_values), read_only=False)
+
+
+def defer_insert_row(table_name, column_names, column_values):
+    """
+    Queues an INSERT whose generated values are not needed (see defer)
+
+    Args:
+        (string) table_name - Table name
+        (string list) column_names - Column names
+        (list) column_values - Column values
+    """
+
+    if _write_behind is not None:
+        _write_behind.insert_row(table_name, column_names, column_values)
+        return
+
+    query = sql.SQL('INSERT INTO {} ({}) VALUES ({})').format(
+        sql.Identifier(table_name),
+        sql.SQL(', ').join(map(sql.Identifier, column_names)),
+        sql.SQL(', ').join(sql.Placeholder() * len(column_names)))
+
+    defer(query, list(column_values))
+
+
+def update_row(table_name, id_name, id_value, column_names, column_values):
+    """
+    Updates columns of a row by ID number with parameterized values
+
+    Args:
+        (string) table_name - Table name
+        (string) id_name - Name of ID column
+        (integer) id_value - ID number
+        (string list) column_names - Column names
+        (list) column_values - Column values
+    Returns:
+        (int) updated_rows - How many rows updated
+    """
+
+    if not column_names:
+        return 0
+
+    if _write_behind is not None:
+        return _write_behind.update_row(table_name, id_name, id_value,
+                                        column_names, column_values)
+
+    query = sql.SQL('UPDATE {} SET {} WHERE {} = %s').format(
+        sql.Identifier(table_name),
+        sql.SQL(', ').join(sql.SQL('{} = %s').format(sql.Identifier(column_name))
+                           for column_name in column_names),
+        sql.Identifier(id_name))
+
+    return execute(query, list(column_values) + [id_value])
+
+
+def select_row(table_name, id_name, id_value):
+    """
+    Selects a row by ID number
+
+    Args:
+        (string) table_name - Table name
+        (string) id_name - Name of ID column
+        (integer) id_value - ID number
+    Returns:
+        (list) columns - Data columns
+        (tuple) values - Data values (None if not found)
+    """
+
+    if _write_behind is not None:
+        return _write_behind.select_row(table_name, id_name, id_value)
+
+    return read_row(table_name, id_name, id_value)
+
+
+def read_row(table_name, id_name, id_value):
+    """
+    Selects a row by ID number from the database (bypassing write-behind)
+
+    Args:
+        (string) table_name - Table name
+        (string) id_name - Name of ID column
+        (integer) id_value - ID number
+    Returns:
+        (list) columns - Data columns
+        (tuple) values - Data values (None if not found)
+    """
+
+    query = sql.SQL('SELECT * FROM {} WHERE {} = %s').format(
+        sql.Identifier(table_name), sql.Identifier(id_name))
+
+    return fetch_one(query, (id_value,))
+
+
+def reserve_ids(table_name, id_name, count):
+    """
+    Reserves ID numbers from the serial sequence of a table
+
+    Args:
+        (string) table_name - Table name
+        (string) id_name - Name of serial ID column
+        (integer) count - How many IDs to reserve
+    Returns:
+        (list) id_numbers - Reserved ID numbers
+    """
+
+    columns, rows = fetch_all(
+        'SELECT nextval(pg_get_serial_sequence(%s, %s)) FROM generate_series(1, %s)',
+        (table_name, id_name, count))
+
+    return [row[0] for row in rows]
@@ -0,0 +1,392 @@
+import csv
+import sys
+import unicodedata
+from itertools import combinations
+
+import psycopg2
+
+import db
+
+# Person columns loaded for comparison
+PERSON_COLUMNS = ['person_id', 'page_number', 'first_names', 'last_name', 'gender',
+                  'birth_date', 'death_date', 'page_from', 'page_to']
+
+# Blocks larger than this are compared only with neighbours in name order
+MAX_BLOCK_SIZE = 100
+WINDOW_SIZE = 20
+
+# Minimum score of a reported candidate pair
+THRESHOLD = 0.8
+
+# Letters and letter groups with the same sound in old Finnish and Swedish records
+PHONETIC_REPLACEMENTS = [('ph', 'f'), ('th', 't'), ('dh', 'd'), ('ch', 'k'), ('ck', 'k'),
+                         ('w', 'v'), ('z', 'ts'), ('x', 'ks'), ('q', 'k'), ('c', 'k'),
+                         ('b', 'p'), ('g', 'k')]
+
+
+def normalize_name(name):
+    """
+    Converts a name to lower case letters without accents (ä is a, ö is o)
+
+    Args:
+        (string) name - Name
+    Returns:
+        (string) name - Normalized name
+    """
+
+    if not name:
+        return ''
+
+    name = unicodedata.normalize('NFKD', name.lower())
+    return ''.join(character for character in name if 'a' <= character <= 'z'
+                   or character == ' ').strip()
+
+
+def phonetic_key(name):
+    """
+    Builds a Finnish-aware phonetic key of a name
+
+    Spelling variants such as Tossavainen and Tossawainen get the same key:
+    old spellings are replaced, double letters collapsed and vowels after
+    the first letter dropped.
+
+    Args:
+        (string) name - Name
+    Returns:
+        (string) key - Phonetic key
+    """
+
+    name = normalize_name(name).replace(' ', '')
+    if not name:
+        return ''
+
+    for old, new in PHONETIC_REPLACEMENTS:
+        name = name.replace(old, new)
+
+    key = name[0]
+    for character in name[1:]:
+        if character in 'aeiouy' or character == key[-1]:
+            continue
+        key += character
+
+    return key
+
+
+def first_name(first_names):
+    """
+    Returns the first of given names
+
+    Args:
+        (string) first_names - First names
+    Returns:
+        (string) name - First name (empty if not known)
+    """
+
+    names = normalize_name(first_names).split()
+    if names:
+        return names[0]
+    return ''
+
+
+def birth_year(date):
+    """
+    Returns the year of a YYYY-MM-DD date
+
+    Args:
+        (string) date - Date
+    Returns:
+        (integer/none) year - Year or None if not known
+    """
+
+    if date:
+        try:
+            return int(date[0:4])
+        except ValueError:
+            pass
+    return None
+
+
+def jaro_winkler(first, second):
+    """
+    Calculates Jaro-Winkler similarity of two strings
+
+    Args:
+        (string) first - First string
+        (string) second - Second string
+    Returns:
+        (float) similarity - Similarity from 0 (different) to 1 (same)
+    """
+
+    if first == second:
+        return 1.0
+    if not first or not second:
+        return 0.0
+
+    match_distance = max(len(first), len(second)) // 2 - 1
+    first_matches = [False] * len(first)
+    second_matches = [False] * len(second)
+
+    matches = 0
+    for i, character in enumerate(first):
+        start = max(0, i - match_distance)
+        end = min(i + match_distance + 1, len(second))
+        for j in range(start, end):
+            if not second_matches[j] and second[j] == character:
+                first_matches[i] = True
+                second_matches[j] = True
+                matches += 1
+                break
+
+    if matches == 0:
+        return 0.0
+
+    transpositions = 0
+    j = 0
+    for i, character in enumerate(first):
+        if first_matches[i]:
+            while not second_matches[j]:
+                j += 1
+            if character != second[j]:
+                transpositions += 1
+            j += 1
+
+    jaro = (matches / len(first) + matches / len(second) +
+            (matches - transpositions / 2) / matches) / 3
+
+    prefix = 0
+    for character1, character2 in zip(first[:4], second[:4]):
+        if character1 != character2:
+            break
+        prefix += 1
+
+    return jaro + prefix * 0.1 * (1 - jaro)
+
+
+def date_similarity(first, second):
+    """
+    Compares two partial YYYY-MM-DD dates (XX for unknown parts)
+
+    Args:
+        (string) first - First date
+        (string) second - Second date
+    Returns:
+        (float/none) similarity - 1 for matching, 0 for conflicting dates,
+                                  None if either is not known
+    """
+
+    if not first or not second:
+        return None
+
+    first_parts = first.split('-')
+    second_parts = second.split('-')
+    if first_parts[0] != second_parts[0]:
+        year1 = birth_year(first)
+        year2 = birth_year(second)
+        if year1 is not None and year2 is not None and abs(year1 - year2) == 1:
+            return 0.5 # Often off by one in transcriptions
+        return 0.0
+
+    for part1, part2 in zip(first_parts[1:], second_parts[1:]):
+        if 'X' in part1.upper() or 'X' in part2.upper():
+            return 0.9 # Matching as far as known
+        if part1.lstrip('0') != part2.lstrip('0'):
+            return 0.3
+
+    return 1.0
+
+
+def load_persons():
+    """
+    Loads the persons table once for duplicate detection
+
+    Returns:
+        (list) persons - Person data by column name
+    """
+
+    columns, rows = db.fetch_all('SELECT {} FROM persons'.format(', '.join(PERSON_COLUMNS)))
+
+    return [prepare_person(dict(zip(columns, values))) for values in rows]
+
+
+def prepare_person(person):
+    """
+    Adds normalized names and keys used for comparison to person data
+
+    Args:
+        (dict) person - Person data by column name
+    Returns:
+        (dict) person - Person data with keys
+    """
+
+    person['first_name_key'] = first_name(person['first_names'])
+    person['last_name_key'] = normalize_name(person['last_name'])
+    person['first_phonetic'] = phonetic_key(person['first_name_key'])
+    person['last_phonetic'] = phonetic_key(person['last_name'])
+    person['birth_year'] = birth_year(person['birth_date'])
+
+    return person
+
+
+def blocking_keys(person):
+    """
+    Generates the blocks a person is compared in
+
+    Married names differ from birth names, so persons are also blocked by
+    first name and birth date without the last name.
+
+    Args:
+        (dict) person - Person data
+    Returns:
+        (list) keys - Blocking keys
+    """
+
+    keys = []
+    if person['last_phonetic'] and person['birth_year'] is not None:
+        keys.append(('last_name_year', person['last_phonetic'], person['birth_year']))
+    if person['first_phonetic'] and person['last_phonetic']:
+        keys.append(('names', person['first_phonetic'], person['last_phonetic']))
+    if person['first_phonetic'] and person['birth_date']:
+        keys.append(('first_name_birth', person['first_phonetic'], person['birth_date']))
+    return keys
+
+
+def candidate_pairs(persons):
+    """
+    Generates each candidate pair once from blocks
+
+    Args:
+        (list) persons - Person data
+    Yields:
+        (tuple) pair - Indexes of two persons
+    """
+
+    blocks = {}
+    for index, person in enumerate(persons):
+        for key in blocking_keys(person):
+            blocks.setdefault(key, []).append(index)
+
+    seen = set()
+    for members in blocks.values():
+        if len(members) < 2:
+            continue
+
+        if len(members) <= MAX_BLOCK_SIZE:
+            pairs = combinations(members, 2)
+        else:
+            # Sorted neighbourhood keeps large blocks linear
+            members = sorted(members, key=lambda index: (persons[index]['last_name_key'],
+                                                         persons[index]['first_name_key']))
+            pairs = ((members[i], members[j]) for i in range(len(members))
+                     for j in range(i + 1, min(i + WINDOW_SIZE, len(members))))
+
+        for first, second in pairs:
+            pair = (min(first, second), max(first, second))
+            if pair not in seen:
+                seen.add(pair)
+                yield pair
+
+
+def score_pair(first, second, threshold=0.0):
+    """
+    Scores how likely two persons are the same person
+
+    Args:
+        (dict) first - First person data
+        (dict) second - Second person data
+        (float) threshold - Pairs that cannot reach this score get 0
+    Returns:
+        (float) score - Score from 0 to 1
+    """
+
+    if first['gender'] and second['gender'] and first['gender'] != second['gender']:
+        return 0.0
+
+    score = 0.0
+    for column_name, weight in (('birth_date', 0.3), ('death_date', 0.1)):
+        similarity = date_similarity(first[column_name], second[column_name])
+        if similarity is None:
+            similarity = 0.6 # Unknown dates neither confirm nor conflict
+        score += similarity * weight
+
+    # Persons referring to each other's pages are likely the same person
+    if (first['page_to'] == second['page_number'] or first['page_from'] == second['page_number']
+            or second['page_to'] == first['page_number']
+            or second['page_from'] == first['page_number']):
+        score += 0.1
+
+    # Names are compared only if the pair can still reach the threshold
+    if score + 0.6 < threshold:
+        return 0.0
+
+    score += 0.35 * jaro_winkler(first['first_name_key'], second['first_name_key'])
+    score += 0.25 * jaro_winkler(first['last_name_key'], second['last_name_key'])
+
+    return min(1.0, score)
+
+
+def find_duplicates(persons, threshold=THRESHOLD):
+    """
+    Finds candidate duplicate pairs ranked by score
+
+    Args:
+        (list) persons - Person data
+        (float) threshold - Minimum score
+    Returns:
+        (list) candidates - (score, first person, second person) tuples
+    """
+
+    candidates = []
+    for first, second in candidate_pairs(persons):
+        score = score_pair(persons[first], persons[second], threshold)
+        if score >= threshold:
+            candidates.append((score, persons[first], persons[second]))
+
+    candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]['person_id'],
+                                           candidate[2]['person_id']))
+    return candidates
+
+
+def write_candidates(candidates, output_file):
+    """
+    Writes candidate pairs as CSV
+
+    Args:
+        (list) candidates - (score, first person, second person) tuples
+        (file) output_file - Output file
+    """
+
+    writer = csv.writer(output_file)
+    header = ['score']
+    for prefix in ('person1_', 'person2_'):
+        header += [prefix + column_name for column_name in PERSON_COLUMNS]
+    writer.writerow(header)
+
+    for score, first, second in candidates:
+        writer.writerow(['{:.3f}'.format(score)] +
+                        [first[column_name] for column_name in PERSON_COLUMNS] +
+                        [second[column_name] for column_name in PERSON_COLUMNS])
+
+
+def dedupe_command(args):
+    """
+    Runs the dedupe command
+
+    Args:
+        (Namespace) args - Command line arguments
+    """
+
+    try:
+        persons = load_persons()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return
+
+    candidates = find_duplicates(persons, args.threshold)
+
+    if args.output:
+        with open(args.output, 'w', newline='', encoding='utf-8') as output_file:
+            write_candidates(candidates, output_file)
+        print('{} candidate pairs among {} persons written to {}.'.format(
+            len(candidates), len(persons), args.output))
+    else:
+        write_candidates(candidates, sys.stdout)
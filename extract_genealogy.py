@@ -1,5 +1,68 @@
+import argparse
+import threading
+
 import psycopg2
-from config import config
+import cache
+import db
+import journal
+import prefetch
+import search
+import storage
+
+# Supported person column names and types
+PERSON_INTEGER_COLUMNS = ['page_number', 'page_from', 'page_to']
+PERSON_BOOLEAN_COLUMNS = ['deceased']
+PERSON_STRING_COLUMNS = ['first_names', 'last_name', 'birth_date',
+                         'birth_place', 'death_date', 'death_place',
+                         'comments', 'gender']
+
+# Supported relationship column names and types
+RELATIONSHIP_INTEGER_COLUMNS = ['person_id_partner1', 'person_id_partner2']
+RELATIONSHIP_BOOLEAN_COLUMNS = []
+RELATIONSHIP_STRING_COLUMNS = ['marriage_date', 'marriage_place', 'divorce_date',
+                               'divorce_place', 'comments']
+
+# Saved and read rows are printed (see set_echo)
+_echo_rows = True
+
+# Show persons with similar names while adding a person (by thread, so each
+# daemon session has its own setting)
+_suggest_persons = threading.local()
+
+
+def prepare_columns(column_names, column_values, integer_columns, boolean_columns,
+                    string_columns):
+    """
+    Checks column names and converts values for saving
+
+    Args:
+        (list) column_names - Names of columns
+        (list) column_values - Values of columns
+        (list) integer_columns - Supported integer columns
+        (list) boolean_columns - Supported boolean columns
+        (list) string_columns - Supported string columns
+    Returns:
+        (list) prepared_names - Names of supported columns
+        (list) prepared_values - Values of supported columns
+    """
+
+    prepared_names = []
+    prepared_values = []
+    for column_name, column_value in zip(column_names, column_values):
+        if column_name in integer_columns or column_name in boolean_columns:
+            pass
+        elif column_name in string_columns:
+            if column_value is not None and len(column_value) == 0:
+                column_value = None # Empty strings should be NULL
+        else:
+            print("ERROR: Unsupported column name '{}'".format(column_name))
+            continue
+
+        prepared_names.append(column_name)
+        prepared_values.append(column_value)
+
+    return prepared_names, prepared_values
+
 
 def initialize_database_row(id_name, column_names, column_values, table_name):
     """
@@ -13,49 +76,106 @@ def initialize_database_row(id_name, column_names, column_values, table_name):
         (int) id_number - ID number
     """
 
-    # Create strings for added column data
-    column_list = None
-    value_list = None
-    first_column = True
-    for column_name, column_value in zip(column_names, column_values):
-        if column_value is None:
-            column_value = 'NULL' # Changing to SQL-supported type
+    id_number = None
+    try:
+        # execute the INSERT statement and get the generated ID back
+        columns, values = storage.insert_row(table_name, column_names, column_values,
+                                             returning=id_name)
+        id_number = values[0]
+    except (Exception, psycopg2.DatabaseError) as error:
+        # Inside a transaction the error rolls back the whole block
+        if storage.in_transaction():
+            raise
+        print(error)
 
-        if first_column:
-            column_list = column_name
-            value_list = str(column_value)
-            first_column = False
-        else:
-            column_list = column_list + ', ' + column_name
-            value_list = value_list + ', ' + str(column_value)
+    return id_number
 
-    sql = 'INSERT INTO {} ({}) VALUES({}) RETURNING {};'.format(table_name, column_list,
-                                                                value_list, id_name)
 
-    conn = None
-    id_number = None
+def create_database_row(column_names, column_values, table_name):
+    """
+    Adds a row in given table and returns the saved row
+
+    Args:
+        (string list) column_names - Column names
+        (list) column_values - Column values
+        (string) table_name - Table name
+    Returns:
+        (list) columns - Data columns
+        (tuple) values - Data values
+    """
+
+    columns = None
+    values = None
     try:
-        # read database configuration
-        params = config()
-        # connect to the PostgreSQL database
-        conn = psycopg2.connect(**params)
-        # create a new cursor
-        cur = conn.cursor()
-        # execute the INSERT statement
-        cur.execute(sql)
-        # get the generated ID back
-        id_number = cur.fetchone()[0]
-        # commit the changes to the database
-        conn.commit()
-        # close communication with the database
-        cur.close()
+        # execute the INSERT statement and get the whole row back
+        columns, values = storage.insert_row(table_name, column_names, column_values)
     except (Exception, psycopg2.DatabaseError) as error:
+        # Inside a transaction the error rolls back the whole block
+        if storage.in_transaction():
+            raise
         print(error)
-    finally:
-        if conn is not None:
-            conn.close()
 
-    return id_number
+    return columns, values
+
+
+def modify_database_row(id_name, id_value, column_names, column_values, table_name):
+    """
+    Modifies a row in given table by ID number
+
+    Args:
+        (string) id_name - Name of ID column
+        (integer) id_value - ID number
+        (list) column_names - Names of columns
+        (list) column_values - Values of columns
+        (string) table_name - Table name
+    Returns:
+        (int) updated_rows - How many rows updated
+    """
+
+    updated_rows = 0
+    try:
+        # execute the UPDATE statement and get the number of updated rows
+        updated_rows = storage.update_row(table_name, id_name, id_value,
+                                          column_names, column_values)
+    except (Exception, psycopg2.DatabaseError) as error:
+        # Inside a transaction the error rolls back the whole block
+        if storage.in_transaction():
+            raise
+        print(error)
+
+    return updated_rows
+
+
+def cache_saved_row(row_cache, id_value, columns, values):
+    """
+    Caches a saved or read row, shared with other sessions after commit
+
+    Args:
+        (RowCache) row_cache - cache.persons or cache.relationships
+        (integer) id_value - Row ID
+        (list) columns - Data columns
+        (tuple) values - Data values
+    """
+
+    row_cache.put_uncommitted(id_value, columns, values)
+    storage.after_commit(lambda: row_cache.publish(id_value),
+                         lambda: row_cache.discard(id_value))
+
+
+def invalidate_cached_row(row_cache, id_value):
+    """
+    Drops a modified row from the cache now and again after commit
+
+    Until the change commits other sessions may cache the old row again.
+
+    Args:
+        (RowCache) row_cache - cache.persons or cache.relationships
+        (integer) id_value - Row ID
+    """
+
+    row_cache.invalidate(id_value)
+    storage.after_commit(lambda: row_cache.settle(id_value),
+                         lambda: row_cache.settle(id_value))
 
 
 def initialize_person(page_number):
@@ -77,87 +197,55 @@ def initialize_person(page_number):
     return person_id
 
 
-def modify_person(person_id, column_names, column_values):
+def create_person(page_number, column_names, column_values):
     """
-    Adds or modifies person data
+    Inserts a person with all data into database in one statement
 
     Args:
-        (integer) person_id - Person's ID
+        (integer) page_number - Page number
         (list) column_names - Names of columns
         (list) column_values - Values of columns
     Returns:
-        (int) updated_rows - How many rows updated
+        (list) columns - Data columns
+        (tuple) values - Data values
     """
 
-    sql = "UPDATE persons SET "
+    column_names, column_values = prepare_columns(
+        ['page_number'] + list(column_names), [page_number] + list(column_values),
+        PERSON_INTEGER_COLUMNS, PERSON_BOOLEAN_COLUMNS, PERSON_STRING_COLUMNS)
 
-    # Supported column names and types
-    integer_columns = ['page_number', 'page_from', 'page_to']
-    boolean_columns = ['deceased']
-    string_columns = ['first_names', 'last_name', 'birth_date',
-                      'birth_place', 'death_date', 'death_place',
-                      'comments', 'gender']
-
-    first_column = True
-    for column_name, column_value in zip(column_names, column_values):
+    columns, values = create_database_row(column_names, column_values, 'persons')
 
-        # SET list separated by commas
-        if not first_column:
-            sql = sql + ', '
+    # Saved row is displayed from cache and found by name
+    if values is not None:
+        cache_saved_row(cache.persons, values[columns.index('person_id')], columns, values)
+        storage.after_commit(lambda: search.person_added(columns, values))
 
-        # Add columns to SQL command by type
-        if column_name in integer_columns:
-            if column_value is None:
-                column_value = 'NULL' # Changing to SQL-supported type
-            sql = sql + '{} = {}'.format(column_name, column_value)
+    return columns, values
 
-        elif column_name in boolean_columns:
-            sql = sql + '{} = {}'.format(column_name, column_value)
 
-        elif column_name in string_columns:
-            if len(column_value) == 0:
-                column_value = 'NULL' # Empty strings should be NULL
-            else:
-                # Change ' characters with '' for SQL input compatibility
-                if column_value.find('\'') != -1:
-                    column_value.replace('\'', '\'\'')
+def modify_person(person_id, column_names, column_values):
+    """
+    Adds or modifies person data
 
-                column_value = "'" + column_value + "'" # Strings within '' in SQL
+    Args:
+        (integer) person_id - Person's ID
+        (list) column_names - Names of columns
+        (list) column_values - Values of columns
+    Returns:
+        (int) updated_rows - How many rows updated
+    """
 
-            sql = sql + '{} = {}'.format(column_name, column_value)
-        else:
-            print("ERROR: Unsupported column name '{}'".format(column_name))
+    column_names, column_values = prepare_columns(
+        column_names, column_values,
+        PERSON_INTEGER_COLUMNS, PERSON_BOOLEAN_COLUMNS, PERSON_STRING_COLUMNS)
 
-        if first_column:
-            first_column = False
+    invalidate_cached_row(cache.persons, person_id)
+    storage.after_commit(lambda: search.person_modified(person_id, column_names,
+                                                        column_values))
 
-    sql = sql + ' WHERE person_id = {}'.format(person_id)
-
-    # Save values to PostgreSQL database
-    conn = None
-    updated_rows = 0
-    try:
-        # read database configuration
-        params = config()
-        # connect to the PostgreSQL database
-        conn = psycopg2.connect(**params)
-        # create a new cursor
-        cur = conn.cursor()
-        # execute the UPDATE  statement
-        cur.execute(sql)
-        # get the number of updated rows
-        updated_rows = cur.rowcount
-        # Commit the changes to the database
-        conn.commit()
-        # Close communication with the PostgreSQL database
-        cur.close()
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-    finally:
-        if conn is not None:
-            conn.close()
-
-    return updated_rows
+    return modify_database_row('person_id', person_id, column_names,
+                               column_values, 'persons')
 
 
 def convert_date_dmy_to_ymd(date):
@@ -196,24 +284,84 @@ def get_database_row(id_name, id_value, table_name):
         (tuple) person_data - Personal data
     """
 
-    conn = None
+    columns = None
+    values = None
     try:
-        params = config()
-        conn = psycopg2.connect(**params)
-        cur = conn.cursor()
-        cur.execute("SELECT * FROM {} WHERE {} = {}".format(table_name, id_name, id_value))
+        # columns as list, values as tuple
+        columns, values = storage.select_row(table_name, id_name, id_value)
+    except (Exception, psycopg2.DatabaseError) as error:
+        # Inside a transaction the error rolls back the whole block
+        if storage.in_transaction():
+            raise
+        print(error)
+
+    return columns, values
+
+
+def set_echo(enabled):
+    """
+    Enables or disables printing saved and read rows
+
+    Args:
+        (boolean) enabled - Print rows
+    """
+
+    global _echo_rows
+    _echo_rows = enabled
 
-        values = cur.fetchone() # Values as tuple
-        columns = [desc[0] for desc in cur.description] # columns as list
 
-        cur.close()
+def set_suggest(enabled):
+    """
+    Enables or disables showing persons with similar names in add_person
+
+    The setting applies to the current thread (daemon session) only.
+
+    Args:
+        (boolean) enabled - Show similar persons
+    """
+
+    _suggest_persons.enabled = enabled
+
+
+def print_similar_persons(first_names, last_name, limit=3):
+    """
+    Prints saved persons with names similar to the given names
+
+    Args:
+        (string) first_names - First names
+        (string) last_name - Last name
+        (integer) limit - Most persons printed
+    """
+
+    try:
+        matches = search.search('{} {}'.format(first_names, last_name), limit)
     except (Exception, psycopg2.DatabaseError) as error:
         print(error)
-    finally:
-        if conn is not None:
-            conn.close()
+        return
 
-    return columns, values
+    if matches:
+        print('  Similar persons already saved:')
+    for match in matches:
+        print('  - {} [{}] page {}'.format(format_person(match), match['person_id'],
+                                           match['page_number']))
+
+
+def print_database_row(title, columns, values):
+    """
+    Prints saved row values
+
+    Args:
+        (string) title - Title printed before values
+        (list) columns - Data columns
+        (tuple) values - Data values
+    """
+
+    if not _echo_rows:
+        return
+
+    print(title)
+    for column, value in zip(columns or [], values or []):
+        print('"{}": "{}"'.format(column, value))
 
 
 def get_person(person_id, print_values=False):
@@ -227,13 +375,16 @@ def get_person(person_id, print_values=False):
         (tuple) values - Data values
     """
 
-    columns, values = get_database_row('person_id', person_id, 'persons')
+    cached_row = cache.persons.get(person_id)
+    if cached_row is not None:
+        columns, values = cached_row
+    else:
+        columns, values = get_database_row('person_id', person_id, 'persons')
+        cache_saved_row(cache.persons, person_id, columns, values)
 
     # Optionally print saved values
     if print_values:
-        print('Person values in database:')
-        for column, value in zip(columns, values):
-            print('"{}": "{}"'.format(column, value))
+        print_database_row('Person values in database:', columns, values)
 
     return columns, values
 
@@ -249,13 +400,17 @@ def get_relationship(relationship_id, print_values=False):
         (tuple) values - Data values
     """
 
-    columns, values = get_database_row('relationship_id', relationship_id, 'relationships')
+    cached_row = cache.relationships.get(relationship_id)
+    if cached_row is not None:
+        columns, values = cached_row
+    else:
+        columns, values = get_database_row('relationship_id', relationship_id,
+                                           'relationships')
+        cache_saved_row(cache.relationships, relationship_id, columns, values)
 
     # Optionally print saved values
     if print_values:
-        print('Relationship values in database:')
-        for column, value in zip(columns, values):
-            print('"{}": "{}"'.format(column, value))
+        print_database_row('Relationship values in database:', columns, values)
 
     return columns, values
 
@@ -275,13 +430,60 @@ def get_child(child_id, print_values=False):
 
     # Optionally print saved values
     if print_values:
-        print('Child values in database:')
-        for column, value in zip(columns, values):
-            print('"{}": "{}"'.format(column, value))
+        print_database_row('Child values in database:', columns, values)
 
     return columns, values
 
 
+def normalize_gender(gender):
+    """
+    Converts gender input to the saved format
+
+    Args:
+        (string) gender - Gender input
+    Returns:
+        (string) gender - MALE, FEMALE or the input in lower case
+    """
+
+    gender = gender.strip().lower()
+
+    if gender in ('m', 'male'):
+        gender = 'MALE'
+    elif gender in ('f', 'female'):
+        gender = 'FEMALE'
+
+    return gender
+
+
+def infer_deceased(birth_date, death_date):
+    """
+    Checks if a person can be assumed deceased
+
+    Args:
+        (string) birth_date - Birth date in YYYY-MM-DD format
+        (string) death_date - Death date in YYYY-MM-DD format
+    Returns:
+        (boolean/none) deceased - True if deceased, None if not known
+    """
+
+    deceased = None
+
+    # If person died or born over 101 years ago, we can assume deceased
+    if death_date:
+        deceased = True
+
+    if birth_date:
+        try:
+            birth_year = int(birth_date[0:4])
+        except ValueError:
+            pass
+        else:
+            if birth_year <= 1919:
+                deceased = True
+
+    return deceased
+
+
 def add_person(page_number):
     """
     Inputs person data and adds person to database
@@ -312,12 +514,9 @@ def add_person(page_number):
 
         first_names = input('- First names: ').strip()
         last_name = input('- Last name: ').strip()
-        gender = input('- Gender: ').strip().lower()
-
-        if gender in ('m', 'male'):
-            gender = 'MALE'
-        elif gender in ('f', 'female'):
-            gender = 'FEMALE'
+        if getattr(_suggest_persons, 'enabled', False) and (first_names or last_name):
+            print_similar_persons(first_names, last_name)
+        gender = normalize_gender(input('- Gender: '))
 
         birth_date = input('- Birth date: ').strip() # different date formats
         birth_place = input('- Birth place: ').strip()
@@ -328,19 +527,7 @@ def add_person(page_number):
         death_date = convert_date_dmy_to_ymd(death_date)
 
         # Process deceased
-        deceased = None # reset value if values changed
-        # - If person died or born over 101 years ago, we can assume deceased
-        if len(death_date) != 0:
-            deceased = True
-
-        if birth_date != 0:
-            try:
-                birth_year = int(birth_date[0:4])
-            except ValueError:
-                pass
-            else:
-                if birth_year <= 1919:
-                    deceased = True
+        deceased = infer_deceased(birth_date, death_date) # reset value if values changed
 
         # - Otherwise ask it from user
         while deceased is None:
@@ -386,20 +573,21 @@ def add_person(page_number):
             else:
                 print('ERROR: Please answer y(es) or n(o).')
 
-    # Checks and adds user to database
-    person_id = initialize_person(page_number)
-
-    # Add other person information
+    # Add person with all information to database
     column_names = ['first_names', 'last_name', 'birth_date', 'birth_place',
                     'death_date', 'death_place', 'comments', 'gender',
                     'deceased', 'page_from', 'page_to']
     column_values = [first_names, last_name, birth_date, birth_place,
                      death_date, death_place, comments, gender,
                      deceased, page_from, page_to]
-    modify_person(person_id, column_names, column_values)
+    columns, values = create_person(page_number, column_names, column_values)
 
     # Print saved data
-    get_person(person_id, print_values=True)
+    print_database_row('Person values in database:', columns, values)
+
+    person_id = None
+    if values is not None:
+        person_id = values[columns.index('person_id')]
 
     return person_id
 
@@ -463,8 +651,6 @@ def add_relationship(partner1_id, partner2_id=None):
             else:
                 print('Please type y(es) or n(o).')
 
-    relationship_id = initialize_relationship(partner1_id, partner2_id)
-
     if relationship_marriage not in ('n', 'N'):
         marriage_date = convert_date_dmy_to_ymd(marriage_date)
         divorce_date = convert_date_dmy_to_ymd(divorce_date)
@@ -473,10 +659,15 @@ def add_relationship(partner1_id, partner2_id=None):
                     'divorce_place', 'comments']
     column_values = [marriage_date, marriage_place, divorce_date,
                      divorce_place, comments]
-    modify_relationship(relationship_id, column_names, column_values)
+    columns, values = create_relationship(partner1_id, partner2_id,
+                                          column_names, column_values)
 
     # Print saved data
-    get_relationship(relationship_id, print_values=True)
+    print_database_row('Relationship values in database:', columns, values)
+
+    relationship_id = None
+    if values is not None:
+        relationship_id = values[columns.index('relationship_id')]
 
     return relationship_id
 
@@ -501,84 +692,56 @@ def initialize_relationship(partner1_id, partner2_id):
     return relationship_id
 
 
-def modify_relationship(relationship_id, column_names, column_values):
+def create_relationship(partner1_id, partner2_id, column_names, column_values):
     """
-    Adds or modifies relationship data
+    Inserts a relationship with all data into database in one statement
 
     Args:
-        (integer) relatinship_id - Relationship ID
+        (integer) partner1_id - Person ID for partner 1
+        (integer) partner2_id - Person ID for partner 2 ('None' if not known)
         (list) column_names - Names of columns
         (list) column_values - Values of columns
     Returns:
-        (int) updated_rows - How many rows updated
+        (list) columns - Data columns
+        (tuple) values - Data values
     """
 
-    sql = "UPDATE relationships SET "
+    column_names, column_values = prepare_columns(
+        ['person_id_partner1', 'person_id_partner2'] + list(column_names),
+        [partner1_id, partner2_id] + list(column_values),
+        RELATIONSHIP_INTEGER_COLUMNS, RELATIONSHIP_BOOLEAN_COLUMNS,
+        RELATIONSHIP_STRING_COLUMNS)
 
-    # Supported column names and types
-    integer_columns = ['person_id_partner1', 'person_id_partner2']
-    string_columns = ['marriage_date', 'marriage_place', 'divorce_date',
-                      'divorce_place', 'comments']
+    columns, values = create_database_row(column_names, column_values, 'relationships')
 
-    first_column = True
-    for column_name, column_value in zip(column_names, column_values):
+    # Saved row is displayed from cache
+    if values is not None:
+        cache_saved_row(cache.relationships, values[columns.index('relationship_id')],
+                        columns, values)
 
-        # SET list separated by commas
-        if not first_column:
-            sql = sql + ', '
+    return columns, values
 
-        # Add columns to SQL command by type
-        if column_name in integer_columns:
-            if column_value is None:
-                column_value = 'NULL' # Changing to SQL-supported type
-            sql = sql + '{} = {}'.format(column_name, column_value)
 
-        elif column_name in string_columns:
-            if column_value is None:
-                column_value = 'NULL' # Changing to SQL-supported type
-            elif len(column_value) == 0:
-                column_value = 'NULL' # Empty strings should be NULL
-            else:
-                # Change ' characters with '' for SQL input compatibility
-                if column_value.find('\'') != -1:
-                    column_value.replace('\'', '\'\'')
+def modify_relationship(relationship_id, column_names, column_values):
+    """
+    Adds or modifies relationship data
 
-                column_value = "'" + column_value + "'" # Strings within '' in SQL
+    Args:
+        (integer) relatinship_id - Relationship ID
+        (list) column_names - Names of columns
+        (list) column_values - Values of columns
+    Returns:
+        (int) updated_rows - How many rows updated
+    """
 
-            sql = sql + '{} = {}'.format(column_name, column_value)
-        else:
-            print("ERROR: Unsupported column name '{}'".format(column_name))
+    column_names, column_values = prepare_columns(
+        column_names, column_values, RELATIONSHIP_INTEGER_COLUMNS,
+        RELATIONSHIP_BOOLEAN_COLUMNS, RELATIONSHIP_STRING_COLUMNS)
 
-        if first_column:
-            first_column = False
+    invalidate_cached_row(cache.relationships, relationship_id)
 
-    sql = sql + ' WHERE relationship_id = {}'.format(relationship_id)
-
-    # Save values to PostgreSQL database
-    conn = None
-    updated_rows = 0
-    try:
-        # read database configuration
-        params = config()
-        # connect to the PostgreSQL database
-        conn = psycopg2.connect(**params)
-        # create a new cursor
-        cur = conn.cursor()
-        # execute the UPDATE  statement
-        cur.execute(sql)
-        # get the number of updated rows
-        updated_rows = cur.rowcount
-        # Commit the changes to the database
-        conn.commit()
-        # Close communication with the PostgreSQL database
-        cur.close()
-    except (Exception, psycopg2.DatabaseError) as error:
-        print(error)
-    finally:
-        if conn is not None:
-            conn.close()
-
-    return updated_rows
+    return modify_database_row('relationship_id', relationship_id, column_names,
+                               column_values, 'relationships')
 
 
 def add_child(relationship_id, person_id, verbose=False):
@@ -633,6 +796,14 @@ def add_child(relationship_id, person_id, verbose=False):
         if ok_to_proceed not in ('n', 'no'):
             review_finished = True
 
+    # Inside a family line transaction the child is saved with the other
+    # queued statements as no ID is needed right away
+    if storage.in_transaction():
+        queue_child(relationship_id, person_id)
+        print_database_row('Child values to be saved:', ['relationship_id', 'person_id'],
+                           [relationship_id, person_id])
+        return None
+
     child_id = initialize_child(relationship_id, person_id)
 
     # Print saved data
@@ -661,6 +832,25 @@ def initialize_child(relationship_id, person_id):
     return child_id
 
 
+def queue_child(relationship_id, person_id):
+    """
+    Queues a child to be saved when the current transaction is flushed
+
+    Args:
+        (integer) relationship_id - Relationship ID that the child belongs to
+        (integer) person_id - Person ID for the child
+    """
+
+    try:
+        storage.defer_insert_row('children', ['relationship_id', 'person_id'],
+                                 [relationship_id, person_id])
+    except (Exception, psycopg2.DatabaseError) as error:
+        # Inside a transaction the error rolls back the whole block
+        if storage.in_transaction():
+            raise
+        print(error)
+
+
 def add_family(person_id_head, page_number):
     """
     Adds a family line recursively
@@ -670,52 +860,54 @@ def add_family(person_id_head, page_number):
         (integer) page_number - Page number
     """
 
-    print('Adding a family')
+    # All writes of the family line are committed together
+    with storage.transaction():
+        print('Adding a family')
 
-    add_more_spouses = True
-    while add_more_spouses:
-        spouse_known = input('Is the spouse known (Y/n)? ').lower()
-        person_id_spouse = None
-        if spouse_known not in ('n', 'no'):
-            page_number_new = input_integer('Provide page number (default {}): '.format(
-                page_number))
-            if page_number_new is not None:
-                page_number = page_number_new
+        add_more_spouses = True
+        while add_more_spouses:
+            spouse_known = input('Is the spouse known (Y/n)? ').lower()
+            person_id_spouse = None
+            if spouse_known not in ('n', 'no'):
+                page_number_new = input_integer('Provide page number (default {}): '.format(
+                    page_number))
+                if page_number_new is not None:
+                    page_number = page_number_new
 
-            person_id_spouse = add_person(page_number)
+                person_id_spouse = add_person(page_number)
 
-        relationship_id = add_relationship(person_id_head, person_id_spouse)
+            relationship_id = add_relationship(person_id_head, person_id_spouse)
 
-        add_more_children = False
-        print_relationship(relationship_id)
-        input_more_children = input('Add children to this relationship (y/N)? ').lower()
-        if input_more_children in ('y', 'yes'):
-            add_more_children = True
+            add_more_children = False
+            print_relationship(relationship_id)
+            input_more_children = input('Add children to this relationship (y/N)? ').lower()
+            if input_more_children in ('y', 'yes'):
+                add_more_children = True
 
-        while add_more_children:
-            page_number_new = input_integer('Provide page number (default {}): '.format(
-                page_number))
-            if page_number_new is not None:
-                page_number = page_number_new
+            while add_more_children:
+                page_number_new = input_integer('Provide page number (default {}): '.format(
+                    page_number))
+                if page_number_new is not None:
+                    page_number = page_number_new
 
-            person_id_child = add_person(page_number)
+                person_id_child = add_person(page_number)
 
-            add_child(relationship_id, person_id_child, False)
+                add_child(relationship_id, person_id_child, False)
 
-            input_family = input('Add family for {} (y/N)? '.format(
-                print_person(person_id_child))).lower()
-            if input_family in ('y', 'yes'):
-                add_family(person_id_child, page_number)
+                input_family = input('Add family for {} (y/N)? '.format(
+                    print_person(person_id_child))).lower()
+                if input_family in ('y', 'yes'):
+                    add_family(person_id_child, page_number)
 
-            print_relationship(relationship_id)
-            input_more_children = input('Add more children to this relationship (Y/n)? ').lower()
-            if input_more_children in ('n', 'no'):
-                add_more_children = False
+                print_relationship(relationship_id)
+                input_more_children = input('Add more children to this relationship (Y/n)? ').lower()
+                if input_more_children in ('n', 'no'):
+                    add_more_children = False
 
-        input_more_spouses = input('Add more spouses for {} (y/N)? '.format(
-            print_person(person_id_head))).lower()
-        if input_more_spouses not in ('y', 'yes'):
-            add_more_spouses = False
+            input_more_spouses = input('Add more spouses for {} (y/N)? '.format(
+                print_person(person_id_head))).lower()
+            if input_more_spouses not in ('y', 'yes'):
+                add_more_spouses = False
 
 
 def input_integer(input_message, allow_empty=True, allow_zero=False):
@@ -756,41 +948,59 @@ def input_integer(input_message, allow_empty=True, allow_zero=False):
     return read_input
 
 
-def print_person(person_id):
+# Relationships with partner data in one query
+RELATIONSHIP_SUMMARY_SQL = """
+SELECT r.relationship_id, r.marriage_date, r.divorce_date,
+       r.person_id_partner1, p1.first_names, p1.last_name, p1.birth_date, p1.death_date,
+       r.person_id_partner2, p2.first_names, p2.last_name, p2.birth_date, p2.death_date
+FROM relationships r
+LEFT JOIN persons p1 ON p1.person_id = r.person_id_partner1
+LEFT JOIN persons p2 ON p2.person_id = r.person_id_partner2
+"""
+
+# Person columns included in a relationship summary
+SUMMARY_PERSON_COLUMNS = ['person_id', 'first_names', 'last_name', 'birth_date',
+                          'death_date']
+
+
+def shorten_date(date):
     """
-    Prepares a person data print
+    Removes unknown month and day from a YYYY-MM-DD date
 
     Args:
-        (integer) person_id - Person ID
+        (string) date - Date in YYYY-MM-DD format
     Returns:
-        (string) print_data - Prepared print data
+        (string) date - Date in YYYY, YYYY-MM or YYYY-MM-DD format
     """
 
-    person_columns, person_data = get_person(person_id)
+    if date:
+        if date[4:] == '-XX-XX': # month and day missing
+            date = date[0:4]
+        elif date[7:] == '-XX': # only day missing
+            date = date[0:7]
+    return date
+
+
+def format_person(person):
+    """
+    Prepares a person data print from person data
 
-    first_names = person_data[2]
-    last_name = person_data[3]
-    birth_date = person_data[4]
-    death_date = person_data[6]
+    Args:
+        (dict) person - Person data by column name
+    Returns:
+        (string) print_data - Prepared print data
+    """
 
+    first_names = person.get('first_names')
+    last_name = person.get('last_name')
+    birth_date = shorten_date(person.get('birth_date'))
+    death_date = shorten_date(person.get('death_date'))
 
     if not first_names:
         first_names = '[NK]'
     if not last_name:
         last_name = '[NK]'
 
-    if birth_date:
-        if birth_date[4:] == '-XX-XX': # month and day missing
-            birth_date = birth_date[0:4]
-        elif birth_date[7:] == '-XX': # only day missing
-            birth_date = birth_date[0:7]
-
-    if death_date:
-        if death_date[4:] == '-XX-XX': # month and day missing
-            death_date = death_date[0:4]
-        elif death_date[7:] == '-XX': # only day missing
-            death_date = death_date[0:7]
-
     print_data = None
     if birth_date and death_date:
         print_data = '{} {} (b. {} d. {})'.format(first_names, last_name, birth_date, death_date)
@@ -804,62 +1014,526 @@ def print_person(person_id):
     return print_data
 
 
-def print_relationship(relationship_id):
+def print_person(person_id):
     """
-    Prepares a relationship data print
+    Prepares a person data print
+
+    Args:
+        (integer) person_id - Person ID
+    Returns:
+        (string) print_data - Prepared print data
+    """
+
+    person_columns, person_data = get_person(person_id)
+    person = dict(zip(person_columns or [], person_data or []))
+
+    return format_person(person)
+
+
+def summary_from_row(values):
+    """
+    Converts a relationship summary query row to summary data
+
+    Args:
+        (tuple) values - Row of RELATIONSHIP_SUMMARY_SQL
+    Returns:
+        (dict) summary - Relationship ID, dates and partner data
+    """
+
+    summary = {'relationship_id': values[0], 'marriage_date': values[1],
+               'divorce_date': values[2], 'partner1': None, 'partner2': None}
+
+    if values[3] is not None:
+        summary['partner1'] = dict(zip(SUMMARY_PERSON_COLUMNS, values[3:8]))
+    if values[8] is not None:
+        summary['partner2'] = dict(zip(SUMMARY_PERSON_COLUMNS, values[8:13]))
+
+    return summary
+
+
+def get_relationship_summaries(relationship_ids):
+    """
+    Gets summaries of many relationships with one query
+
+    Args:
+        (list) relationship_ids - Relationship IDs
+    Returns:
+        (dict) summaries - Summaries by relationship ID
+    """
+
+    summaries = {}
+    try:
+        columns, rows = db.fetch_all(RELATIONSHIP_SUMMARY_SQL +
+                                     'WHERE r.relationship_id = ANY(%s)',
+                                     ([int(id_value) for id_value in relationship_ids],))
+        for values in rows:
+            summaries[values[0]] = summary_from_row(values)
+    except (Exception, psycopg2.DatabaseError) as error:
+        # Inside a transaction the error rolls back the whole block
+        if storage.in_transaction():
+            raise
+        print(error)
+
+    return summaries
+
+
+def get_page_relationship_summaries(page_number):
+    """
+    Gets summaries of relationships that have a partner on a page
+
+    Args:
+        (integer) page_number - Page number
+    Returns:
+        (list) summaries - Summaries ordered by relationship ID
+    """
+
+    summaries = []
+    try:
+        columns, rows = db.fetch_all(RELATIONSHIP_SUMMARY_SQL +
+                                     'WHERE p1.page_number = %s OR p2.page_number = %s '
+                                     'ORDER BY r.relationship_id',
+                                     (page_number, page_number))
+        summaries = [summary_from_row(values) for values in rows]
+    except (Exception, psycopg2.DatabaseError) as error:
+        # Inside a transaction the error rolls back the whole block
+        if storage.in_transaction():
+            raise
+        print(error)
+
+    return summaries
+
+
+def get_cached_relationship_summary(relationship_id):
+    """
+    Builds a relationship summary from cached rows
 
     Args:
         (integer) relationship_id - Relationship ID
+    Returns:
+        (dict/none) summary - Summary or None if rows are not cached
     """
 
-    print('\nRelationship:')
+    cached_row = cache.relationships.get(relationship_id)
+    if cached_row is None:
+        return None
+    relationship = dict(zip(*cached_row))
+
+    summary = {'relationship_id': relationship_id,
+               'marriage_date': relationship.get('marriage_date'),
+               'divorce_date': relationship.get('divorce_date'),
+               'partner1': None, 'partner2': None}
+
+    for partner in ('partner1', 'partner2'):
+        person_id = relationship.get('person_id_' + partner)
+        if person_id:
+            cached_row = cache.persons.get(person_id)
+            if cached_row is None:
+                return None
+            summary[partner] = dict(zip(*cached_row))
+
+    return summary
+
+
+def get_relationship_summary(relationship_id):
+    """
+    Gets relationship and partner data for printing
+
+    Cached rows are used when available, otherwise the data is read with
+    one query (or row by row from the journal in write-behind mode and from
+    a local SQLite file).
+
+    Args:
+        (integer) relationship_id - Relationship ID
+    Returns:
+        (dict) summary - Relationship ID, dates and partner data
+    """
 
-    # Read relationship data
+    summary = get_cached_relationship_summary(relationship_id)
+    if summary is not None:
+        return summary
+
+    if storage.is_remote() and not db.write_behind_active():
+        summary = get_relationship_summaries([relationship_id]).get(int(relationship_id))
+        if summary is not None:
+            return summary
+
+    # Rows not yet saved from the journal and local rows are read one by one
     relationship_columns, relationship_data = get_relationship(relationship_id)
+    relationship = dict(zip(relationship_columns or [], relationship_data or []))
+
+    summary = {'relationship_id': relationship_id,
+               'marriage_date': relationship.get('marriage_date'),
+               'divorce_date': relationship.get('divorce_date'),
+               'partner1': None, 'partner2': None}
 
-    person_id_partner1 = relationship_data[1]
-    person_id_partner2 = relationship_data[2]
-    marriage_date = relationship_data[3]
-    divorce_date = relationship_data[5]
+    for partner in ('partner1', 'partner2'):
+        person_id = relationship.get('person_id_' + partner)
+        if person_id:
+            person_columns, person_data = get_person(person_id)
+            summary[partner] = dict(zip(person_columns or [], person_data or []))
 
-    # Acquire and process person data
-    partner1_print = None
-    if person_id_partner1:
-        partner1_print = print_person(person_id_partner1)
-        print('- Partner 1: {}'.format(partner1_print))
+    return summary
+
+
+def print_relationship_summary(summary):
+    """
+    Prints relationship summary data
+
+    Args:
+        (dict) summary - Relationship summary
+    """
+
+    # Process person data
+    if summary['partner1']:
+        print('- Partner 1: {}'.format(format_person(summary['partner1'])))
     else:
         print('- Partner 1: [NK]')
 
-    partner2_print = None
-    if person_id_partner2:
-        partner2_print = print_person(person_id_partner2)
-        print('- Partner 2: {}'.format(partner2_print))
+    if summary['partner2']:
+        print('- Partner 2: {}'.format(format_person(summary['partner2'])))
     else:
         print('- Partner 2: [NK]')
 
     # Process marriage dates
-    if marriage_date:
-        if marriage_date[4:] == '-XX-XX': # month and day missing
-            marriage_date = marriage_date[0:4]
-        elif marriage_date[7:] == '-XX': # only day missing
-            marriage_date = marriage_date[0:7]
-    if divorce_date:
-        if divorce_date[4:] == '-XX-XX': # month and day missing
-            divorce_date = divorce_date[0:4]
-        elif divorce_date[7:] == '-XX': # only day missing
-            divorce_date = divorce_date[0:7]
+    marriage_date = shorten_date(summary['marriage_date'])
+    divorce_date = shorten_date(summary['divorce_date'])
 
     if marriage_date and divorce_date:
         print('- Marriage: m. {} div. {}'.format(marriage_date, divorce_date))
     elif marriage_date and not divorce_date:
         print('- Marriage: m. {}'.format(marriage_date))
     elif not marriage_date and divorce_date:
-        print('- Marriagew: div. {}'.format(divorce_date))
+        print('- Marriage: div. {}'.format(divorce_date))
+
+
+def print_relationship(relationship_id):
+    """
+    Prepares a relationship data print
+
+    Args:
+        (integer) relationship_id - Relationship ID
+    """
+
+    print('\nRelationship:')
+
+    print_relationship_summary(get_relationship_summary(relationship_id))
+
+
+def list_relationships_command(args):
+    """
+    Prints summaries of relationships on a page
+
+    Args:
+        (Namespace) args - Command line arguments
+    """
+
+    summaries = get_page_relationship_summaries(args.page_number)
+    for summary in summaries:
+        print('\nRelationship {}:'.format(summary['relationship_id']))
+        print_relationship_summary(summary)
+
+    print('\n{} relationships on page {}.'.format(len(summaries), args.page_number))
+
+
+def parse_arguments(argv=None):
+    """
+    Parses command line arguments
+
+    Args:
+        (list) argv - Arguments (defaults to sys.argv)
+    Returns:
+        (Namespace) args - Parsed arguments
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Data extraction tool for family history book. '
+                    'Without a command, data is added interactively.')
+    parser.add_argument('--journal', metavar='FILE',
+                        help='write entries to a local journal file first and save them '
+                             'to the database in the background')
+    parser.add_argument('--profile', action='store_true',
+                        help='time database round trips and print a summary at the end')
+    parser.add_argument('--profile-output', metavar='FILE',
+                        help='with --profile, write the summary as JSON to FILE')
+    parser.add_argument('--slow-ms', type=float, default=100,
+                        help='with --profile, log statements slower than this '
+                             '(milliseconds, default 100)')
+    parser.add_argument('--record', metavar='FILE',
+                        help='record answers to a transcript file for replaying')
+    parser.add_argument('--replay', metavar='FILE', action='append',
+                        help='read answers from a recorded transcript file instead of '
+                             'typing them (can be repeated)')
+    parser.add_argument('--echo', action='store_true',
+                        help='with --replay, print saved rows')
+    parser.add_argument('--suggest', action='store_true',
+                        help='show saved persons with similar names when adding a person')
+    parser.add_argument('--local', metavar='FILE',
+                        help='save entries to a local SQLite file (push them to the '
+                             'database later with the sync command)')
+    subparsers = parser.add_subparsers(dest='command')
+
+    import_parser = subparsers.add_parser(
+        'import', help='import persons, relationships and children from CSV/JSON files')
+    import_parser.add_argument('--persons', help='persons file')
+    import_parser.add_argument('--relationships', help='relationships file')
+    import_parser.add_argument('--children', help='children file')
+    import_parser.add_argument('--batch-size', type=int, default=1000,
+                               help='rows in one INSERT statement (default 1000)')
+
+    ingest_parser = subparsers.add_parser(
+        'ingest', help='save a directory of page files in parallel worker processes')
+    ingest_parser.add_argument('directory', help='directory of page files')
+    ingest_parser.add_argument('--workers', type=int,
+                               help='worker processes (default: number of CPUs)')
+    ingest_parser.add_argument('--batch-size', type=int, default=1000,
+                               help='rows in one INSERT statement (default 1000)')
+    ingest_parser.add_argument('--report', metavar='FILE',
+                               help='write a JSON report of each file')
+
+    relationships_parser = subparsers.add_parser(
+        'relationships', help='list relationships with a partner on a page')
+    relationships_parser.add_argument('page_number', type=int, help='page number')
+
+    dedupe_parser = subparsers.add_parser(
+        'dedupe', help='find candidate duplicate persons')
+    dedupe_parser.add_argument('--output', metavar='FILE',
+                               help='CSV file for candidate pairs (default: print)')
+    dedupe_parser.add_argument('--threshold', type=float, default=0.8,
+                               help='minimum similarity score from 0 to 1 (default 0.8)')
+
+    for command, description in (('descendants', 'list descendants of a person'),
+                                 ('ancestors', 'list ancestors of a person')):
+        traversal_parser = subparsers.add_parser(command, help=description)
+        traversal_parser.add_argument('person_id', type=int, help='person ID')
+        traversal_parser.add_argument('--generations', type=int,
+                                      help='how many generations (default all)')
+        traversal_parser.add_argument('--graph', action='store_true',
+                                      help='load the whole family graph into memory '
+                                           'and traverse it there')
+
+    gedcom_parser = subparsers.add_parser(
+        'import-gedcom', help='import individuals and families from a GEDCOM file')
+    gedcom_parser.add_argument('gedcom_file', help='GEDCOM file')
+    gedcom_parser.add_argument('--page-number', type=int,
+                               help='page number for persons without a source page '
+                                    '(required if any person lacks one)')
+    gedcom_parser.add_argument('--batch-size', type=int, default=1000,
+                               help='rows in one INSERT statement (default 1000)')
+
+    export_parser = subparsers.add_parser('export', help='export the database to a file')
+    export_parser.add_argument('format', choices=['gedcom'], help='file format')
+    export_parser.add_argument('--output', required=True, metavar='FILE', help='output file')
+    export_parser.add_argument('--source-title', default='Family book',
+                               help='title of the family book source record')
+
+    subparsers.add_parser('init-db', help='create the database tables and indexes')
+    migrate_parser = subparsers.add_parser(
+        'migrate', help='upgrade the database schema to the latest version')
+    migrate_parser.add_argument('--status', action='store_true',
+                                help='show the schema version and pending migrations')
+    migrate_parser.add_argument('--version', type=int,
+                                help='upgrade only up to this version')
+
+    sync_parser = subparsers.add_parser(
+        'sync', help='push entries of a local SQLite file to the database')
+    sync_parser.add_argument('local_file', help='SQLite file')
+    sync_parser.add_argument('--batch-size', type=int, default=1000,
+                             help='rows in one INSERT statement (default 1000)')
+
+    journal_parser = subparsers.add_parser(
+        'save-journal', help='save entries left in a journal file to the database')
+    journal_parser.add_argument('journal_file', help='journal file')
+
+    link_parser = subparsers.add_parser(
+        'link-pages', help='link persons continuing on other pages (page_from/page_to)')
+    link_parser.add_argument('--apply', action='store_true',
+                             help='save the links found (default is to only report them)')
+    link_parser.add_argument('--output', help='CSV file for the results (default stdout)')
+
+    snapshot_parser = subparsers.add_parser(
+        'snapshot', help='save the tables as columnar files for offline analysis')
+    snapshot_parser.add_argument('directory', help='output directory')
+    snapshot_parser.add_argument('--format', choices=['arrow', 'numpy'], default='arrow',
+                                 help='Arrow IPC files (needs pyarrow) or .npy files '
+                                      '(needs numpy), default arrow')
+
+    search_parser = subparsers.add_parser('search', help='find persons by name')
+    search_parser.add_argument('query', nargs='+',
+                               help='names or their beginnings (a birth year may be included)')
+    search_parser.add_argument('--year', type=int, help='birth year (within two years)')
+    search_parser.add_argument('--limit', type=int, default=10,
+                               help='most matches shown (default 10)')
+
+    pages_parser = subparsers.add_parser(
+        'pages', help='show persons and page links of each page and which pages are done')
+    pages_parser.add_argument('--missing', action='store_true',
+                              help='only pages referred to by page links but not entered')
+    pages_parser.add_argument('--done', type=int, nargs='+', metavar='PAGE',
+                              help='mark pages done')
+    pages_parser.add_argument('--reopen', type=int, nargs='+', metavar='PAGE',
+                              help='mark pages not done')
+
+    daemon_parser = subparsers.add_parser(
+        'daemon', help='serve entry sessions of client.py over a Unix socket')
+    daemon_parser.add_argument('--socket',
+                               help='socket path (default $GENEALOGY_SOCKET or '
+                                    '$XDG_RUNTIME_DIR/genealogy.sock)')
+
+    return parser.parse_args(argv)
+
+
+def run_command(args):
+    """
+    Runs a non-interactive command
+
+    Args:
+        (Namespace) args - Command line arguments
+    """
+
+    if args.command == 'import':
+        from bulk_import import import_command
+        import_command(args)
+
+    elif args.command == 'ingest':
+        from ingest import ingest_command
+        ingest_command(args)
+
+    elif args.command == 'relationships':
+        list_relationships_command(args)
+
+    elif args.command == 'dedupe':
+        from dedupe import dedupe_command
+        dedupe_command(args)
+
+    elif args.command in ('descendants', 'ancestors'):
+        from traversal import traversal_command
+        traversal_command(args)
+
+    elif args.command == 'import-gedcom':
+        from gedcom import import_command as import_gedcom_command
+        import_gedcom_command(args)
+
+    elif args.command == 'export':
+        from gedcom import export_command
+        export_command(args)
+
+    elif args.command in ('init-db', 'migrate'):
+        from schema import migrate_command
+        migrate_command(args)
+
+    elif args.command == 'sync':
+        storage.sync_command(args)
+
+    elif args.command == 'save-journal':
+        journal.close_journal(journal.open_journal(args.journal_file, require_ids=False))
+
+    elif args.command == 'link-pages':
+        from page_links import link_pages_command
+        link_pages_command(args)
+
+    elif args.command == 'snapshot':
+        from snapshot import snapshot_command
+        snapshot_command(args)
+
+    elif args.command == 'search':
+        search.search_command(args)
+
+    elif args.command == 'pages':
+        from pages import pages_command
+        pages_command(args)
+
+    elif args.command == 'daemon':
+        from daemon import daemon_command
+        daemon_command(args)
 
 
 def main():
     """ Main function """
 
+    args = parse_arguments()
+    if not args.profile:
+        run_session(args)
+        return
+
+    import instrumentation
+    instrumentation.enable(args.slow_ms)
+    try:
+        run_session(args)
+    finally:
+        instrumentation.report(args.profile_output or '-')
+
+
+def run_session(args):
+    """
+    Runs a command or adds data interactively
+
+    Args:
+        (Namespace) args - Command line arguments
+    """
+
+    if args.command is not None:
+        run_command(args)
+        return
+
+    if args.journal and args.local:
+        print('ERROR: Use either --journal or --local.')
+        return
+
+    if args.local:
+        # Entries are saved to the SQLite file until synced
+        storage.set_storage(storage.SqliteStorage(args.local))
+        try:
+            interactive_session(args)
+        finally:
+            storage.get_storage().close()
+            storage.set_storage(None)
+    elif args.journal:
+        # Entries are saved to the database by a background writer
+        try:
+            active_journal = journal.open_journal(args.journal)
+        except RuntimeError as error:
+            print('ERROR: Journal mode cannot start: {}.'.format(error))
+            return
+        try:
+            interactive_session(args)
+        finally:
+            journal.close_journal(active_journal)
+    else:
+        interactive_session(args)
+
+
+def interactive_session(args):
+    """
+    Adds data interactively or from replayed transcripts
+
+    Args:
+        (Namespace) args - Command line arguments
+    """
+
+    import replay
+
+    if args.suggest:
+        print('Name index of {} persons loaded.'.format(len(search.get_index())))
+    set_suggest(args.suggest)
+
+    stop_recording = None
+    try:
+        if args.record:
+            stop_recording = replay.record(args.record)
+        if args.replay:
+            sessions = replay.replay(args.replay, add_interactively, args.echo)
+            print('\nReplayed {} sessions.'.format(sessions))
+        else:
+            add_interactively()
+    finally:
+        set_suggest(False)
+        if stop_recording is not None:
+            stop_recording()
+
+
+def add_interactively():
+    """ Adds persons, relationships or children interactively """
+
     add_type = input('Add (p)person, (r)elationship or (c)hild? ').lower()
 
     # Add a person or a whole family line
@@ -875,12 +1549,23 @@ def main():
                 if page_number_new is not None:
                     page_number = page_number_new
 
-            person_id = add_person(page_number)
-
-            input_family = input('Add family for {} (Y/n)? '.format(
-                print_person(person_id))).lower()
-            if input_family.lower() not in ('n', 'no'):
-                add_family(person_id, page_number)
+            # Person and family line are saved in one transaction
+            try:
+                with storage.transaction():
+                    person_id = add_person(page_number)
+
+                    input_family = input('Add family for {} (Y/n)? '.format(
+                        print_person(person_id))).lower()
+                    if input_family.lower() not in ('n', 'no'):
+                        add_family(person_id, page_number)
+            except KeyboardInterrupt:
+                print('\nCancelled, the family line was not saved.')
+                return
+            except EOFError:
+                # Input ended (e.g. at the end of a replayed transcript)
+                raise
+            except (Exception, psycopg2.DatabaseError) as error:
+                print('ERROR: {}'.format(error))
 
             input_more_persons = input('Add more persons (Y/n)? ').lower()
             if input_more_persons in ('n', 'no'):
@@ -891,11 +1576,14 @@ def main():
         add_more_relationships = True
         while add_more_relationships:
             person_id_head = input_integer('Provide ID for partner 1: ')
+            # Partners are printed for review after the relationship prompts
+            prefetch.persons([person_id_head])
 
             spouse_known = input('Is the spouse known (Y/n)? ').lower()
             person_id_spouse = None
             if spouse_known not in ('n', 'no'):
                 person_id_spouse = input_integer('Provide ID for partner 2: ')
+                prefetch.persons([person_id_spouse])
 
             add_relationship(person_id_head, person_id_spouse)
 
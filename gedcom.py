@@ -0,0 +1,660 @@
+import psycopg2
+
+import db
+from bulk_import import batches, insert_batch
+
+# Rows fetched from a server-side cursor at a time
+ITER_SIZE = 2000
+
+# Rows sent to the database in one multi-row INSERT when importing
+BATCH_SIZE = 1000
+
+# Maximum length of imported string columns
+DATE_LENGTH = 10
+TEXT_LENGTH = 255
+
+# Date qualifiers removed from imported dates (kept in comments)
+DATE_QUALIFIERS = ['ABT', 'CAL', 'EST', 'BEF', 'AFT', 'BET', 'FROM', 'TO', 'INT']
+
+MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+          'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+
+SEX_CODES = {'MALE': 'M', 'FEMALE': 'F'}
+
+# Persons with the IDs of relationships they are a partner (FAMS) or child (FAMC) in
+EXPORT_PERSONS_SQL = """
+SELECT p.person_id, p.page_number, p.first_names, p.last_name, p.gender,
+       p.birth_date, p.birth_place, p.death_date, p.death_place, p.deceased,
+       p.page_from, p.page_to, p.comments, fams.ids, famc.ids
+FROM persons p
+LEFT JOIN (SELECT person_id, array_agg(relationship_id ORDER BY relationship_id) AS ids
+           FROM (SELECT person_id_partner1 AS person_id, relationship_id FROM relationships
+                 UNION ALL
+                 SELECT person_id_partner2, relationship_id FROM relationships) AS partners
+           WHERE person_id IS NOT NULL
+           GROUP BY person_id) AS fams ON fams.person_id = p.person_id
+LEFT JOIN (SELECT person_id, array_agg(relationship_id ORDER BY relationship_id) AS ids
+           FROM children
+           GROUP BY person_id) AS famc ON famc.person_id = p.person_id
+ORDER BY p.person_id
+"""
+
+# Relationships with partner genders and child IDs
+EXPORT_RELATIONSHIPS_SQL = """
+SELECT r.relationship_id, r.person_id_partner1, p1.gender, r.person_id_partner2, p2.gender,
+       r.marriage_date, r.marriage_place, r.divorce_date, r.divorce_place, r.comments,
+       ch.ids
+FROM relationships r
+LEFT JOIN persons p1 ON p1.person_id = r.person_id_partner1
+LEFT JOIN persons p2 ON p2.person_id = r.person_id_partner2
+LEFT JOIN (SELECT relationship_id, array_agg(person_id ORDER BY child_id) AS ids
+           FROM children
+           GROUP BY relationship_id) AS ch ON ch.relationship_id = r.relationship_id
+ORDER BY r.relationship_id
+"""
+
+
+def gedcom_date(date):
+    """
+    Converts a YYYY-MM-DD date with XX for unknown parts to a GEDCOM date
+
+    Args:
+        (string) date - Date (e.g. 1850-04-03, 1850-04-XX or 1850-XX-XX)
+    Returns:
+        (string) date - GEDCOM date (e.g. 3 APR 1850, APR 1850 or 1850), or a
+                        date phrase in parentheses if the date is not valid
+    """
+
+    if not date:
+        return None
+
+    parts = date.split('-')
+    try:
+        year = int(parts[0])
+        month = None
+        day = None
+        if len(parts) > 1 and 'X' not in parts[1].upper():
+            month = int(parts[1])
+            if len(parts) > 2 and 'X' not in parts[2].upper():
+                day = int(parts[2])
+        if len(parts) > 3 or not 1 <= (month or 1) <= 12 or not 1 <= (day or 1) <= 31:
+            raise ValueError(date)
+    except ValueError:
+        return '({})'.format(date)
+
+    if day is not None:
+        return '{} {} {}'.format(day, MONTHS[month - 1], year)
+    if month is not None:
+        return '{} {}'.format(MONTHS[month - 1], year)
+    return str(year)
+
+
+def gedcom_lines(level, tag, value=None):
+    """
+    Formats a GEDCOM line, splitting multi-line values with CONT
+
+    Args:
+        (integer) level - Line level
+        (string) tag - Tag (or xref and tag for records)
+        (any) value - Line value
+    Returns:
+        (string) lines - Formatted lines ending with a newline
+    """
+
+    if value is None or value == '':
+        return '{} {}\n'.format(level, tag)
+
+    value_lines = str(value).splitlines() or ['']
+    lines = '{} {} {}\n'.format(level, tag, value_lines[0])
+    for value_line in value_lines[1:]:
+        lines += '{} CONT {}\n'.format(level + 1, value_line)
+    return lines
+
+
+def event_lines(tag, date, place, occurred=False):
+    """
+    Formats an event (birth, death, marriage or divorce) with date and place
+
+    Args:
+        (string) tag - Event tag
+        (string) date - Event date
+        (string) place - Event place
+        (boolean) occurred - Write the event as known even without details
+    Returns:
+        (string) lines - Formatted lines (empty if nothing known)
+    """
+
+    if not date and not place:
+        if occurred:
+            return gedcom_lines(1, tag, 'Y')
+        return ''
+
+    lines = gedcom_lines(1, tag)
+    if date:
+        lines += gedcom_lines(2, 'DATE', gedcom_date(date))
+    if place:
+        lines += gedcom_lines(2, 'PLAC', place)
+    return lines
+
+
+def individual_record(values, source_xref):
+    """
+    Formats an INDI record from an EXPORT_PERSONS_SQL row
+
+    Args:
+        (tuple) values - Person row
+        (string) source_xref - Xref of the family book source record
+    Returns:
+        (string) record - GEDCOM lines
+    """
+
+    (person_id, page_number, first_names, last_name, gender, birth_date, birth_place,
+     death_date, death_place, deceased, page_from, page_to, comments,
+     fams_ids, famc_ids) = values
+
+    record = gedcom_lines(0, '@I{}@ INDI'.format(person_id))
+    record += gedcom_lines(1, 'NAME', '{} /{}/'.format(first_names or '', last_name or '').strip())
+    if first_names:
+        record += gedcom_lines(2, 'GIVN', first_names)
+    if last_name:
+        record += gedcom_lines(2, 'SURN', last_name)
+    record += gedcom_lines(1, 'SEX', SEX_CODES.get(gender, 'U'))
+    record += event_lines('BIRT', birth_date, birth_place)
+    record += event_lines('DEAT', death_date, death_place, bool(deceased))
+    for relationship_id in fams_ids or []:
+        record += gedcom_lines(1, 'FAMS', '@F{}@'.format(relationship_id))
+    for relationship_id in famc_ids or []:
+        record += gedcom_lines(1, 'FAMC', '@F{}@'.format(relationship_id))
+    if comments:
+        record += gedcom_lines(1, 'NOTE', comments)
+    record += gedcom_lines(1, 'SOUR', source_xref)
+    record += gedcom_lines(2, 'PAGE', page_number)
+    if page_from is not None:
+        record += gedcom_lines(1, '_PAGE_FROM', page_from)
+    if page_to is not None:
+        record += gedcom_lines(1, '_PAGE_TO', page_to)
+
+    return record
+
+
+def family_record(values):
+    """
+    Formats a FAM record from an EXPORT_RELATIONSHIPS_SQL row
+
+    Args:
+        (tuple) values - Relationship row
+    Returns:
+        (string) record - GEDCOM lines
+    """
+
+    (relationship_id, partner1_id, partner1_gender, partner2_id, partner2_gender,
+     marriage_date, marriage_place, divorce_date, divorce_place, comments,
+     child_ids) = values
+
+    # Partner 1 is the husband unless the genders tell otherwise (same
+    # gender partners are kept in the stored order)
+    if partner1_gender != partner2_gender and (partner1_gender == 'FEMALE' or
+                                               partner2_gender == 'MALE'):
+        partner1_id, partner2_id = partner2_id, partner1_id
+
+    record = gedcom_lines(0, '@F{}@ FAM'.format(relationship_id))
+    if partner1_id is not None:
+        record += gedcom_lines(1, 'HUSB', '@I{}@'.format(partner1_id))
+    if partner2_id is not None:
+        record += gedcom_lines(1, 'WIFE', '@I{}@'.format(partner2_id))
+    record += event_lines('MARR', marriage_date, marriage_place)
+    record += event_lines('DIV', divorce_date, divorce_place)
+    for person_id in child_ids or []:
+        record += gedcom_lines(1, 'CHIL', '@I{}@'.format(person_id))
+    if comments:
+        record += gedcom_lines(1, 'NOTE', comments)
+
+    return record
+
+
+def stream_rows(conn, name, query):
+    """
+    Streams rows from a named server-side cursor
+
+    Args:
+        (connection) conn - Database connection
+        (string) name - Cursor name
+        (string) query - SQL query
+    Yields:
+        (tuple) values - Row
+    """
+
+    with conn.cursor(name=name) as cur:
+        cur.itersize = ITER_SIZE
+        cur.execute(query)
+        for values in cur:
+            yield values
+
+
+def export_gedcom(output_file, source_title='Family book'):
+    """
+    Writes the whole database as GEDCOM without loading tables in memory
+
+    Args:
+        (file) output_file - Text file opened for writing
+        (string) source_title - Title of the family book source record
+    Returns:
+        (dict) record_counts - How many INDI and FAM records written
+    """
+
+    source_xref = '@S1@'
+    record_counts = {'persons': 0, 'relationships': 0}
+
+    output_file.write(gedcom_lines(0, 'HEAD'))
+    output_file.write(gedcom_lines(1, 'SOUR', 'GENEALOGY_EXTRACTION_TOOL'))
+    output_file.write(gedcom_lines(1, 'GEDC'))
+    output_file.write(gedcom_lines(2, 'VERS', '5.5.1'))
+    output_file.write(gedcom_lines(2, 'FORM', 'LINEAGE-LINKED'))
+    output_file.write(gedcom_lines(1, 'CHAR', 'UTF-8'))
+    output_file.write(gedcom_lines(0, '{} SOUR'.format(source_xref)))
+    output_file.write(gedcom_lines(1, 'TITL', source_title))
+
+    with db.connection() as conn:
+        for values in stream_rows(conn, 'export_persons', EXPORT_PERSONS_SQL):
+            output_file.write(individual_record(values, source_xref))
+            record_counts['persons'] += 1
+
+        for values in stream_rows(conn, 'export_relationships', EXPORT_RELATIONSHIPS_SQL):
+            output_file.write(family_record(values))
+            record_counts['relationships'] += 1
+
+    output_file.write(gedcom_lines(0, 'TRLR'))
+
+    return record_counts
+
+
+def parse_line(line):
+    """
+    Splits a GEDCOM line into level, xref, tag and value
+
+    Args:
+        (string) line - GEDCOM line
+    Returns:
+        (int) level - Line level
+        (string) xref - Record xref (None if not given)
+        (string) tag - Tag
+        (string) value - Value (empty if not given)
+    """
+
+    parts = line.split(' ', 2)
+    level = int(parts[0])
+    xref = None
+    if len(parts) > 1 and parts[1].startswith('@'):
+        xref = parts[1]
+        parts = [parts[0]] + (parts[2].split(' ', 1) if len(parts) > 2 else [''])
+
+    tag = parts[1].upper() if len(parts) > 1 else ''
+    value = parts[2] if len(parts) > 2 else ''
+
+    return level, xref, tag, value
+
+
+def parse_records(lines):
+    """
+    Groups GEDCOM lines into top-level records one record at a time
+
+    CONT and CONC lines are joined to the value of their parent line.
+
+    Args:
+        (iterable) lines - GEDCOM lines
+    Yields:
+        (dict) record - Node with xref, tag, value and child nodes
+    """
+
+    record = None
+    stack = []
+    for line in lines:
+        line = line.strip().lstrip('\ufeff')
+        if not line:
+            continue
+        try:
+            level, xref, tag, value = parse_line(line)
+        except ValueError:
+            continue # Not a GEDCOM line
+
+        node = {'xref': xref, 'tag': tag, 'value': value, 'children': []}
+
+        if level == 0:
+            if record is not None:
+                yield record
+            record = node
+            stack = [node]
+            continue
+
+        if record is None or level > len(stack):
+            continue # Line without a parent
+
+        parent = stack[level - 1]
+        if tag == 'CONT':
+            parent['value'] += '\n' + value
+        elif tag == 'CONC':
+            parent['value'] += value
+        else:
+            parent['children'].append(node)
+            del stack[level:]
+            stack.append(node)
+
+    if record is not None:
+        yield record
+
+
+def read_gedcom(filename):
+    """
+    Streams top-level records from a GEDCOM file
+
+    Args:
+        (string) filename - GEDCOM file name
+    Yields:
+        (dict) record - Record node
+    """
+
+    with open(filename, encoding='utf-8', errors='replace') as input_file:
+        for record in parse_records(input_file):
+            yield record
+
+
+def find_value(node, *tags):
+    """
+    Finds the value of the first child node along a path of tags
+
+    Args:
+        (dict) node - Node
+        (string) tags - Tags from child to grandchild
+    Returns:
+        (string/none) value - Value or None if not found
+    """
+
+    for tag in tags:
+        for child in node['children']:
+            if child['tag'] == tag:
+                node = child
+                break
+        else:
+            return None
+    return node['value']
+
+
+def parse_gedcom_date(date):
+    """
+    Converts a GEDCOM date to a YYYY-MM-DD date with XX for unknown parts
+
+    Qualified dates (e.g. ABT 1850, BET 1850 AND 1852) are converted by
+    their first date.
+
+    Args:
+        (string) date - GEDCOM date (e.g. 3 APR 1850, APR 1850 or 1850)
+    Returns:
+        (string/none) date - Converted date (None if not a date)
+        (boolean) qualified - True if a qualifier was removed
+    """
+
+    if not date or date.startswith('('):
+        return None, False
+
+    words = date.upper().replace('.', ' ').split()
+    qualified = False
+    if words and words[0] in DATE_QUALIFIERS:
+        qualified = True
+        words = words[1:]
+    if 'AND' in words:
+        words = words[:words.index('AND')]
+    if 'TO' in words:
+        words = words[:words.index('TO')]
+
+    try:
+        year = int(words[-1].split('/')[0])
+        month = 'XX'
+        day = 'XX'
+        if len(words) > 1:
+            month = '{:02d}'.format(MONTHS.index(words[-2]) + 1)
+        if len(words) > 2:
+            day = '{:02d}'.format(int(words[-3]))
+    except (ValueError, IndexError):
+        return None, False
+
+    return '{:04d}-{}-{}'.format(year, month, day), qualified
+
+
+def split_name(name):
+    """
+    Splits a GEDCOM name (Given /Surname/) into first names and last name
+
+    Args:
+        (string) name - GEDCOM name
+    Returns:
+        (string) first_names - First names
+        (string) last_name - Last name
+    """
+
+    if not name:
+        return None, None
+
+    if '/' in name:
+        first_names, last_name = name.split('/', 1)
+        last_name = last_name.split('/', 1)[0]
+    else:
+        first_names, last_name = name, ''
+
+    return first_names.strip() or None, last_name.strip() or None
+
+
+def parse_integer(value):
+    """
+    Converts a value to an integer if possible
+
+    Args:
+        (string) value - Value
+    Returns:
+        (integer/none) value - Integer or None
+    """
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def truncate(value, length):
+    """
+    Shortens a string to the column length
+
+    Args:
+        (string) value - Value
+        (integer) length - Maximum length
+    Returns:
+        (string/none) value - Shortened value
+    """
+
+    if value:
+        return value[:length]
+    return None
+
+
+def person_from_record(record, page_number):
+    """
+    Converts an INDI record to persons column values
+
+    Args:
+        (dict) record - INDI record
+        (integer) page_number - Page number for persons without a source page
+                                (None to reject them)
+    Returns:
+        (list) column_names - Names of columns
+        (list) column_values - Values of columns
+    """
+
+    first_names, last_name = split_name(find_value(record, 'NAME'))
+    first_names = find_value(record, 'NAME', 'GIVN') or first_names
+    last_name = find_value(record, 'NAME', 'SURN') or last_name
+
+    gender = {'M': 'MALE', 'F': 'FEMALE'}.get((find_value(record, 'SEX') or '').upper())
+
+    comments = []
+    dates = {}
+    for tag, column_name in (('BIRT', 'birth_date'), ('DEAT', 'death_date')):
+        original = find_value(record, tag, 'DATE')
+        dates[column_name], qualified = parse_gedcom_date(original)
+        if qualified or (original and dates[column_name] is None):
+            comments.append('{}: {}'.format(tag, original))
+
+    deceased = None
+    death = [child for child in record['children'] if child['tag'] == 'DEAT']
+    if death:
+        deceased = True
+
+    note = find_value(record, 'NOTE')
+    if note and not note.startswith('@'):
+        comments.append(note)
+
+    source_page = parse_integer(find_value(record, 'SOUR', 'PAGE'))
+    if source_page is not None:
+        page_number = source_page
+    elif page_number is None:
+        raise ValueError('Individual {} has no source page, provide --page-number'.format(
+            record['xref']))
+
+    column_names = ['page_number', 'first_names', 'last_name', 'gender', 'birth_date',
+                    'birth_place', 'death_date', 'death_place', 'deceased',
+                    'page_from', 'page_to', 'comments']
+    column_values = [page_number, truncate(first_names, 100), truncate(last_name, 100),
+                     gender, truncate(dates['birth_date'], DATE_LENGTH),
+                     truncate(find_value(record, 'BIRT', 'PLAC'), TEXT_LENGTH),
+                     truncate(dates['death_date'], DATE_LENGTH),
+                     truncate(find_value(record, 'DEAT', 'PLAC'), TEXT_LENGTH), deceased,
+                     parse_integer(find_value(record, '_PAGE_FROM')),
+                     parse_integer(find_value(record, '_PAGE_TO')),
+                     truncate('; '.join(comments), TEXT_LENGTH)]
+
+    return column_names, column_values
+
+
+def relationship_from_record(record, person_ids):
+    """
+    Converts a FAM record to relationships column values and child IDs
+
+    Args:
+        (dict) record - FAM record
+        (dict) person_ids - Person IDs by INDI xref
+    Returns:
+        (list) column_names - Names of columns
+        (list) column_values - Values of columns
+        (list) child_ids - Person IDs of children
+    """
+
+    comments = []
+    dates = {}
+    for tag, column_name in (('MARR', 'marriage_date'), ('DIV', 'divorce_date')):
+        original = find_value(record, tag, 'DATE')
+        dates[column_name], qualified = parse_gedcom_date(original)
+        if qualified or (original and dates[column_name] is None):
+            comments.append('{}: {}'.format(tag, original))
+
+    note = find_value(record, 'NOTE')
+    if note and not note.startswith('@'):
+        comments.append(note)
+
+    column_names = ['person_id_partner1', 'person_id_partner2', 'marriage_date',
+                    'marriage_place', 'divorce_date', 'divorce_place', 'comments']
+    column_values = [person_ids.get(find_value(record, 'HUSB')),
+                     person_ids.get(find_value(record, 'WIFE')),
+                     dates['marriage_date'],
+                     truncate(find_value(record, 'MARR', 'PLAC'), TEXT_LENGTH),
+                     dates['divorce_date'],
+                     truncate(find_value(record, 'DIV', 'PLAC'), TEXT_LENGTH),
+                     truncate('; '.join(comments), TEXT_LENGTH)]
+
+    child_ids = [person_ids[child['value']] for child in record['children']
+                 if child['tag'] == 'CHIL' and child['value'] in person_ids]
+
+    return column_names, column_values, child_ids
+
+
+def import_gedcom(filename, page_number=None, batch_size=BATCH_SIZE):
+    """
+    Imports INDI and FAM records of a GEDCOM file in one transaction
+
+    The file is read twice, individuals first, so that only the map from
+    xrefs to person IDs is kept in memory.
+
+    Args:
+        (string) filename - GEDCOM file name
+        (integer) page_number - Page number for persons without a source page
+                                (None to reject them)
+        (integer) batch_size - Rows in one INSERT statement
+    Returns:
+        (dict) row_counts - How many rows inserted by table
+    """
+
+    row_counts = {'persons': 0, 'relationships': 0, 'children': 0}
+    person_ids = {}
+
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            individuals = (record for record in read_gedcom(filename)
+                           if record['tag'] == 'INDI' and record['xref'])
+            for batch in batches(individuals, batch_size):
+                rows = [person_from_record(record, page_number) for record in batch]
+                id_numbers = insert_batch(cur, 'persons', 'person_id', rows[0][0],
+                                          [column_values for column_names, column_values
+                                           in rows])
+                for record, id_number in zip(batch, id_numbers):
+                    person_ids[record['xref']] = id_number
+                row_counts['persons'] += len(batch)
+
+            families = (record for record in read_gedcom(filename)
+                        if record['tag'] == 'FAM')
+            for batch in batches(families, batch_size):
+                rows = [relationship_from_record(record, person_ids) for record in batch]
+                id_numbers = insert_batch(cur, 'relationships', 'relationship_id', rows[0][0],
+                                          [column_values for column_names, column_values,
+                                           child_ids in rows])
+                child_rows = [(relationship_id, person_id)
+                              for (column_names, column_values, child_ids), relationship_id
+                              in zip(rows, id_numbers) for person_id in child_ids]
+                if child_rows:
+                    insert_batch(cur, 'children', 'child_id', ['relationship_id', 'person_id'],
+                                 child_rows)
+                row_counts['relationships'] += len(batch)
+                row_counts['children'] += len(child_rows)
+
+    return row_counts
+
+
+def import_command(args):
+    """
+    Runs the import-gedcom command
+
+    Args:
+        (Namespace) args - Command line arguments
+    """
+
+    try:
+        row_counts = import_gedcom(args.gedcom_file, args.page_number, args.batch_size)
+    except (Exception, psycopg2.DatabaseError) as error:
+        print('Import failed, nothing was saved: {}'.format(error))
+    else:
+        print('Imported {} persons, {} relationships and {} children.'.format(
+            row_counts['persons'], row_counts['relationships'], row_counts['children']))
+
+
+def export_command(args):
+    """
+    Runs the export gedcom command
+
+    Args:
+        (Namespace) args - Command line arguments
+    """
+
+    try:
+        with open(args.output, 'w', encoding='utf-8', buffering=1024 * 1024) as output_file:
+            record_counts = export_gedcom(output_file, args.source_title)
+    except (Exception, psycopg2.DatabaseError) as error:
+        print('Export failed: {}'.format(error))
+    else:
+        print('Exported {} persons and {} families to {}.'.format(
+            record_counts['persons'], record_counts['relationships'], args.output))
@@ -0,0 +1,190 @@
+import threading
+
+import db
+
+# ID columns of tables with serial IDs
+ID_COLUMNS = {'persons': 'person_id', 'relationships': 'relationship_id',
+              'children': 'child_id'}
+
+# IDs reserved from a sequence in one round trip
+BLOCK_SIZE = 1000
+
+
+class IdAllocator:
+    """
+    Hands out row IDs reserved in blocks from the table sequences
+
+    Reserved IDs are never given by the database to other sessions, so rows
+    can refer to each other before they are saved and a whole family line
+    can be written in one batch. IDs left unused only leave gaps.
+    """
+
+    def __init__(self, block_size=BLOCK_SIZE):
+        """
+        Args:
+            (integer) block_size - IDs reserved at a time
+        """
+
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.reserved = {table_name: [] for table_name in ID_COLUMNS}
+
+    def fetch(self, table_name, count):
+        """
+        Reserves IDs from the sequence of a table with one query
+
+        Args:
+            (string) table_name - Table name
+            (integer) count - How many IDs
+        Returns:
+            (list) id_numbers - Reserved IDs
+        """
+
+        return db.reserve_ids(table_name, ID_COLUMNS[table_name], count)
+
+    def next_id(self, table_name, wait=True):
+        """
+        Takes the next reserved ID of a table, reserving a block if needed
+
+        Args:
+            (string) table_name - Table name
+            (boolean) wait - Reserve a block if the stock is empty
+        Returns:
+            (int) id_number - ID
+        """
+
+        return self.take(table_name, 1, wait)[0]
+
+    def take(self, table_name, count, wait=True):
+        """
+        Takes reserved IDs of a table
+
+        IDs in stock are used first, and a new block is reserved when the
+        stock runs out. Requests larger than a block reserve exactly the
+        missing IDs. Without waiting, an empty stock raises an error instead
+        of a database round trip (the stock is then refilled elsewhere).
+
+        Args:
+            (string) table_name - Table name
+            (integer) count - How many IDs
+            (boolean) wait - Reserve a block if the stock runs out
+        Returns:
+            (list) id_numbers - IDs
+        """
+
+        with self.lock:
+            reserved = self.reserved[table_name]
+            if len(reserved) < count:
+                if not wait:
+                    raise RuntimeError('No reserved IDs left for {}. More are reserved '
+                                       'when the database can be reached.'.format(table_name))
+                missing = count - len(reserved)
+                reserved.extend(self.fetch(table_name, max(missing, self.block_size)))
+            id_numbers = reserved[:count]
+            del reserved[:count]
+        return id_numbers
+
+    def refill(self, table_name, minimum=None, reserved=None):
+        """
+        Reserves a new block if fewer IDs than the minimum are in stock
+
+        The block is reserved without holding the lock, so IDs in stock can
+        be taken while waiting for the database.
+
+        Args:
+            (string) table_name - Table name
+            (integer) minimum - Low water mark (half a block by default)
+            (function) reserved - Called with the new IDs before they are
+                                  stocked (e.g. to save them)
+        """
+
+        if minimum is None:
+            minimum = self.block_size // 2
+
+        if self.available(table_name) >= minimum:
+            return
+
+        id_numbers = self.fetch(table_name, self.block_size)
+        if reserved is not None:
+            reserved(table_name, id_numbers)
+        self.add(table_name, id_numbers)
+
+    def add(self, table_name, id_numbers):
+        """
+        Puts IDs reserved earlier (e.g. saved by a journal) in stock
+
+        Args:
+            (string) table_name - Table name
+            (list) id_numbers - Reserved IDs not used yet
+        """
+
+        with self.lock:
+            self.reserved[table_name].extend(id_numbers)
+
+    def needs_refill(self, table_name, minimum=None):
+        """
+        Checks if fewer IDs than the minimum are in stock
+
+        Args:
+            (string) table_name - Table name
+            (integer) minimum - Low water mark (half a block by default)
+        Returns:
+            (boolean) low - True if the stock should be refilled
+        """
+
+        if minimum is None:
+            minimum = self.block_size // 2
+
+        return self.available(table_name) < minimum
+
+    def available(self, table_name):
+        """
+        Returns how many IDs of a table are in stock
+
+        Args:
+            (string) table_name - Table name
+        Returns:
+            (int) count - Reserved IDs not yet used
+        """
+
+        with self.lock:
+            return len(self.reserved[table_name])
+
+
+allocator = IdAllocator()
+
+
+def next_id(table_name, wait=True):
+    """ Takes the next reserved ID of a table (see IdAllocator.next_id) """
+
+    return allocator.next_id(table_name, wait)
+
+
+def take(table_name, count, wait=True):
+    """ Takes reserved IDs of a table (see IdAllocator.take) """
+
+    return allocator.take(table_name, count, wait)
+
+
+def refill(table_name, minimum=None, reserved=None):
+    """ Keeps IDs of a table in stock (see IdAllocator.refill) """
+
+    allocator.refill(table_name, minimum, reserved)
+
+
+def add(table_name, id_numbers):
+    """ Puts IDs reserved earlier in stock (see IdAllocator.add) """
+
+    allocator.add(table_name, id_numbers)
+
+
+def needs_refill(table_name, minimum=None):
+    """ Checks if the IDs of a table run low (see IdAllocator.needs_refill) """
+
+    return allocator.needs_refill(table_name, minimum)
+
+
+def available(table_name):
+    """ Returns how many IDs of a table are in stock (see IdAllocator.available) """
+
+    return allocator.available(table_name)
@@ -0,0 +1,331 @@
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+import db
+from bulk_import import (read_rows, batches, parse_integer, parse_reference,
+                         prepare_person, prepare_relationship, prepare_child, BATCH_SIZE)
+
+# File types read from an ingested directory
+PAGE_FILE_EXTENSIONS = ('.csv', '.jsonl', '.ndjson', '.json')
+
+# Row types of a page file by the value of its type column
+ROW_TYPES = {'person': 'persons', 'persons': 'persons',
+             'relationship': 'relationships', 'relationships': 'relationships',
+             'child': 'children', 'children': 'children'}
+
+# Reference columns by table and the table they refer to
+REFERENCE_COLUMNS = {'relationships': [('partner1', 'persons'), ('partner2', 'persons')],
+                     'children': [('relationship', 'relationships'), ('person', 'persons')]}
+
+
+def find_page_files(directory):
+    """
+    Lists the page files of a directory in name order
+
+    Args:
+        (string) directory - Directory
+    Returns:
+        (list) filenames - Page file names
+    """
+
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if os.path.splitext(name)[1].lower() in PAGE_FILE_EXTENSIONS
+            and os.path.isfile(os.path.join(directory, name))]
+
+
+def read_page_file(filename):
+    """
+    Reads the rows of a page file grouped by table
+
+    Args:
+        (string) filename - Page file name
+    Returns:
+        (dict) rows - (row number, row) tuples by table name
+    """
+
+    rows = {'persons': [], 'relationships': [], 'children': []}
+    for row_number, row in enumerate(read_rows(filename), 1):
+        row_type = str(row.get('type') or '').strip().lower()
+        if row_type not in ROW_TYPES:
+            raise ValueError('Row {}: unknown type {!r} (use person, relationship or '
+                             'child)'.format(row_number, row.get('type')))
+        rows[ROW_TYPES[row_type]].append((row_number, row))
+    return rows
+
+
+def prepare_rows(rows, prepare, *args):
+    """
+    Prepares rows and reports the row number of invalid rows
+
+    Args:
+        (list) rows - (row number, row) tuples
+        (function) prepare - prepare_person, prepare_relationship or prepare_child
+        (tuple) args - ID maps passed to prepare
+    Returns:
+        (list) prepared_rows - Prepared rows
+    """
+
+    prepared_rows = []
+    for row_number, row in rows:
+        try:
+            prepared_rows.append(prepare(row, *args))
+        except (ValueError, TypeError) as error:
+            raise ValueError('Row {}: {}'.format(row_number, error))
+    return prepared_rows
+
+
+def find_dangling_references(rows):
+    """
+    Lists PAGE:ROW references to rows that are not in the same file
+
+    Page files are saved independently in parallel, so a reference can only
+    be resolved within its own file (rows already saved are referred to as
+    #ID). Invalid values are left to be reported by the prepare functions.
+
+    Args:
+        (dict) rows - (row number, row) tuples by table name
+    Returns:
+        (list) dangling - Descriptions of references outside the file
+    """
+
+    keys = {'persons': set(), 'relationships': set()}
+    for table_name in keys:
+        for row_number, row in rows[table_name]:
+            try:
+                key = (parse_integer(row.get('page_number')), parse_integer(row.get('row')))
+            except (ValueError, TypeError):
+                continue
+            if None not in key:
+                keys[table_name].add(key)
+
+    dangling = []
+    for table_name, columns in REFERENCE_COLUMNS.items():
+        for row_number, row in rows[table_name]:
+            for column_name, referenced_table in columns:
+                try:
+                    reference = parse_reference(row.get(column_name),
+                                                parse_integer(row.get('page_number')))
+                except (ValueError, TypeError):
+                    continue
+                if isinstance(reference, tuple) and reference not in keys[referenced_table]:
+                    dangling.append('Row {}: {} {}:{}'.format(row_number, column_name,
+                                                              *reference))
+    return dangling
+
+
+def assign_ids(table_name, id_name, prepared_rows):
+    """
+    Reserves IDs for prepared rows with one round trip
+
+    Args:
+        (string) table_name - Table name
+        (string) id_name - Name of ID column
+        (list) prepared_rows - (key, column_names, column_values) tuples
+    Returns:
+        (dict) id_map - Reserved IDs by (page, row)
+        (list) rows - Column values with the ID first
+    """
+
+    if not prepared_rows:
+        return {}, []
+
+    id_numbers = db.reserve_ids(table_name, id_name, len(prepared_rows))
+
+    id_map = {}
+    rows = []
+    for (key, column_names, column_values), id_number in zip(prepared_rows, id_numbers):
+        if key is not None:
+            if key in id_map:
+                raise ValueError('Duplicate {} row {}:{}'.format(table_name, *key))
+            id_map[key] = id_number
+        rows.append([id_number] + list(column_values))
+    return id_map, rows
+
+
+def write_rows(cur, table_name, column_names, rows, batch_size):
+    """
+    Inserts rows with given IDs in multi-row INSERT statements
+
+    Args:
+        (cursor) cur - Database cursor
+        (string) table_name - Table name
+        (list) column_names - Names of columns
+        (list) rows - Column values for each row
+        (integer) batch_size - Rows in one INSERT statement
+    """
+
+    query = sql.SQL('INSERT INTO {} ({}) VALUES %s').format(
+        sql.Identifier(table_name), sql.SQL(', ').join(map(sql.Identifier, column_names)))
+
+    for batch in batches(rows, batch_size):
+        execute_values(cur, query.as_string(cur), batch, page_size=len(batch))
+
+
+def ingest_file(filename, batch_size=BATCH_SIZE):
+    """
+    Validates a page file and saves its rows in one transaction
+
+    Runs in a worker process with its own connection pool. IDs are reserved
+    from the sequences before writing, so rows refer to each other without
+    reading generated IDs back. A file with PAGE:ROW references to rows of
+    other files is not saved, and the references are reported as dangling.
+
+    Args:
+        (string) filename - Page file name
+        (integer) batch_size - Rows in one INSERT statement
+    Returns:
+        (dict) report - File name, saved rows by table, seconds, error and
+                        dangling references
+    """
+
+    start = time.perf_counter()
+    report = {'file': filename, 'persons': 0, 'relationships': 0, 'children': 0,
+              'error': None, 'dangling': []}
+
+    try:
+        rows = read_page_file(filename)
+
+        report['dangling'] = find_dangling_references(rows)
+        if report['dangling']:
+            raise ValueError('{} references to rows outside this file (each page file '
+                             'must be self-contained, use #ID for saved rows)'.format(
+                                 len(report['dangling'])))
+
+        # Person rows have fixed columns (see bulk_import.prepare_person)
+        prepared_persons = prepare_rows(rows['persons'], prepare_person)
+        person_ids, person_rows = assign_ids('persons', 'person_id', prepared_persons)
+
+        prepared_relationships = prepare_rows(rows['relationships'], prepare_relationship,
+                                              person_ids)
+        relationship_ids, relationship_rows = assign_ids(
+            'relationships', 'relationship_id', prepared_relationships)
+
+        child_rows = prepare_rows(rows['children'], prepare_child, person_ids,
+                                  relationship_ids)
+
+        with db.connection() as conn:
+            with conn.cursor() as cur:
+                if person_rows:
+                    write_rows(cur, 'persons', ['person_id'] + prepared_persons[0][1],
+                               person_rows, batch_size)
+                if relationship_rows:
+                    write_rows(cur, 'relationships',
+                               ['relationship_id'] + prepared_relationships[0][1],
+                               relationship_rows, batch_size)
+                if child_rows:
+                    write_rows(cur, 'children', ['relationship_id', 'person_id'],
+                               child_rows, batch_size)
+
+        report['persons'] = len(person_rows)
+        report['relationships'] = len(relationship_rows)
+        report['children'] = len(child_rows)
+    except (Exception, psycopg2.DatabaseError) as error:
+        report['error'] = str(error).strip()
+
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    return report
+
+
+def print_progress(done, total, row_count, failed):
+    """
+    Prints a progress line over the previous one
+
+    Args:
+        (integer) done - Files processed
+        (integer) total - Files in total
+        (integer) row_count - Rows saved
+        (integer) failed - Files not saved
+    """
+
+    print('\r{}/{} files, {} rows saved, {} files failed'.format(
+        done, total, row_count, failed), end='', file=sys.stderr, flush=True)
+
+
+def ingest_directory(directory, workers=None, batch_size=BATCH_SIZE, progress=True):
+    """
+    Ingests the page files of a directory in parallel worker processes
+
+    Each file is saved in its own transaction, so a file with errors is
+    reported and skipped without affecting the others.
+
+    Args:
+        (string) directory - Directory of page files
+        (integer) workers - Worker processes (CPU count if None)
+        (integer) batch_size - Rows in one INSERT statement
+        (boolean) progress - Print a progress line
+    Returns:
+        (list) reports - Report of each file in name order
+    """
+
+    filenames = find_page_files(directory)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    # Workers are started fresh, so no database connections are shared
+    context = multiprocessing.get_context('spawn')
+
+    reports = []
+    row_count = 0
+    failed = 0
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(filenames) or 1)),
+                             mp_context=context) as executor:
+        futures = [executor.submit(ingest_file, filename, batch_size)
+                   for filename in filenames]
+        for future in as_completed(futures):
+            report = future.result()
+            reports.append(report)
+            if report['error']:
+                failed += 1
+            else:
+                row_count += report['persons'] + report['relationships'] + report['children']
+            if progress:
+                print_progress(len(reports), len(filenames), row_count, failed)
+
+    if progress and filenames:
+        print(file=sys.stderr)
+
+    reports.sort(key=lambda report: report['file'])
+    return reports
+
+
+def ingest_command(args):
+    """
+    Runs the ingest command
+
+    Args:
+        (Namespace) args - Command line arguments
+    """
+
+    start = time.perf_counter()
+    try:
+        reports = ingest_directory(args.directory, args.workers, args.batch_size)
+    except OSError as error:
+        print('Ingest failed: {}'.format(error))
+        return
+
+    saved = [report for report in reports if not report['error']]
+    failed = [report for report in reports if report['error']]
+
+    for report in failed:
+        print('ERROR: {}: {}'.format(report['file'], report['error']))
+        for reference in report['dangling']:
+            print('- Dangling reference: {}'.format(reference))
+
+    print('Ingested {} files in {:.1f} s: {} persons, {} relationships and {} children. '
+          '{} files failed.'.format(
+              len(saved), time.perf_counter() - start,
+              sum(report['persons'] for report in saved),
+              sum(report['relationships'] for report in saved),
+              sum(report['children'] for report in saved), len(failed)))
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as report_file:
+            json.dump(reports, report_file, indent=2)
+        print('File reports written to {}.'.format(args.report))
@@ -0,0 +1,294 @@
+import builtins
+import json
+import re
+import sys
+import threading
+import time
+
+from psycopg2 import extensions, sql
+
+import db
+
+# Statements slower than this are logged when they finish (milliseconds)
+SLOW_STATEMENT_MS = 100
+
+# Characters of a statement shown in logs and reports
+STATEMENT_LENGTH = 120
+
+# First table named in a statement
+TABLE_PATTERN = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN)\s+"?(\w+)', re.IGNORECASE)
+
+_profiler = None
+
+# input function replaced while profiling
+_original_input = None
+
+
+class Profiler:
+    """
+    Collects database round trips of a session
+
+    Every statement is counted by table and by the prompt answered before
+    it, so the report shows where a session waits on the database.
+    """
+
+    def __init__(self, slow_ms=SLOW_STATEMENT_MS):
+        """
+        Args:
+            (float) slow_ms - Threshold for logging slow statements
+        """
+
+        self.slow_ms = slow_ms
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.input_seconds = 0.0
+        self.prompt = None # Last prompt answered
+        self.connections = {'opened': 0, 'seconds': 0.0}
+        self.statements = {'count': 0, 'seconds': 0.0, 'rows': 0}
+        self.tables = {}
+        self.prompts = {}
+        self.slow_statements = []
+
+    def connected(self, seconds):
+        """
+        Records an opened connection
+
+        Args:
+            (float) seconds - Time taken to connect
+        """
+
+        with self.lock:
+            self.connections['opened'] += 1
+            self.connections['seconds'] += seconds
+
+    def executed(self, statement, seconds, rows):
+        """
+        Records an executed statement
+
+        Args:
+            (string) statement - SQL statement
+            (float) seconds - Time taken
+            (integer) rows - Rows affected or returned (-1 if not known)
+        """
+
+        match = TABLE_PATTERN.search(statement)
+        table_name = match.group(1).lower() if match else '(other)'
+        rows = max(rows, 0)
+
+        with self.lock:
+            for totals in (self.statements,
+                           self.tables.setdefault(table_name, {'count': 0, 'seconds': 0.0,
+                                                               'rows': 0}),
+                           self.prompts.setdefault(self.prompt or '(start)',
+                                                   {'count': 0, 'seconds': 0.0, 'rows': 0})):
+                totals['count'] += 1
+                totals['seconds'] += seconds
+                totals['rows'] += rows
+
+            if seconds * 1000 >= self.slow_ms:
+                text = ' '.join(statement.split())[:STATEMENT_LENGTH]
+                self.slow_statements.append({'ms': round(seconds * 1000, 3),
+                                             'prompt': self.prompt, 'statement': text})
+                print('SLOW {:.1f} ms after "{}": {}'.format(
+                    seconds * 1000, self.prompt, text), file=sys.stderr)
+
+    def answered(self, prompt, seconds):
+        """
+        Records an answered input prompt
+
+        Args:
+            (string) prompt - Prompt text
+            (float) seconds - Time spent waiting for the answer
+        """
+
+        with self.lock:
+            self.prompt = prompt.strip()
+            self.input_seconds += seconds
+
+    def summary(self):
+        """
+        Returns the collected counters
+
+        Returns:
+            (dict) summary - Session totals, tables, prompts and slow statements
+        """
+
+        def rounded(totals):
+            return dict(totals, seconds=round(totals['seconds'], 6))
+
+        with self.lock:
+            return {'session_seconds': round(time.perf_counter() - self.started, 6),
+                    'input_seconds': round(self.input_seconds, 6),
+                    'connections': rounded(self.connections),
+                    'statements': rounded(self.statements),
+                    'tables': {name: rounded(totals) for name, totals in self.tables.items()},
+                    'prompts': {prompt: rounded(totals)
+                                for prompt, totals in self.prompts.items()},
+                    'slow_statements': list(self.slow_statements)}
+
+
+class ProfilingCursor(extensions.cursor):
+    """
+    Cursor that reports each statement to the profiler
+    """
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_statement(self, query, time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_statement(self, query, time.perf_counter() - start)
+
+
+class ProfilingConnection(extensions.connection):
+    """
+    Connection that reports connecting and creates profiling cursors
+    """
+
+    def __init__(self, *args, **kwargs):
+        start = time.perf_counter()
+        super().__init__(*args, **kwargs)
+        if _profiler is not None:
+            _profiler.connected(time.perf_counter() - start)
+        self.cursor_factory = ProfilingCursor
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            if _profiler is not None:
+                _profiler.executed('COMMIT', time.perf_counter() - start, -1)
+
+    def rollback(self):
+        start = time.perf_counter()
+        try:
+            return super().rollback()
+        finally:
+            if _profiler is not None:
+                _profiler.executed('ROLLBACK', time.perf_counter() - start, -1)
+
+
+def record_statement(cur, query, seconds):
+    """
+    Reports a statement executed on a cursor
+
+    Args:
+        (cursor) cur - Cursor
+        (string/bytes/Composable) query - SQL statement
+        (float) seconds - Time taken
+    """
+
+    if _profiler is None:
+        return
+
+    if isinstance(query, sql.Composable):
+        query = query.as_string(cur)
+    elif isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+
+    _profiler.executed(query, seconds, cur.rowcount)
+
+
+def enable(slow_ms=SLOW_STATEMENT_MS):
+    """
+    Starts profiling database round trips and input prompts
+
+    Args:
+        (float) slow_ms - Threshold for logging slow statements
+    Returns:
+        (Profiler) profiler - Profiler collecting the session
+    """
+
+    global _profiler, _original_input
+
+    _profiler = Profiler(slow_ms)
+    db.set_connection_factory(ProfilingConnection)
+
+    # Time spent answering prompts is not database time
+    original_input = builtins.input
+    _original_input = original_input
+
+    def timed_input(prompt=''):
+        start = time.perf_counter()
+        try:
+            return original_input(prompt)
+        finally:
+            if _profiler is not None:
+                _profiler.answered(prompt, time.perf_counter() - start)
+
+    builtins.input = timed_input
+
+    return _profiler
+
+
+def print_summary(summary):
+    """
+    Prints a session profile
+
+    Args:
+        (dict) summary - Profiler summary
+    """
+
+    statements = summary['statements']
+    print('\nSession profile:', file=sys.stderr)
+    print('- Session {:.3f} s, answering prompts {:.3f} s, database {:.3f} s'.format(
+        summary['session_seconds'], summary['input_seconds'], statements['seconds']),
+        file=sys.stderr)
+    print('- Connections opened: {} ({:.3f} s)'.format(
+        summary['connections']['opened'], summary['connections']['seconds']), file=sys.stderr)
+    print('- Statements: {} ({} rows)'.format(statements['count'], statements['rows']),
+          file=sys.stderr)
+
+    for title, key in (('table', 'tables'), ('prompt answered before', 'prompts')):
+        print('\nStatements by {}:'.format(title), file=sys.stderr)
+        ordered = sorted(summary[key].items(), key=lambda item: -item[1]['seconds'])
+        for name, totals in ordered:
+            print('{:>8.1f} ms {:>6} statements {:>8} rows  {}'.format(
+                totals['seconds'] * 1000, totals['count'], totals['rows'], name),
+                file=sys.stderr)
+
+    if summary['slow_statements']:
+        print('\n{} statements slower than the threshold.'.format(
+            len(summary['slow_statements'])), file=sys.stderr)
+
+
+def report(output='-'):
+    """
+    Stops profiling and prints the summary or writes it as JSON
+
+    The input function and the connection class replaced by enable are
+    restored, also when writing the summary fails.
+
+    Args:
+        (string) output - JSON file name ('-' to print)
+    """
+
+    global _profiler, _original_input
+
+    if _profiler is None:
+        return
+
+    try:
+        summary = _profiler.summary()
+        _profiler = None
+
+        if output == '-':
+            print_summary(summary)
+        else:
+            with open(output, 'w', encoding='utf-8') as output_file:
+                json.dump(summary, output_file, indent=2)
+            print('Session profile written to {}.'.format(output), file=sys.stderr)
+    finally:
+        _profiler = None
+        if _original_input is not None:
+            builtins.input = _original_input
+            _original_input = None
+        db.set_connection_factory(None)
@@ -0,0 +1,562 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+import db
+import ids
+
+# ID columns of the journaled tables
+ID_COLUMNS = {'persons': 'person_id', 'relationships': 'relationship_id',
+              'children': 'child_id'}
+
+# Entries saved in one transaction
+BATCH_SIZE = 500
+
+# Seconds to wait before retrying when the database is not reachable
+RETRY_INTERVAL = 5
+
+
+class Journal:
+    """
+    Append-only file journal that saves rows to the database in the background
+
+    Every inserted or updated row is written to the journal file and synced
+    to disk before the call returns, or when the transaction it belongs to
+    commits. A writer thread saves the entries to the database in batches
+    and records the last saved entry in a separate progress file. Rows get
+    IDs reserved ahead from the table sequences, so replaying entries after
+    a crash or network outage is idempotent. The writer also keeps the IDs
+    in stock, so entering data never waits for the database. Reserved IDs
+    are written to the journal file too, so they can be used again after a
+    restart while the database is not reachable.
+    """
+
+    def __init__(self, filename):
+        """
+        Opens a journal file and queues the entries not yet saved
+
+        Args:
+            (string) filename - Journal file name
+        """
+
+        self.filename = filename
+        self.progress_filename = filename + '.done'
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.entries = [] # Entries not yet saved
+        self.pending_rows = {} # Rows not yet saved by (table, id)
+        self.pending_updates = {} # Changes not yet saved by (table, id)
+        self.local = threading.local() # Entries of the open transaction by thread
+        self.last_error = None
+        self.refill_needed = True
+        self.refill_error = None
+        self.stopping = False
+        self.writer = None
+        self.id_stock = {} # Reserved IDs not yet used by table
+
+        saved_seq = self.read_progress()
+        self.seq = saved_seq
+        valid_length = 0
+        used_ids = set()
+        if os.path.exists(filename):
+            with open(filename, 'rb') as journal_file:
+                length = 0
+                group = []
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        break # Entry cut short by a crash
+                    length += len(line)
+                    group.append(entry)
+                    # Entries of a transaction count only when all were written
+                    if not entry.get('end', True):
+                        continue
+                    valid_length = length
+                    for entry in group:
+                        self.seq = max(self.seq, entry['seq'])
+                        if entry['op'] == 'reserve':
+                            self.id_stock.setdefault(entry['table'], []).extend(entry['ids'])
+                            continue
+                        if entry['op'] == 'insert':
+                            used_ids.add((entry['table'], entry['id']))
+                        if entry['seq'] > saved_seq:
+                            self.entries.append(entry)
+                            self.apply_pending(entry)
+                    group = []
+
+        for table_name, id_numbers in self.id_stock.items():
+            self.id_stock[table_name] = [id_number for id_number in id_numbers
+                                         if (table_name, id_number) not in used_ids]
+
+        self.journal_file = open(filename, 'a', encoding='utf-8')
+        # Drop a partly written last entry before appending new ones
+        self.journal_file.truncate(valid_length)
+
+    def read_progress(self):
+        """
+        Reads the number of the last entry saved to the database
+
+        Returns:
+            (int) seq - Entry number (0 if nothing saved)
+        """
+
+        try:
+            with open(self.progress_filename, encoding='utf-8') as progress_file:
+                return int(progress_file.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def write_progress(self, seq):
+        """
+        Records the number of the last entry saved to the database
+
+        Args:
+            (integer) seq - Entry number
+        """
+
+        temporary_filename = self.progress_filename + '.tmp'
+        with open(temporary_filename, 'w', encoding='utf-8') as progress_file:
+            progress_file.write(str(seq))
+            progress_file.flush()
+            os.fsync(progress_file.fileno())
+        os.replace(temporary_filename, self.progress_filename)
+
+    def apply_pending(self, entry):
+        """
+        Updates the in-memory view of rows not yet saved
+
+        Args:
+            (dict) entry - Journal entry
+        """
+
+        key = (entry['table'], entry['id'])
+        values = dict(zip(entry['columns'], entry['values']))
+        if entry['op'] == 'insert':
+            self.pending_rows[key] = values
+        elif key in self.pending_rows:
+            self.pending_rows[key].update(values)
+        else:
+            self.pending_updates.setdefault(key, {}).update(values)
+
+    def append(self, op, table_name, id_value, column_names, column_values):
+        """
+        Writes an entry to the journal file and queues it for saving
+
+        Inside a transaction the entry is kept in memory until the
+        transaction commits.
+
+        Args:
+            (string) op - 'insert' or 'update'
+            (string) table_name - Table name
+            (integer) id_value - Row ID
+            (list) column_names - Names of columns
+            (list) column_values - Values of columns
+        """
+
+        entry = {'op': op, 'table': table_name, 'id': id_value,
+                 'columns': list(column_names), 'values': list(column_values)}
+
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is not None:
+            buffer.append(entry)
+        else:
+            self.write_entries([entry])
+
+    def write_group(self, entries):
+        """
+        Writes entries to the journal file with one sync
+
+        The last entry is marked as the end of the group, so a group cut
+        short by a crash is dropped when the journal is opened again. The
+        caller holds the lock.
+
+        Args:
+            (list) entries - Entries without numbers
+        Returns:
+            (list) numbered - Written entries with numbers
+        """
+
+        numbered = []
+        for index, entry in enumerate(entries):
+            self.seq += 1
+            entry = dict(seq=self.seq, **entry)
+            if index < len(entries) - 1:
+                entry['end'] = False
+            numbered.append(entry)
+        self.journal_file.write(''.join(json.dumps(entry) + '\n' for entry in numbered))
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+
+        return numbered
+
+    def write_entries(self, entries):
+        """
+        Writes entries to the journal file with one sync and queues them
+
+        Args:
+            (list) entries - Entries without numbers
+        """
+
+        with self.condition:
+            numbered = self.write_group(entries)
+            for entry in numbered:
+                self.entries.append(entry)
+                self.apply_pending(entry)
+            self.condition.notify()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Groups the entries of a with block, so they are saved only together
+
+        The entries are kept in memory and written to the journal file when
+        the outermost block finishes. Errors and interrupts (Ctrl-C) drop
+        the entries of the block, and a failing nested block drops only its
+        own entries. No database connection is used.
+
+        Yields:
+            (Journal) journal - This journal
+        """
+
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is not None:
+            start = len(buffer)
+            try:
+                yield self
+            except BaseException:
+                del buffer[start:]
+                raise
+            return
+
+        self.local.buffer = buffer = []
+        try:
+            yield self
+        finally:
+            self.local.buffer = None
+        if buffer:
+            self.write_entries(buffer)
+
+    def in_transaction(self):
+        """
+        Checks if a transaction is open in this thread
+
+        Returns:
+            (boolean) open - True inside a transaction block
+        """
+
+        return getattr(self.local, 'buffer', None) is not None
+
+    def insert_row(self, table_name, column_names, column_values, returning='*'):
+        """
+        Journals a new row (see db.insert_row)
+
+        Returns:
+            (list) columns - Returned columns
+            (tuple) values - Returned values
+        """
+
+        id_name = ID_COLUMNS[table_name]
+        # The writer reserves more IDs before the stock runs out
+        id_value = ids.next_id(table_name, wait=False)
+        if ids.needs_refill(table_name):
+            with self.condition:
+                self.refill_needed = True
+                self.condition.notify()
+        self.append('insert', table_name, id_value, column_names, column_values)
+
+        if returning != '*':
+            return [id_name], (id_value,)
+
+        return [id_name] + list(column_names), (id_value,) + tuple(column_values)
+
+    def update_row(self, table_name, id_name, id_value, column_names, column_values):
+        """
+        Journals changed columns of a row (see db.update_row)
+
+        Returns:
+            (int) updated_rows - How many rows updated
+        """
+
+        self.append('update', table_name, id_value, column_names, column_values)
+
+        return 1
+
+    def select_row(self, table_name, id_name, id_value):
+        """
+        Reads a row including changes not yet saved (see db.select_row)
+
+        Returns:
+            (list) columns - Data columns
+            (tuple) values - Data values (None if not found)
+        """
+
+        key = (table_name, id_value)
+        with self.lock:
+            pending_row = self.pending_rows.get(key)
+            if pending_row is not None:
+                pending_row = dict(pending_row)
+            pending_update = dict(self.pending_updates.get(key, {}))
+
+        # Entries of the open transaction of this thread
+        for entry in getattr(self.local, 'buffer', None) or []:
+            if (entry['table'], entry['id']) != key:
+                continue
+            values = dict(zip(entry['columns'], entry['values']))
+            if entry['op'] == 'insert':
+                pending_row = values
+            elif pending_row is not None:
+                pending_row.update(values)
+            else:
+                pending_update.update(values)
+
+        if pending_row is not None:
+            columns = [id_name] + list(pending_row)
+            return columns, (id_value,) + tuple(pending_row.values())
+
+        columns, values = db.read_row(table_name, id_name, id_value)
+        if values is not None and pending_update:
+            row = dict(zip(columns, values))
+            row.update(pending_update)
+            values = tuple(row[column] for column in columns)
+
+        return columns, values
+
+    def save_entries(self, entries):
+        """
+        Saves journal entries to the database in one transaction
+
+        Consecutive inserts to the same columns are sent as one multi-row
+        INSERT. Rows that already exist are skipped so entries can be saved
+        again after a crash.
+
+        Args:
+            (list) entries - Journal entries in order
+        """
+
+        with db.connection() as conn:
+            with conn.cursor() as cur:
+                index = 0
+                while index < len(entries):
+                    entry = entries[index]
+                    id_name = ID_COLUMNS[entry['table']]
+
+                    if entry['op'] == 'update':
+                        query = sql.SQL('UPDATE {} SET {} WHERE {} = %s').format(
+                            sql.Identifier(entry['table']),
+                            sql.SQL(', ').join(sql.SQL('{} = %s').format(sql.Identifier(name))
+                                               for name in entry['columns']),
+                            sql.Identifier(id_name))
+                        cur.execute(query, entry['values'] + [entry['id']])
+                        index += 1
+                        continue
+
+                    group = [entry]
+                    while (index + len(group) < len(entries)
+                           and entries[index + len(group)]['op'] == 'insert'
+                           and entries[index + len(group)]['table'] == entry['table']
+                           and entries[index + len(group)]['columns'] == entry['columns']):
+                        group.append(entries[index + len(group)])
+
+                    query = sql.SQL('INSERT INTO {} ({}) VALUES %s ON CONFLICT ({}) DO NOTHING').format(
+                        sql.Identifier(entry['table']),
+                        sql.SQL(', ').join(map(sql.Identifier, [id_name] + entry['columns'])),
+                        sql.Identifier(id_name))
+                    execute_values(cur, query.as_string(cur),
+                                   [[item['id']] + item['values'] for item in group],
+                                   page_size=len(group))
+                    index += len(group)
+
+        self.write_progress(entries[-1]['seq'])
+
+        # Saved rows are read from the database from now on
+        with self.lock:
+            del self.entries[:len(entries)]
+            self.pending_rows = {}
+            self.pending_updates = {}
+            for entry in self.entries:
+                self.apply_pending(entry)
+
+    def drain(self):
+        """
+        Saves all queued entries to the database
+
+        Returns:
+            (boolean) saved - True if the journal is empty
+        """
+
+        while True:
+            with self.lock:
+                entries = self.entries[:BATCH_SIZE]
+            if not entries:
+                return True
+            try:
+                self.save_entries(entries)
+                self.last_error = None
+            except (Exception, psycopg2.DatabaseError) as error:
+                if str(error) != str(self.last_error):
+                    print('\nJournal could not be saved, retrying later: {}'.format(error))
+                self.last_error = error
+                return False
+
+    def write_reservation(self, table_name, id_numbers):
+        """
+        Writes reserved IDs to the journal file, so a restart can use them
+
+        Args:
+            (string) table_name - Table name
+            (list) id_numbers - Reserved IDs
+        """
+
+        with self.lock:
+            self.write_group([{'op': 'reserve', 'table': table_name,
+                               'ids': list(id_numbers)}])
+
+    def refill_ids(self):
+        """
+        Reserves more IDs for tables whose stock runs low
+
+        Returns:
+            (boolean) reserved - True if every table has IDs in stock
+        """
+
+        with self.lock:
+            self.refill_needed = False
+        for table_name in ID_COLUMNS:
+            try:
+                ids.refill(table_name, reserved=self.write_reservation)
+            except (Exception, psycopg2.DatabaseError) as error:
+                if str(error) != str(self.refill_error):
+                    print('\nIDs could not be reserved for {}, retrying later: {}'.format(
+                        table_name, error))
+                self.refill_error = error
+                with self.lock:
+                    self.refill_needed = True
+                return False
+        self.refill_error = None
+        return True
+
+    def run_writer(self):
+        """
+        Background writer loop
+        """
+
+        while True:
+            with self.condition:
+                while not self.entries and not self.refill_needed and not self.stopping:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+
+            saved = self.drain()
+            # Keep IDs reserved so entering data does not wait for them
+            reserved = self.refill_ids()
+            if not (saved and reserved):
+                with self.condition:
+                    self.condition.wait(RETRY_INTERVAL)
+
+    def start(self):
+        """
+        Reserves IDs and starts the background writer thread
+
+        IDs left in the journal file by the previous session are used first.
+
+        Returns:
+            (list) missing - Tables without any IDs in stock
+        """
+
+        for table_name, id_numbers in self.id_stock.items():
+            ids.add(table_name, id_numbers)
+        self.id_stock = {}
+        self.refill_ids()
+
+        self.writer = threading.Thread(target=self.run_writer, name='journal-writer',
+                                       daemon=True)
+        self.writer.start()
+
+        return [table_name for table_name in ID_COLUMNS if ids.available(table_name) == 0]
+
+    def close(self, timeout=30):
+        """
+        Stops the writer after saving what can be saved within the timeout
+
+        Args:
+            (integer) timeout - Seconds to wait for the database
+        Returns:
+            (int) remaining - How many entries are left in the journal
+        """
+
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.writer is not None:
+            self.writer.join()
+
+        deadline = time.monotonic() + timeout
+        while not self.drain() and time.monotonic() < deadline:
+            time.sleep(min(RETRY_INTERVAL, max(0, deadline - time.monotonic())))
+
+        # IDs not used are kept for the next session
+        id_stock = {table_name: ids.take(table_name, ids.available(table_name), wait=False)
+                    for table_name in ID_COLUMNS}
+
+        with self.lock:
+            remaining = len(self.entries)
+            if remaining == 0:
+                # Everything is saved, start the next session from an empty file
+                self.journal_file.truncate(0)
+                self.write_progress(0)
+                self.seq = 0
+                for table_name, id_numbers in id_stock.items():
+                    if id_numbers:
+                        self.write_group([{'op': 'reserve', 'table': table_name,
+                                           'ids': id_numbers}])
+            self.journal_file.close()
+
+        return remaining
+
+
+def open_journal(filename, require_ids=True):
+    """
+    Opens a journal and routes database row writes through it
+
+    Args:
+        (string) filename - Journal file name
+        (boolean) require_ids - Refuse to start without IDs for new rows
+    Returns:
+        (Journal) journal - Started journal
+    """
+
+    journal = Journal(filename)
+    if journal.entries:
+        print('Saving {} entries left in journal {}.'.format(len(journal.entries), filename))
+    missing = journal.start()
+    if require_ids and missing:
+        # Rows typed without IDs could not be saved, so do not let the session start
+        journal.close(timeout=0)
+        raise RuntimeError('No IDs reserved for {} and the database cannot be reached'.format(
+            ', '.join(missing)))
+    db.set_write_behind(journal)
+
+    return journal
+
+
+def close_journal(journal):
+    """
+    Saves remaining entries and stops routing writes through the journal
+
+    Args:
+        (Journal) journal - Journal to close
+    """
+
+    db.set_write_behind(None)
+    remaining = journal.close()
+    if remaining:
+        print('{} entries are kept in journal {} and saved on next start.'.format(
+            remaining, journal.filename))
@@ -0,0 +1,200 @@
+import csv
+import sys
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+import db
+from dedupe import load_persons, date_similarity
+
+# Page reference columns of a person
+REFERENCE_COLUMNS = ['page_from', 'page_to']
+
+# Columns of the resolver report
+REPORT_COLUMNS = ['status', 'person_id', 'page_number', 'first_names', 'last_name',
+                  'birth_date', 'reference', 'referenced_page', 'linked_person_ids']
+
+
+def index_persons(persons):
+    """
+    Indexes persons by page and phonetic first name for hash lookups
+
+    Args:
+        (list) persons - Person data (see dedupe.load_persons)
+    Returns:
+        (dict) index - Persons by (page number, first name key)
+        (set) pages - Page numbers that have persons
+    """
+
+    index = {}
+    pages = set()
+    for person in persons:
+        pages.add(person['page_number'])
+        if person['first_phonetic']:
+            index.setdefault((person['page_number'], person['first_phonetic']),
+                             []).append(person)
+    return index, pages
+
+
+def is_match(person, candidate):
+    """
+    Tells whether a person on another page can be the same person
+
+    The last names must match phonetically, or both birth dates must be
+    known and match (a married name on the other page). Partial birth dates
+    match as far as they are known.
+
+    Args:
+        (dict) person - Person with a page reference
+        (dict) candidate - Person on the referenced page
+    Returns:
+        (boolean) match - True if the persons match
+    """
+
+    if candidate['person_id'] == person['person_id']:
+        return False
+    if person['gender'] and candidate['gender'] and person['gender'] != candidate['gender']:
+        return False
+
+    similarity = date_similarity(person['birth_date'], candidate['birth_date'])
+    if similarity is not None and similarity < 0.9:
+        return False
+
+    if person['last_phonetic'] and person['last_phonetic'] == candidate['last_phonetic']:
+        return True
+    return similarity is not None
+
+
+def resolve_references(persons):
+    """
+    Resolves the page references of all persons in one pass
+
+    Each page_from and page_to is looked up among the persons of the
+    referenced page. A single match becomes a link. Of many matches, the
+    ones referring back to the person's page are preferred.
+
+    Args:
+        (list) persons - Person data (see dedupe.load_persons)
+    Returns:
+        (set) links - (smaller person ID, larger person ID) pairs
+        (list) results - Report rows by column name
+    """
+
+    index, pages = index_persons(persons)
+
+    links = set()
+    results = []
+    for person in persons:
+        for reference in REFERENCE_COLUMNS:
+            page = person[reference]
+            if page is None or page == person['page_number']:
+                continue
+
+            matches = []
+            if page not in pages:
+                status = 'page not entered'
+            else:
+                matches = [candidate for candidate in
+                           index.get((page, person['first_phonetic']), [])
+                           if is_match(person, candidate)]
+                if len(matches) > 1:
+                    referring = [candidate for candidate in matches
+                                 if person['page_number'] in
+                                 (candidate['page_from'], candidate['page_to'])]
+                    if referring:
+                        matches = referring
+
+                if not matches:
+                    status = 'no match'
+                elif len(matches) > 1:
+                    status = 'ambiguous'
+                else:
+                    status = 'link'
+                    links.add((min(person['person_id'], matches[0]['person_id']),
+                               max(person['person_id'], matches[0]['person_id'])))
+
+            results.append({'status': status, 'person_id': person['person_id'],
+                            'page_number': person['page_number'],
+                            'first_names': person['first_names'],
+                            'last_name': person['last_name'],
+                            'birth_date': person['birth_date'], 'reference': reference,
+                            'referenced_page': page,
+                            'linked_person_ids': ' '.join(
+                                str(match['person_id']) for match in matches)})
+
+    results.sort(key=lambda result: (result['page_number'], result['person_id'],
+                                     result['reference']))
+    return links, results
+
+
+def save_links(links, batch_size=1000):
+    """
+    Saves person links in one transaction, skipping existing links
+
+    Args:
+        (set) links - (smaller person ID, larger person ID) pairs
+        (integer) batch_size - Rows in one INSERT statement
+    Returns:
+        (int) saved - How many new links were saved
+    """
+
+    saved = 0
+    links = sorted(links)
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            for start in range(0, len(links), batch_size):
+                batch = links[start:start + batch_size]
+                saved += len(execute_values(
+                    cur, 'INSERT INTO person_links (person_id1, person_id2) VALUES %s '
+                    'ON CONFLICT DO NOTHING RETURNING person_id1', batch,
+                    page_size=len(batch), fetch=True))
+    return saved
+
+
+def write_results(results, output_file):
+    """
+    Writes resolver results as CSV
+
+    Args:
+        (list) results - Report rows by column name
+        (file) output_file - Output file
+    """
+
+    writer = csv.DictWriter(output_file, REPORT_COLUMNS)
+    writer.writeheader()
+    writer.writerows(results)
+
+
+def link_pages_command(args):
+    """
+    Runs the link-pages command
+
+    Args:
+        (Namespace) args - Command line arguments
+    """
+
+    try:
+        persons = load_persons()
+        links, results = resolve_references(persons)
+        saved = save_links(links) if args.apply else None
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return
+
+    if args.output:
+        with open(args.output, 'w', newline='', encoding='utf-8') as output_file:
+            write_results(results, output_file)
+    elif not args.apply:
+        write_results(results, sys.stdout)
+        return
+
+    statuses = [result['status'] for result in results]
+    print('{} page references: {} links, {} ambiguous, {} without a match and {} to '
+          'pages not entered.'.format(len(results), statuses.count('link'),
+                                      statuses.count('ambiguous'),
+                                      statuses.count('no match'),
+                                      statuses.count('page not entered')))
+    if saved is not None:
+        print('Saved {} new links ({} found).'.format(saved, len(links)))
+    if args.output:
+        print('Results written to {}.'.format(args.output))
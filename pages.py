@@ -0,0 +1,112 @@
+import psycopg2
+
+import db
+
+# Page summaries in page order (see schema migration 5)
+PAGE_SUMMARIES_SQL = """
+SELECT page_number, persons, referenced_by, done
+FROM page_summaries
+WHERE persons > 0 OR referenced_by > 0 OR done
+ORDER BY page_number
+"""
+
+# Pages referred to by page_from or page_to that have no persons yet
+MISSING_PAGES_SQL = """
+SELECT page_number, referenced_by
+FROM page_summaries
+WHERE persons = 0 AND referenced_by > 0
+ORDER BY page_number
+"""
+
+
+def get_page_summaries(missing_only=False):
+    """
+    Reads the summary of every page entered, referred to or marked done
+
+    Args:
+        (boolean) missing_only - Only pages referred to but not entered
+    Returns:
+        (list) summaries - Summary data of each page in page order
+    """
+
+    if missing_only:
+        columns, rows = db.fetch_all(MISSING_PAGES_SQL)
+    else:
+        columns, rows = db.fetch_all(PAGE_SUMMARIES_SQL)
+
+    return [dict(zip(columns, values)) for values in rows]
+
+
+def mark_pages(page_numbers, done=True):
+    """
+    Marks pages done or not done
+
+    Args:
+        (list) page_numbers - Page numbers
+        (boolean) done - Done or reopened
+    Returns:
+        (int) marked - How many pages were marked
+    """
+
+    return db.execute('INSERT INTO page_summaries (page_number, done) '
+                      'SELECT unnest(%s::integer[]), %s '
+                      'ON CONFLICT (page_number) DO UPDATE SET done = EXCLUDED.done',
+                      (sorted(set(page_numbers)), done))
+
+
+def page_status(summary):
+    """
+    Describes the entry state of a page
+
+    Args:
+        (dict) summary - Page summary
+    Returns:
+        (string) status - done, in progress or missing
+    """
+
+    if summary['done']:
+        return 'done'
+    if summary['persons'] > 0:
+        return 'in progress'
+    return 'missing'
+
+
+def pages_command(args):
+    """
+    Runs the pages command
+
+    Args:
+        (Namespace) args - Command line arguments
+    """
+
+    try:
+        if args.done:
+            mark_pages(args.done, True)
+            print('Marked {} pages done.'.format(len(set(args.done))))
+        if args.reopen:
+            mark_pages(args.reopen, False)
+            print('Reopened {} pages.'.format(len(set(args.reopen))))
+        if args.done or args.reopen:
+            return
+
+        summaries = get_page_summaries(args.missing)
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return
+
+    if args.missing:
+        for summary in summaries:
+            print('Page {} is referred to by {} page links but has no persons.'.format(
+                summary['page_number'], summary['referenced_by']))
+        print('{} pages missing.'.format(len(summaries)))
+        return
+
+    print('{:>6} {:>8} {:>11}  {}'.format('Page', 'Persons', 'Referenced', 'Status'))
+    for summary in summaries:
+        print('{:>6} {:>8} {:>11}  {}'.format(summary['page_number'], summary['persons'],
+                                              summary['referenced_by'],
+                                              page_status(summary)))
+
+    statuses = [page_status(summary) for summary in summaries]
+    print('{} pages done, {} in progress and {} referred to but missing.'.format(
+        statuses.count('done'), statuses.count('in progress'), statuses.count('missing')))
@@ -0,0 +1,109 @@
+import queue
+import threading
+
+import psycopg2
+
+import cache
+import db
+import storage
+
+
+class Prefetcher:
+    """
+    Reads rows into the row caches on a background thread
+
+    Lookups of rows typed in by ID are queued while the operator is still
+    typing, so the rows are cached by the time the review prints them. A lookup that
+    fails or is not ready yet only means the row is read when displayed.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, key, function, *args):
+        """
+        Queues a lookup unless the same lookup is already queued
+
+        Args:
+            (tuple) key - Lookup key
+            (function) function - Lookup function
+            (tuple) args - Arguments of the lookup function
+        """
+
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='prefetch', daemon=True)
+                self.thread.start()
+        self.queue.put((key, function, args))
+
+    def run(self):
+        """
+        Runs queued lookups (background thread)
+        """
+
+        while True:
+            key, function, args = self.queue.get()
+            try:
+                function(*args)
+            except (Exception, psycopg2.DatabaseError):
+                pass # The row is read again when displayed
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+                self.queue.task_done()
+
+
+prefetcher = Prefetcher()
+
+
+def enabled():
+    """
+    Tells whether rows can be read ahead on another connection
+
+    Rows waiting in the write-behind journal and rows of a local SQLite
+    file are only visible to the session itself.
+
+    Returns:
+        (boolean) enabled - True with direct PostgreSQL storage
+    """
+
+    return storage.is_remote() and not db.write_behind_active()
+
+
+def load_persons(person_ids):
+    """
+    Reads persons missing from the cache with one query
+
+    Args:
+        (list) person_ids - Person IDs
+    """
+
+    invalidations = cache.persons.invalidations
+    missing = [int(person_id) for person_id in person_ids
+               if person_id and not cache.persons.contains(person_id)]
+    if not missing:
+        return
+
+    columns, rows = db.fetch_all('SELECT * FROM persons WHERE person_id = ANY(%s)',
+                                 (missing,))
+    id_index = columns.index('person_id')
+    for values in rows:
+        cache.persons.put_prefetched(values[id_index], columns, values, invalidations)
+
+
+def persons(person_ids):
+    """
+    Reads persons into the cache in the background
+
+    Args:
+        (list) person_ids - Person IDs
+    """
+
+    if enabled():
+        prefetcher.submit(('persons',) + tuple(person_ids), load_persons, person_ids)
@@ -0,0 +1,137 @@
+import builtins
+import json
+import sys
+
+import storage
+
+
+class TranscriptReader:
+    """
+    Standard input that reads the answers of a recorded transcript
+
+    input() reads one answer per prompt. When the answers run out, input()
+    raises EOFError as if standard input was closed.
+    """
+
+    def __init__(self, answers):
+        """
+        Args:
+            (list) answers - Answers in prompt order
+        """
+
+        self.answers = answers
+        self.position = 0
+
+    def readline(self):
+        if self.position >= len(self.answers):
+            return ''
+        answer = self.answers[self.position]
+        self.position += 1
+        return answer + '\n'
+
+    def remaining(self):
+        """
+        Returns how many answers are not read yet
+
+        Returns:
+            (int) count - Answers left
+        """
+
+        return len(self.answers) - self.position
+
+    def isatty(self):
+        return False
+
+
+def read_transcript(filename):
+    """
+    Reads the answers of a transcript file
+
+    Args:
+        (string) filename - Transcript file (JSON Lines with prompt and answer)
+    Returns:
+        (list) answers - Answers in prompt order
+    """
+
+    answers = []
+    with open(filename, encoding='utf-8') as transcript_file:
+        for line_number, line in enumerate(transcript_file, 1):
+            if not line.strip():
+                continue
+            try:
+                answers.append(str(json.loads(line)['answer']))
+            except (ValueError, KeyError, TypeError):
+                raise ValueError('Not a transcript entry on line {}: {}'.format(
+                    line_number, line.strip()))
+    return answers
+
+
+def record(filename):
+    """
+    Records every answered prompt to a transcript file
+
+    Args:
+        (string) filename - Transcript file (appended to)
+    Returns:
+        (function) stop - Stops recording and closes the file
+    """
+
+    transcript_file = open(filename, 'a', encoding='utf-8')
+    original_input = builtins.input
+
+    def recorded_input(prompt=''):
+        answer = original_input(prompt)
+        transcript_file.write(json.dumps({'prompt': prompt, 'answer': answer},
+                                         ensure_ascii=False) + '\n')
+        transcript_file.flush()
+        return answer
+
+    def stop():
+        builtins.input = original_input
+        transcript_file.close()
+
+    builtins.input = recorded_input
+    return stop
+
+
+def replay(filenames, session, echo=False):
+    """
+    Runs interactive sessions with answers read from transcript files
+
+    Sessions are repeated until the answers run out. All writes are saved
+    in one transaction; a family line that fails or is left unfinished at
+    the end of the transcript is rolled back alone.
+
+    Args:
+        (list) filenames - Transcript files
+        (function) session - Interactive session (add_interactively)
+        (boolean) echo - Print saved and read rows
+    Returns:
+        (int) sessions - How many sessions were replayed
+    """
+
+    from extract_genealogy import set_echo
+
+    answers = []
+    for filename in filenames:
+        answers += read_transcript(filename)
+
+    reader = TranscriptReader(answers)
+    original_stdin = sys.stdin
+    sys.stdin = reader
+    set_echo(echo)
+    sessions = 0
+    try:
+        with storage.transaction():
+            try:
+                while reader.remaining():
+                    session()
+                    sessions += 1
+            except EOFError:
+                print('\nTranscript ended in the middle of an entry, '
+                      'the unfinished entry was not saved.')
+    finally:
+        sys.stdin = original_stdin
+        set_echo(True)
+
+    return sessions
@@ -0,0 +1,306 @@
+import psycopg2
+
+import db
+
+# Page changes of person rows: (page_number, persons, referenced_by)
+PAGE_CHANGES = """SELECT page_number, {sign} AS persons, 0 AS referenced_by FROM {rows}
+    UNION ALL SELECT page_from, 0, {sign} FROM {rows} WHERE page_from IS NOT NULL
+    UNION ALL SELECT page_to, 0, {sign} FROM {rows} WHERE page_to IS NOT NULL"""
+
+# Adds page changes to page summaries (unchanged pages are skipped)
+PAGE_SUMMARY_UPSERT = """INSERT INTO page_summaries AS s (page_number, persons, referenced_by)
+                SELECT page_number, SUM(persons), SUM(referenced_by)
+                FROM ({changes}) changes
+                GROUP BY page_number
+                HAVING SUM(persons) <> 0 OR SUM(referenced_by) <> 0
+                ORDER BY page_number
+                ON CONFLICT (page_number) DO UPDATE
+                SET persons = s.persons + EXCLUDED.persons,
+                    referenced_by = s.referenced_by + EXCLUDED.referenced_by;"""
+
+# Schema versions in order: (version, description, statements)
+MIGRATIONS = [
+    (1, 'Create tables', [
+        """CREATE TABLE IF NOT EXISTS persons(
+            person_id serial PRIMARY KEY,
+            page_number INTEGER NOT NULL,
+            first_names VARCHAR (100),
+            last_name VARCHAR (100),
+            gender VARCHAR(30),
+            birth_date VARCHAR (10),
+            birth_place VARCHAR (255),
+            death_date VARCHAR (10),
+            death_place VARCHAR (255),
+            deceased BOOLEAN,
+            page_from INTEGER,
+            page_to INTEGER,
+            comments VARCHAR (255))""",
+        # Databases created from the first README schema lack this column
+        'ALTER TABLE persons ADD COLUMN IF NOT EXISTS deceased BOOLEAN',
+        """CREATE TABLE IF NOT EXISTS relationships(
+            relationship_id serial PRIMARY KEY,
+            person_id_partner1 INTEGER,
+            person_id_partner2 INTEGER,
+            marriage_date VARCHAR (10),
+            marriage_place VARCHAR (255),
+            divorce_date VARCHAR (10),
+            divorce_place VARCHAR (255),
+            comments VARCHAR (255))""",
+        """CREATE TABLE IF NOT EXISTS children(
+            child_id serial PRIMARY KEY,
+            person_id INTEGER NOT NULL,
+            relationship_id INTEGER NOT NULL)""",
+    ]),
+    (2, 'Add lookup indexes', [
+        'CREATE INDEX IF NOT EXISTS children_relationship_id_idx ON children (relationship_id)',
+        'CREATE INDEX IF NOT EXISTS children_person_id_idx ON children (person_id)',
+        'CREATE INDEX IF NOT EXISTS relationships_partner1_idx '
+        'ON relationships (person_id_partner1)',
+        'CREATE INDEX IF NOT EXISTS relationships_partner2_idx '
+        'ON relationships (person_id_partner2)',
+        'CREATE INDEX IF NOT EXISTS persons_page_number_idx ON persons (page_number)',
+        'CREATE INDEX IF NOT EXISTS persons_last_name_idx ON persons (last_name)',
+    ]),
+    # Foreign keys are checked at commit so rows of one transaction can be
+    # written in any order. Existing rows are checked by validate_foreign_keys.
+    (3, 'Add foreign keys', [
+        'ALTER TABLE relationships ADD CONSTRAINT relationships_partner1_fkey '
+        'FOREIGN KEY (person_id_partner1) REFERENCES persons (person_id) '
+        'DEFERRABLE INITIALLY DEFERRED NOT VALID',
+        'ALTER TABLE relationships ADD CONSTRAINT relationships_partner2_fkey '
+        'FOREIGN KEY (person_id_partner2) REFERENCES persons (person_id) '
+        'DEFERRABLE INITIALLY DEFERRED NOT VALID',
+        'ALTER TABLE children ADD CONSTRAINT children_person_id_fkey '
+        'FOREIGN KEY (person_id) REFERENCES persons (person_id) '
+        'DEFERRABLE INITIALLY DEFERRED NOT VALID',
+        'ALTER TABLE children ADD CONSTRAINT children_relationship_id_fkey '
+        'FOREIGN KEY (relationship_id) REFERENCES relationships (relationship_id) '
+        'DEFERRABLE INITIALLY DEFERRED NOT VALID',
+    ]),
+    (4, 'Add trigram name indexes', [
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        'CREATE INDEX IF NOT EXISTS persons_first_names_trgm_idx '
+        'ON persons USING gin (first_names gin_trgm_ops)',
+        'CREATE INDEX IF NOT EXISTS persons_last_name_trgm_idx '
+        'ON persons USING gin (last_name gin_trgm_ops)',
+    ]),
+    # Statement triggers apply the changes of a whole INSERT (e.g. a bulk
+    # import batch) with one upsert, taking the page rows in page order so
+    # parallel writers cannot deadlock
+    (5, 'Add page summaries', [
+        """CREATE TABLE IF NOT EXISTS page_summaries(
+            page_number INTEGER PRIMARY KEY,
+            persons INTEGER NOT NULL DEFAULT 0,
+            referenced_by INTEGER NOT NULL DEFAULT 0,
+            done BOOLEAN NOT NULL DEFAULT FALSE)""",
+        """CREATE OR REPLACE FUNCTION update_page_summaries() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                {insert}
+            ELSIF TG_OP = 'UPDATE' THEN
+                {update}
+            ELSE
+                {delete}
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql""".format(
+            insert=PAGE_SUMMARY_UPSERT.format(changes=PAGE_CHANGES.format(rows='new_rows',
+                                                                          sign=1)),
+            update=PAGE_SUMMARY_UPSERT.format(changes=PAGE_CHANGES.format(rows='new_rows',
+                                                                          sign=1)
+                                              + ' UNION ALL '
+                                              + PAGE_CHANGES.format(rows='old_rows',
+                                                                    sign=-1)),
+            delete=PAGE_SUMMARY_UPSERT.format(changes=PAGE_CHANGES.format(rows='old_rows',
+                                                                          sign=-1))),
+        'DROP TRIGGER IF EXISTS persons_page_summaries_insert ON persons',
+        'CREATE TRIGGER persons_page_summaries_insert AFTER INSERT ON persons '
+        'REFERENCING NEW TABLE AS new_rows '
+        'FOR EACH STATEMENT EXECUTE PROCEDURE update_page_summaries()',
+        'DROP TRIGGER IF EXISTS persons_page_summaries_update ON persons',
+        'CREATE TRIGGER persons_page_summaries_update AFTER UPDATE ON persons '
+        'REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows '
+        'FOR EACH STATEMENT EXECUTE PROCEDURE update_page_summaries()',
+        'DROP TRIGGER IF EXISTS persons_page_summaries_delete ON persons',
+        'CREATE TRIGGER persons_page_summaries_delete AFTER DELETE ON persons '
+        'REFERENCING OLD TABLE AS old_rows '
+        'FOR EACH STATEMENT EXECUTE PROCEDURE update_page_summaries()',
+        """CREATE OR REPLACE FUNCTION reset_page_summaries() RETURNS trigger AS $$
+        BEGIN
+            UPDATE page_summaries SET persons = 0, referenced_by = 0;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql""",
+        'DROP TRIGGER IF EXISTS persons_page_summaries_truncate ON persons',
+        'CREATE TRIGGER persons_page_summaries_truncate AFTER TRUNCATE ON persons '
+        'FOR EACH STATEMENT EXECUTE PROCEDURE reset_page_summaries()',
+        # Existing rows are counted after the triggers lock out writers
+        """INSERT INTO page_summaries (page_number, persons, referenced_by)
+        SELECT page_number, SUM(persons), SUM(referenced_by)
+        FROM ({}) changes GROUP BY page_number
+        ON CONFLICT (page_number) DO UPDATE
+        SET persons = EXCLUDED.persons, referenced_by = EXCLUDED.referenced_by""".format(
+            PAGE_CHANGES.format(rows='persons', sign=1)),
+    ]),
+    # Occurrences of the same person on different pages (see page_links.py)
+    (6, 'Add person links', [
+        """CREATE TABLE IF NOT EXISTS person_links(
+            person_id1 INTEGER NOT NULL REFERENCES persons (person_id)
+                ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+            person_id2 INTEGER NOT NULL REFERENCES persons (person_id)
+                ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+            PRIMARY KEY (person_id1, person_id2),
+            CHECK (person_id1 < person_id2))""",
+        'CREATE INDEX IF NOT EXISTS person_links_person_id2_idx ON person_links (person_id2)',
+    ]),
+]
+
+# Advisory lock key held while migrating
+MIGRATION_LOCK_ID = 4242013
+
+# Foreign keys added as NOT VALID by migration 3
+FOREIGN_KEYS = [('relationships', 'relationships_partner1_fkey'),
+                ('relationships', 'relationships_partner2_fkey'),
+                ('children', 'children_person_id_fkey'),
+                ('children', 'children_relationship_id_fkey')]
+
+
+def get_version(cur):
+    """
+    Reads the current schema version
+
+    Args:
+        (cursor) cur - Database cursor
+    Returns:
+        (int) version - Schema version (0 if not versioned yet)
+    """
+
+    cur.execute("""CREATE TABLE IF NOT EXISTS schema_version(
+                       version INTEGER PRIMARY KEY,
+                       description VARCHAR (255),
+                       applied_at TIMESTAMP NOT NULL DEFAULT now())""")
+    cur.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version')
+
+    return cur.fetchone()[0]
+
+
+def migrate(target_version=None):
+    """
+    Creates or upgrades the schema in place
+
+    Each migration runs in its own transaction together with its version
+    row, so a failed migration leaves the database at the previous version.
+
+    Args:
+        (integer) target_version - Version to upgrade to (latest if None)
+    Returns:
+        (list) applied - Descriptions of applied migrations
+    """
+
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if target_version is not None and version > target_version:
+            break
+
+        with db.connection() as conn:
+            with conn.cursor() as cur:
+                # Only one process can upgrade at a time
+                cur.execute('SELECT pg_advisory_xact_lock(%s)', (MIGRATION_LOCK_ID,))
+                if get_version(cur) >= version:
+                    continue
+
+                for statement in statements:
+                    cur.execute(statement)
+                cur.execute('INSERT INTO schema_version (version, description) '
+                            'VALUES (%s, %s)', (version, description))
+                applied.append('{}: {}'.format(version, description))
+
+    return applied
+
+
+def validate_foreign_keys():
+    """
+    Checks existing rows against the foreign keys
+
+    Keys that existing rows break (e.g. orphan children) stay NOT VALID:
+    they are checked for new rows but not for the old ones. Keys that do
+    not exist yet (schema older than version 3) or are already valid are
+    skipped.
+
+    Returns:
+        (list) invalid - Names of foreign keys that existing rows break
+    """
+
+    invalid = []
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT conrelid::regclass::text, conname FROM pg_constraint '
+                        "WHERE contype = 'f' AND NOT convalidated AND conname = ANY(%s)",
+                        ([constraint_name for table_name, constraint_name in FOREIGN_KEYS],))
+            unvalidated = set(cur.fetchall())
+
+            for table_name, constraint_name in FOREIGN_KEYS:
+                if (table_name, constraint_name) not in unvalidated:
+                    continue
+
+                cur.execute('SAVEPOINT validate')
+                try:
+                    cur.execute('ALTER TABLE {} VALIDATE CONSTRAINT {}'.format(
+                        table_name, constraint_name))
+                except psycopg2.IntegrityError:
+                    cur.execute('ROLLBACK TO SAVEPOINT validate')
+                    invalid.append(constraint_name)
+                else:
+                    cur.execute('RELEASE SAVEPOINT validate')
+
+    return invalid
+
+
+def schema_status():
+    """
+    Lists applied and pending migrations
+
+    Returns:
+        (int) version - Current schema version
+        (list) pending - Descriptions of migrations not applied
+    """
+
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            version = get_version(cur)
+
+    pending = ['{}: {}'.format(number, description)
+               for number, description, statements in MIGRATIONS if number > version]
+
+    return version, pending
+
+
+def migrate_command(args):
+    """
+    Runs the init-db and migrate commands
+
+    Args:
+        (Namespace) args - Command line arguments
+    """
+
+    try:
+        if getattr(args, 'status', False):
+            version, pending = schema_status()
+            print('Schema version: {}'.format(version))
+            for description in pending:
+                print('- Pending {}'.format(description))
+            return
+
+        applied = migrate(getattr(args, 'version', None))
+        for description in applied:
+            print('Applied {}'.format(description))
+        if not applied:
+            print('Schema is up to date.')
+
+        invalid = validate_foreign_keys()
+        for constraint_name in invalid:
+            print('WARNING: Existing rows break {}. It is checked for new rows only.'.format(
+                constraint_name))
+    except (Exception, psycopg2.DatabaseError) as error:
+        print('Migration failed: {}'.format(error))
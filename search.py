@@ -0,0 +1,386 @@
+import heapq
+import threading
+import time
+from collections import Counter
+
+import psycopg2
+
+import db
+import storage
+from dedupe import normalize_name, birth_year
+
+# Person columns kept in the index
+SNAPSHOT_SQL = 'SELECT person_id, first_names, last_name, birth_date, page_number FROM persons'
+
+# Minimum share of query trigrams an indexed word must contain
+MIN_SCORE = 0.5
+
+# Best combinations of matched words kept for a query of many words
+MAX_COMBINATIONS = 1000
+
+# Birth years further apart than this do not match a query year
+YEAR_TOLERANCE = 2
+
+
+def name_tokens(*names):
+    """
+    Splits names into normalized words
+
+    Args:
+        (tuple) names - Names
+    Returns:
+        (list) tokens - Words in lower case without accents
+    """
+
+    tokens = []
+    for name in names:
+        tokens += normalize_name(name).split()
+    return tokens
+
+
+def trigrams(token, prefix=False):
+    """
+    Returns the trigrams of a word padded with spaces
+
+    Indexed words are padded at both ends and query words only at the
+    start, so typing the start of a name matches all of its trigrams.
+
+    Args:
+        (string) token - Word
+        (boolean) prefix - Token is a query prefix
+    Returns:
+        (set) grams - Trigrams
+    """
+
+    padded = '  ' + token + ('' if prefix else ' ')
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """
+    In-memory name index over person names and birth years
+
+    Words of first names and last names are indexed by their trigrams, so a
+    query word matches spelling variants and the beginnings of names. The
+    persons of the matching words are intersected for each query word, and
+    only the remaining persons are ranked. The vocabulary of words is much
+    smaller than the number of persons, so lookups stay fast in a book where
+    most persons share a last name.
+    """
+
+    def __init__(self):
+        self.persons = {}
+        self.words = {} # Person IDs by word
+        self.word_grams = {} # Words by trigram
+        self.years = {} # Person IDs by birth year (None if not known)
+        self.lock = threading.Lock()
+
+    def add(self, person_id, first_names, last_name, birth_date, page_number):
+        """
+        Adds or replaces a person
+
+        Args:
+            (integer) person_id - Person ID
+            (string) first_names - First names
+            (string) last_name - Last name
+            (string) birth_date - Birth date in YYYY-MM-DD format
+            (integer) page_number - Page number
+        """
+
+        tokens = tuple(set(name_tokens(first_names, last_name)))
+        year = birth_year(birth_date)
+
+        with self.lock:
+            self.remove_locked(person_id)
+            self.persons[person_id] = {
+                'person_id': person_id, 'first_names': first_names,
+                'last_name': last_name, 'birth_date': birth_date,
+                'birth_year': year, 'page_number': page_number, 'tokens': tokens}
+            self.years.setdefault(year, set()).add(person_id)
+            for token in tokens:
+                if token not in self.words:
+                    self.words[token] = set()
+                    for gram in trigrams(token):
+                        self.word_grams.setdefault(gram, set()).add(token)
+                self.words[token].add(person_id)
+
+    def remove_locked(self, person_id):
+        """
+        Removes a person (lock held by the caller)
+
+        Args:
+            (integer) person_id - Person ID
+        """
+
+        person = self.persons.pop(person_id, None)
+        if person is None:
+            return
+        self.years[person['birth_year']].discard(person_id)
+        for token in person['tokens']:
+            person_ids = self.words[token]
+            person_ids.discard(person_id)
+            if not person_ids:
+                del self.words[token]
+                for gram in trigrams(token):
+                    self.word_grams[gram].discard(token)
+                    if not self.word_grams[gram]:
+                        del self.word_grams[gram]
+
+    def update(self, person_id, column_names, column_values):
+        """
+        Applies modified person columns
+
+        Args:
+            (integer) person_id - Person ID
+            (list) column_names - Names of modified columns
+            (list) column_values - Values of modified columns
+        """
+
+        with self.lock:
+            person = self.persons.get(person_id)
+            if person is None:
+                return
+            person = {column: person[column] for column in
+                      ('first_names', 'last_name', 'birth_date', 'page_number')}
+
+        for column_name, column_value in zip(column_names, column_values):
+            if column_name in person:
+                person[column_name] = column_value
+        self.add(person_id, **person)
+
+    def match_words(self, token):
+        """
+        Finds indexed words similar to a query word (lock held by the caller)
+
+        Args:
+            (string) token - Normalized query word or its beginning
+        Returns:
+            (dict) similarities - Share of query trigrams by word
+        """
+
+        grams = trigrams(token, prefix=True)
+        counts = Counter()
+        for gram in grams:
+            counts.update(self.word_grams.get(gram, ()))
+
+        similarities = {}
+        for word, count in counts.items():
+            similarity = count / len(grams)
+            if similarity >= MIN_SCORE:
+                # Whole words rank before longer names they are a prefix of
+                similarities[word] = similarity + (0.05 if word == token else 0.0)
+        return similarities
+
+    def search(self, query, limit=10, year=None):
+        """
+        Finds persons by name and optional birth year
+
+        Every query word must match a word of the person's names. A person's
+        score only depends on the word matched for each query word and on
+        the birth year, so the combinations of matched words and birth years
+        are ranked first, and their persons are looked up with set
+        intersections, best combination first, until the limit is reached.
+
+        Args:
+            (string) query - Names or their beginnings, a year may be included
+            (integer) limit - Most matches returned
+            (integer) year - Birth year (unknown birth years still match)
+        Returns:
+            (list) matches - Person data with score, best match first
+        """
+
+        tokens = []
+        for token in query.split():
+            if token.isdigit() and len(token) == 4:
+                year = int(token)
+            else:
+                tokens += name_tokens(token)
+        if not tokens:
+            return []
+
+        with self.lock:
+            # Combinations of matched words: (score, person ID sets)
+            combinations = [(0.0, [])]
+            for token in tokens:
+                matched = self.match_words(token)
+                if not matched:
+                    return []
+                combinations = [(score + similarity / len(tokens),
+                                 sets + [self.words[word]])
+                                for score, sets in combinations
+                                for word, similarity in matched.items()]
+                if len(combinations) > MAX_COMBINATIONS:
+                    combinations.sort(key=lambda combination: -combination[0])
+                    del combinations[MAX_COMBINATIONS:]
+
+            if year is not None:
+                year_sets = [(0.0, self.years.get(None, set()))]
+                for difference in range(YEAR_TOLERANCE + 1):
+                    person_ids = self.years.get(year - difference, set())
+                    if difference:
+                        person_ids = person_ids | self.years.get(year + difference, set())
+                    year_sets.append((0.1 * (YEAR_TOLERANCE - difference) / YEAR_TOLERANCE,
+                                      person_ids))
+                combinations = [(score + year_score, sets + [person_ids])
+                                for score, sets in combinations
+                                for year_score, person_ids in year_sets]
+
+            combinations.sort(key=lambda combination: -combination[0])
+
+            matches = []
+            found = set()
+            for score, sets in combinations:
+                sets = sorted(sets, key=len)
+                person_ids = sets[0].intersection(*sets[1:]) if len(sets) > 1 else sets[0]
+                if found:
+                    # A person is found first in its best combination
+                    person_ids = person_ids - found
+                for person_id in heapq.nsmallest(limit - len(matches), person_ids):
+                    matches.append(dict(person_data_columns(self.persons[person_id]),
+                                        score=round(score, 3)))
+                if len(matches) >= limit:
+                    break
+                found |= person_ids
+
+        return matches
+
+    def __len__(self):
+        with self.lock:
+            return len(self.persons)
+
+
+def person_data_columns(person):
+    """
+    Returns the person columns of an index entry
+
+    Args:
+        (dict) person - Index entry
+    Returns:
+        (dict) person - Person data by column name
+    """
+
+    return {column: person[column] for column in
+            ('person_id', 'first_names', 'last_name', 'birth_date', 'page_number')}
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def read_snapshot():
+    """
+    Reads the indexed columns of all persons from the current storage
+
+    Returns:
+        (list) rows - (person_id, first_names, last_name, birth_date, page_number)
+    """
+
+    if storage.is_remote():
+        columns, rows = db.fetch_all(SNAPSHOT_SQL)
+        return rows
+
+    local = storage.get_storage()
+    with local.lock:
+        return local.conn.execute(SNAPSHOT_SQL).fetchall()
+
+
+def get_index():
+    """
+    Returns the name index, building it from a snapshot on first use
+
+    Returns:
+        (NameIndex) index - Name index
+    """
+
+    global _index
+
+    with _index_lock:
+        if _index is None:
+            index = NameIndex()
+            for row in read_snapshot():
+                index.add(*row)
+            _index = index
+        return _index
+
+
+def reset():
+    """
+    Drops the index (e.g. after rows were changed elsewhere), rebuilt on next use
+    """
+
+    global _index
+
+    with _index_lock:
+        _index = None
+
+
+def person_added(columns, values):
+    """
+    Adds a saved person to the index if it is built
+
+    Args:
+        (list) columns - Data columns
+        (tuple) values - Data values
+    """
+
+    if _index is None or values is None:
+        return
+    person = dict(zip(columns, values))
+    _index.add(person['person_id'], person.get('first_names'), person.get('last_name'),
+               person.get('birth_date'), person.get('page_number'))
+
+
+def person_modified(person_id, column_names, column_values):
+    """
+    Applies modified person columns to the index if it is built
+
+    Args:
+        (integer) person_id - Person ID
+        (list) column_names - Names of modified columns
+        (list) column_values - Values of modified columns
+    """
+
+    if _index is not None:
+        _index.update(person_id, column_names, column_values)
+
+
+def search(query, limit=10, year=None):
+    """
+    Finds persons by name (see NameIndex.search)
+
+    Args:
+        (string) query - Names or their beginnings, a year may be included
+        (integer) limit - Most matches returned
+        (integer) year - Birth year
+    Returns:
+        (list) matches - Person data with score, best match first
+    """
+
+    return get_index().search(query, limit, year)
+
+
+def search_command(args):
+    """
+    Runs the search command
+
+    Args:
+        (Namespace) args - Command line arguments
+    """
+
+    from extract_genealogy import format_person
+
+    try:
+        start = time.perf_counter()
+        index = get_index()
+        loaded = time.perf_counter()
+        matches = index.search(' '.join(args.query), args.limit, args.year)
+        searched = time.perf_counter()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return
+
+    for match in matches:
+        print('{:.3f} {} [{}] page {}'.format(match['score'], format_person(match),
+                                              match['person_id'], match['page_number']))
+    print('{} matches among {} persons in {:.2f} ms (index built in {:.0f} ms).'.format(
+        len(matches), len(index), (searched - loaded) * 1000, (loaded - start) * 1000))
@@ -0,0 +1,280 @@
+import datetime
+import importlib
+import json
+import os
+
+import psycopg2
+
+import db
+from gedcom import stream_rows
+
+# Snapshot formats and the optional modules they need
+FORMAT_MODULES = {'arrow': 'pyarrow', 'numpy': 'numpy'}
+
+# Snapshot description file in the snapshot directory
+METADATA_FILE = 'snapshot.json'
+
+# Tables in a snapshot: (table name, columns as (name, kind))
+# Kinds: int (32-bit), bool, date (partial YYYY-MM-DD), dict (dictionary
+# encoded string) and string
+SNAPSHOT_TABLES = [
+    ('persons', [('person_id', 'int'), ('page_number', 'int'), ('first_names', 'dict'),
+                 ('last_name', 'dict'), ('gender', 'dict'), ('birth_date', 'date'),
+                 ('birth_place', 'dict'), ('death_date', 'date'), ('death_place', 'dict'),
+                 ('deceased', 'bool'), ('page_from', 'int'), ('page_to', 'int'),
+                 ('comments', 'string')]),
+    ('relationships', [('relationship_id', 'int'), ('person_id_partner1', 'int'),
+                       ('person_id_partner2', 'int'), ('marriage_date', 'date'),
+                       ('marriage_place', 'dict'), ('divorce_date', 'date'),
+                       ('divorce_place', 'dict'), ('comments', 'string')]),
+    ('children', [('child_id', 'int'), ('relationship_id', 'int'), ('person_id', 'int')]),
+]
+
+
+def require_module(snapshot_format):
+    """
+    Imports the optional module of a snapshot format
+
+    Args:
+        (string) snapshot_format - arrow or numpy
+    Returns:
+        (module) module - pyarrow or numpy
+    """
+
+    module_name = FORMAT_MODULES[snapshot_format]
+    try:
+        return importlib.import_module(module_name)
+    except ImportError:
+        raise ImportError('The {} snapshot format needs the {} package. Install it with '
+                          '"pip install {}"{}.'.format(
+                              snapshot_format, module_name, module_name,
+                              ' or use --format numpy' if snapshot_format == 'arrow' else ''))
+
+
+def parse_date(date):
+    """
+    Splits a partial YYYY-MM-DD date (XX for unknown parts)
+
+    Args:
+        (string) date - Date
+    Returns:
+        (date/none) full_date - Date if all parts are known and valid
+        (integer/none) year - Year
+        (integer/none) month - Month
+        (integer/none) day - Day
+    """
+
+    parts = []
+    for part in (date or '').split('-')[:3]:
+        try:
+            parts.append(int(part))
+        except ValueError:
+            parts.append(None)
+    parts += [None] * (3 - len(parts))
+    year, month, day = parts
+
+    full_date = None
+    if None not in parts:
+        try:
+            full_date = datetime.date(year, month, day)
+        except ValueError:
+            pass
+
+    return full_date, year, month, day
+
+
+def read_table(conn, table_name, columns):
+    """
+    Reads a table into columns with one pass over a server-side cursor
+
+    Date columns are split into the full date and its year, month and day.
+
+    Args:
+        (connection) conn - Database connection
+        (string) table_name - Table name
+        (list) columns - (name, kind) tuples
+    Returns:
+        (list) columns - (name, kind, values) tuples
+    """
+
+    query = 'SELECT {} FROM {} ORDER BY {}'.format(
+        ', '.join(name for name, kind in columns), table_name, columns[0][0])
+
+    values = {name: [] for name, kind in columns}
+    parts = {name: ([], [], []) for name, kind in columns if kind == 'date'}
+    for row in stream_rows(conn, 'snapshot_' + table_name, query):
+        for (name, kind), value in zip(columns, row):
+            if kind == 'date':
+                full_date, year, month, day = parse_date(value)
+                value = full_date
+                for part_values, part in zip(parts[name], (year, month, day)):
+                    part_values.append(part)
+            values[name].append(value)
+
+    table_columns = []
+    for name, kind in columns:
+        table_columns.append((name, kind, values[name]))
+        if kind == 'date':
+            prefix = name[:-len('_date')]
+            for suffix, part_values in zip(('year', 'month', 'day'), parts[name]):
+                table_columns.append(('{}_{}'.format(prefix, suffix), 'int', part_values))
+    return table_columns
+
+
+def write_arrow(pa, filename, columns):
+    """
+    Writes columns as an uncompressed Arrow IPC file (memory-mappable)
+
+    Args:
+        (module) pa - pyarrow
+        (string) filename - Output file
+        (list) columns - (name, kind, values) tuples
+    """
+
+    types = {'int': pa.int32(), 'bool': pa.bool_(), 'date': pa.date32(),
+             'dict': pa.string(), 'string': pa.string()}
+
+    arrays = []
+    for name, kind, values in columns:
+        array = pa.array(values, types[kind])
+        if kind == 'dict':
+            array = array.dictionary_encode()
+        arrays.append(array)
+    table = pa.Table.from_arrays(arrays, names=[name for name, kind, values in columns])
+
+    with pa.OSFile(filename, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def write_numpy(np, directory, columns):
+    """
+    Writes columns as .npy files (loadable with np.load(mmap_mode='r'))
+
+    Missing integers are -1 and missing dates NaT. Booleans are int8 with
+    -1 for unknown. Dictionary-encoded strings are int32 codes (-1 for
+    missing) with the strings in a .dictionary.npy file. Other strings are
+    UTF-8 bytes in a .data.npy file with start offsets in .offsets.npy.
+
+    Args:
+        (module) np - numpy
+        (string) directory - Output directory of the table
+        (list) columns - (name, kind, values) tuples
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    for name, kind, values in columns:
+        filename = os.path.join(directory, name + '.npy')
+        if kind == 'int':
+            array = np.array([-1 if value is None else value for value in values],
+                             dtype=np.int32)
+        elif kind == 'bool':
+            array = np.array([-1 if value is None else int(value) for value in values],
+                             dtype=np.int8)
+        elif kind == 'date':
+            array = np.array([value.isoformat() if value else 'NaT' for value in values],
+                             dtype='datetime64[D]')
+        elif kind == 'dict':
+            codes = {}
+            array = np.array([-1 if value is None else codes.setdefault(value, len(codes))
+                              for value in values], dtype=np.int32)
+            np.save(os.path.join(directory, name + '.dictionary.npy'),
+                    np.array(list(codes), dtype=str))
+        else:
+            # UTF-8 bytes with offsets, as fixed-width strings would waste space
+            encoded = [b'' if value is None else value.encode('utf-8') for value in values]
+            offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(value) for value in encoded], dtype=np.int64)
+            np.save(os.path.join(directory, name + '.offsets.npy'), offsets)
+            filename = os.path.join(directory, name + '.data.npy')
+            array = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        np.save(filename, array)
+
+
+def export_snapshot(directory, snapshot_format='arrow'):
+    """
+    Writes the persons, relationships and children tables as columnar files
+
+    All tables are read in one read-only transaction, so they are consistent
+    with each other, and each table is read once.
+
+    Args:
+        (string) directory - Output directory
+        (string) snapshot_format - arrow or numpy
+    Returns:
+        (dict) row_counts - Rows by table name
+    """
+
+    module = require_module(snapshot_format)
+    os.makedirs(directory, exist_ok=True)
+
+    row_counts = {}
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+
+        for table_name, columns in SNAPSHOT_TABLES:
+            table_columns = read_table(conn, table_name, columns)
+            if snapshot_format == 'arrow':
+                write_arrow(module, os.path.join(directory, table_name + '.arrow'),
+                            table_columns)
+            else:
+                write_numpy(module, os.path.join(directory, table_name), table_columns)
+            row_counts[table_name] = len(table_columns[0][2])
+
+    with open(os.path.join(directory, METADATA_FILE), 'w', encoding='utf-8') as metadata_file:
+        json.dump({'format': snapshot_format,
+                   'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                   'rows': row_counts}, metadata_file, indent=2)
+
+    return row_counts
+
+
+def load_snapshot(directory):
+    """
+    Opens a snapshot memory-mapped without copying the data
+
+    Args:
+        (string) directory - Snapshot directory
+    Returns:
+        (dict) tables - pyarrow Tables (arrow format) or dicts of numpy
+                        arrays by column name (numpy format) by table name
+    """
+
+    with open(os.path.join(directory, METADATA_FILE), encoding='utf-8') as metadata_file:
+        snapshot_format = json.load(metadata_file)['format']
+    module = require_module(snapshot_format)
+
+    tables = {}
+    for table_name, columns in SNAPSHOT_TABLES:
+        if snapshot_format == 'arrow':
+            source = module.memory_map(os.path.join(directory, table_name + '.arrow'))
+            tables[table_name] = module.ipc.open_file(source).read_all()
+        else:
+            table_directory = os.path.join(directory, table_name)
+            tables[table_name] = {
+                filename[:-len('.npy')]: module.load(os.path.join(table_directory, filename),
+                                                     mmap_mode='r')
+                for filename in sorted(os.listdir(table_directory))
+                if filename.endswith('.npy')}
+    return tables
+
+
+def snapshot_command(args):
+    """
+    Runs the snapshot command
+
+    Args:
+        (Namespace) args - Command line arguments
+    """
+
+    try:
+        row_counts = export_snapshot(args.directory, args.format)
+    except ImportError as error:
+        print(error)
+    except (Exception, psycopg2.DatabaseError) as error:
+        print('Snapshot failed: {}'.format(error))
+    else:
+        print('Saved {} persons, {} relationships and {} children to {} ({} format).'.format(
+            row_counts['persons'], row_counts['relationships'], row_counts['children'],
+            args.directory, args.format))
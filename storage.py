@@ -0,0 +1,657 @@
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import sql
+
+import db
+import ids
+
+# ID columns of the stored tables
+ID_COLUMNS = {'persons': 'person_id', 'relationships': 'relationship_id',
+              'children': 'child_id'}
+
+# Columns referring to other tables, mapped to local IDs when syncing
+REFERENCE_COLUMNS = {'relationships': {'person_id_partner1': 'persons',
+                                       'person_id_partner2': 'persons'},
+                     'children': {'person_id': 'persons',
+                                  'relationship_id': 'relationships'}}
+
+# Statements compiled once and kept by each SQLite connection
+CACHED_STATEMENTS = 256
+
+SQLITE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS persons(
+        person_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        page_number INTEGER NOT NULL,
+        first_names VARCHAR (100),
+        last_name VARCHAR (100),
+        gender VARCHAR(30),
+        birth_date VARCHAR (10),
+        birth_place VARCHAR (255),
+        death_date VARCHAR (10),
+        death_place VARCHAR (255),
+        deceased BOOLEAN,
+        page_from INTEGER,
+        page_to INTEGER,
+        comments VARCHAR (255))""",
+    """CREATE TABLE IF NOT EXISTS relationships(
+        relationship_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        person_id_partner1 INTEGER REFERENCES persons DEFERRABLE INITIALLY DEFERRED,
+        person_id_partner2 INTEGER REFERENCES persons DEFERRABLE INITIALLY DEFERRED,
+        marriage_date VARCHAR (10),
+        marriage_place VARCHAR (255),
+        divorce_date VARCHAR (10),
+        divorce_place VARCHAR (255),
+        comments VARCHAR (255))""",
+    """CREATE TABLE IF NOT EXISTS children(
+        child_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        person_id INTEGER NOT NULL REFERENCES persons DEFERRABLE INITIALLY DEFERRED,
+        relationship_id INTEGER NOT NULL
+            REFERENCES relationships DEFERRABLE INITIALLY DEFERRED)""",
+    # Central IDs of rows already pushed by sync
+    """CREATE TABLE IF NOT EXISTS sync_ids(
+        table_name TEXT NOT NULL,
+        local_id INTEGER NOT NULL,
+        central_id INTEGER NOT NULL,
+        PRIMARY KEY (table_name, local_id))""",
+    # Synced rows modified afterwards
+    """CREATE TABLE IF NOT EXISTS sync_updates(
+        table_name TEXT NOT NULL,
+        local_id INTEGER NOT NULL,
+        PRIMARY KEY (table_name, local_id))""",
+]
+
+# Booleans are stored as 0/1 and read back by declared column type
+sqlite3.register_converter('BOOLEAN', lambda value: value not in (b'0', b''))
+
+
+def quote(name):
+    """
+    Quotes an SQLite identifier
+
+    Args:
+        (string) name - Table or column name
+    Returns:
+        (string) quoted_name - Quoted name
+    """
+
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+class Storage(ABC):
+    """
+    Row storage used by the data extraction tool
+
+    Implementations insert, update and read rows by ID and group writes
+    into transactions. Rows are given and returned as (columns, values).
+    """
+
+    # Reads are network round trips, so batched queries pay off
+    remote = True
+
+    @abstractmethod
+    def insert_row(self, table_name, column_names, column_values, returning='*'):
+        """
+        Inserts a row
+
+        Args:
+            (string) table_name - Table name
+            (string list) column_names - Column names
+            (list) column_values - Column values
+            (string) returning - Returned column name ('*' for all columns)
+        Returns:
+            (list) columns - Returned columns
+            (tuple) values - Returned values
+        """
+
+    def defer_insert_row(self, table_name, column_names, column_values):
+        """
+        Inserts a row whose generated values are not needed
+
+        Args:
+            (string) table_name - Table name
+            (string list) column_names - Column names
+            (list) column_values - Column values
+        """
+
+        self.insert_row(table_name, column_names, column_values)
+
+    @abstractmethod
+    def update_row(self, table_name, id_name, id_value, column_names, column_values):
+        """
+        Updates columns of a row by ID number
+
+        Args:
+            (string) table_name - Table name
+            (string) id_name - Name of ID column
+            (integer) id_value - ID number
+            (string list) column_names - Column names
+            (list) column_values - Column values
+        Returns:
+            (int) updated_rows - How many rows updated
+        """
+
+    @abstractmethod
+    def select_row(self, table_name, id_name, id_value):
+        """
+        Selects a row by ID number
+
+        Args:
+            (string) table_name - Table name
+            (string) id_name - Name of ID column
+            (integer) id_value - ID number
+        Returns:
+            (list) columns - Data columns
+            (tuple) values - Data values (None if not found)
+        """
+
+    @abstractmethod
+    def transaction(self):
+        """
+        Returns a context manager running a with block in one transaction
+        """
+
+    @abstractmethod
+    def in_transaction(self):
+        """
+        Checks if a transaction is open
+
+        Returns:
+            (boolean) open - True inside a transaction block
+        """
+
+    def close(self):
+        """
+        Releases the storage
+        """
+
+
+class PostgresStorage(Storage):
+    """
+    Central PostgreSQL database (see db.py), including write-behind journals
+    """
+
+    def insert_row(self, table_name, column_names, column_values, returning='*'):
+        """
+        Inserts a row (see Storage.insert_row)
+
+        Inside a transaction the row gets an ID reserved ahead and the INSERT
+        is queued with the other statements of the transaction, so a whole
+        family line is sent in one batch. The returned row then holds the
+        ID and the given columns.
+        """
+
+        if not db.in_transaction() or db.write_behind_active():
+            return db.insert_row(table_name, column_names, column_values, returning)
+
+        id_name = ids.ID_COLUMNS[table_name]
+        column_names = [id_name] + list(column_names)
+        column_values = [ids.next_id(table_name)] + list(column_values)
+        db.defer_insert_row(table_name, column_names, column_values)
+
+        if returning != '*':
+            return [returning], (column_values[column_names.index(returning)],)
+        return column_names, tuple(column_values)
+
+    def defer_insert_row(self, table_name, column_names, column_values):
+        db.defer_insert_row(table_name, column_names, column_values)
+
+    def update_row(self, table_name, id_name, id_value, column_names, column_values):
+        return db.update_row(table_name, id_name, id_value, column_names, column_values)
+
+    def select_row(self, table_name, id_name, id_value):
+        return db.select_row(table_name, id_name, id_value)
+
+    def transaction(self):
+        """
+        Runs a with block in one transaction (see Storage.transaction)
+
+        With a write-behind journal the rows of the block are grouped in the
+        journal, and no database connection is needed.
+        """
+
+        journal = db.get_write_behind()
+        if journal is not None:
+            return journal.transaction()
+        return db.transaction()
+
+    def in_transaction(self):
+        journal = db.get_write_behind()
+        if journal is not None:
+            return journal.in_transaction()
+        return db.in_transaction()
+
+
+class SqliteStorage(Storage):
+    """
+    Embedded SQLite database file for transcribing without a network
+
+    The file is opened in WAL mode, and statements are kept compiled by the
+    connection statement cache, so writes take microseconds. Rows are pushed
+    to the central database with sync_local.
+    """
+
+    remote = False
+
+    def __init__(self, filename):
+        """
+        Opens or creates an SQLite database file
+
+        Args:
+            (string) filename - SQLite database file name
+        """
+
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.depth = 0 # Nested transaction blocks
+        self.statements = {} # SQL text by statement key
+
+        # Transactions are started explicitly (autocommit otherwise)
+        self.conn = sqlite3.connect(filename, isolation_level=None,
+                                    detect_types=sqlite3.PARSE_DECLTYPES,
+                                    cached_statements=CACHED_STATEMENTS,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        for statement in SQLITE_SCHEMA:
+            self.conn.execute(statement)
+
+    def statement(self, key, build):
+        """
+        Returns the SQL text of a statement, building it on first use
+
+        The same text is used for every call, so the connection reuses the
+        compiled statement.
+
+        Args:
+            (tuple) key - Statement key
+            (function) build - Builds the SQL text
+        Returns:
+            (string) query - SQL text
+        """
+
+        query = self.statements.get(key)
+        if query is None:
+            query = build()
+            self.statements[key] = query
+        return query
+
+    def insert_row(self, table_name, column_names, column_values, returning='*'):
+        column_names = tuple(column_names)
+
+        def build():
+            if not column_names:
+                return 'INSERT INTO {} DEFAULT VALUES'.format(quote(table_name))
+            return 'INSERT INTO {} ({}) VALUES ({})'.format(
+                quote(table_name), ', '.join(map(quote, column_names)),
+                ', '.join('?' * len(column_names)))
+
+        query = self.statement(('insert', table_name, column_names), build)
+        with self.lock:
+            id_value = self.conn.execute(query, list(column_values)).lastrowid
+
+            id_name = ID_COLUMNS[table_name]
+            if returning == id_name:
+                return [id_name], (id_value,)
+            columns, values = self.select_row(table_name, id_name, id_value)
+            if returning != '*':
+                return [returning], (values[columns.index(returning)],)
+            return columns, values
+
+    def update_row(self, table_name, id_name, id_value, column_names, column_values):
+        if not column_names:
+            return 0
+        column_names = tuple(column_names)
+
+        query = self.statement(('update', table_name, column_names), lambda: (
+            'UPDATE {} SET {} WHERE {} = ?'.format(
+                quote(table_name),
+                ', '.join('{} = ?'.format(quote(column_name)) for column_name in column_names),
+                quote(id_name))))
+
+        with self.lock:
+            updated_rows = self.conn.execute(
+                query, list(column_values) + [id_value]).rowcount
+            # Synced rows are sent again on the next sync
+            self.conn.execute('INSERT OR IGNORE INTO sync_updates (table_name, local_id) '
+                              'SELECT table_name, local_id FROM sync_ids '
+                              'WHERE table_name = ? AND local_id = ?',
+                              (table_name, id_value))
+        return updated_rows
+
+    def select_row(self, table_name, id_name, id_value):
+        query = self.statement(('select', table_name, id_name), lambda: (
+            'SELECT * FROM {} WHERE {} = ?'.format(quote(table_name), quote(id_name))))
+
+        with self.lock:
+            cur = self.conn.execute(query, (id_value,))
+            values = cur.fetchone()
+        return [desc[0] for desc in cur.description], values
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs all statements of a with block in one transaction
+
+        Errors and interrupts (Ctrl-C) roll back every change made in the
+        block. Nested blocks join the outer transaction, and an error in a
+        nested block rolls back only that block (to a savepoint).
+        """
+
+        if self.depth:
+            self.depth += 1
+            name = 'nested_{}'.format(self.depth)
+            with self.lock:
+                self.conn.execute('SAVEPOINT {}'.format(name))
+            try:
+                yield self.conn
+            except BaseException:
+                with self.lock:
+                    self.conn.execute('ROLLBACK TO SAVEPOINT {}'.format(name))
+                    self.conn.execute('RELEASE SAVEPOINT {}'.format(name))
+                raise
+            else:
+                with self.lock:
+                    self.conn.execute('RELEASE SAVEPOINT {}'.format(name))
+            finally:
+                self.depth -= 1
+            return
+
+        with self.lock:
+            self.conn.execute('BEGIN')
+        self.depth = 1
+        try:
+            yield self.conn
+            with self.lock:
+                self.conn.execute('COMMIT')
+        except BaseException:
+            with self.lock:
+                self.conn.execute('ROLLBACK')
+            raise
+        finally:
+            self.depth = 0
+
+    def in_transaction(self):
+        return self.depth > 0
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+_storage = PostgresStorage()
+
+# Actions run when the transaction of the thread commits (see after_commit)
+_local = threading.local()
+
+
+def get_storage():
+    """
+    Returns the storage rows are saved to
+
+    Returns:
+        (Storage) storage - Current storage
+    """
+
+    return _storage
+
+
+def set_storage(storage):
+    """
+    Saves rows to another storage (None for the central database)
+
+    Args:
+        (Storage) storage - Storage
+    """
+
+    global _storage
+    _storage = storage or PostgresStorage()
+
+
+def insert_row(table_name, column_names, column_values, returning='*'):
+    """ Inserts a row in the current storage (see Storage.insert_row) """
+
+    return _storage.insert_row(table_name, column_names, column_values, returning)
+
+
+def defer_insert_row(table_name, column_names, column_values):
+    """ Inserts a row in the current storage (see Storage.defer_insert_row) """
+
+    _storage.defer_insert_row(table_name, column_names, column_values)
+
+
+def update_row(table_name, id_name, id_value, column_names, column_values):
+    """ Updates a row in the current storage (see Storage.update_row) """
+
+    return _storage.update_row(table_name, id_name, id_value, column_names, column_values)
+
+
+def select_row(table_name, id_name, id_value):
+    """ Selects a row from the current storage (see Storage.select_row) """
+
+    return _storage.select_row(table_name, id_name, id_value)
+
+
+@contextmanager
+def transaction():
+    """
+    Opens a transaction in the current storage (see Storage.transaction)
+
+    Actions registered with after_commit in the block run when the outermost
+    block commits. When a block rolls back, its actions are dropped and
+    their rollback functions are run.
+    """
+
+    actions = getattr(_local, 'actions', None)
+    outermost = actions is None
+    if outermost:
+        actions = _local.actions = []
+    start = len(actions)
+
+    try:
+        with _storage.transaction() as conn:
+            yield conn
+    except BaseException:
+        rolled_back = actions[start:]
+        del actions[start:]
+        if outermost:
+            _local.actions = None
+        for action, rollback in reversed(rolled_back):
+            if rollback is not None:
+                rollback()
+        raise
+
+    if outermost:
+        _local.actions = None
+        for action, rollback in actions:
+            action()
+
+
+def after_commit(action, rollback=None):
+    """
+    Runs a function when the current transaction commits
+
+    Outside a transaction the function is run right away. Shared state such
+    as caches is updated this way, so other sessions never see rows that
+    may still be rolled back.
+
+    Args:
+        (function) action - Function run after commit
+        (function) rollback - Function run if the changes are rolled back
+    """
+
+    actions = getattr(_local, 'actions', None)
+    if actions is None:
+        action()
+    else:
+        actions.append((action, rollback))
+
+
+def in_transaction():
+    """ Checks if the current storage has a transaction open """
+
+    return _storage.in_transaction()
+
+
+def is_remote():
+    """
+    Checks if reads of the current storage are network round trips
+
+    Returns:
+        (boolean) remote - True for the central database
+    """
+
+    return _storage.remote
+
+
+def read_local_rows(conn, table_name, synced_ids):
+    """
+    Reads local rows not yet pushed to the central database
+
+    Args:
+        (connection) conn - SQLite connection
+        (string) table_name - Table name
+        (dict) synced_ids - Central IDs by local ID
+    Returns:
+        (list) column_names - Data columns without the ID
+        (list) rows - (local ID, values) tuples
+    """
+
+    id_name = ID_COLUMNS[table_name]
+    cur = conn.execute('SELECT * FROM {} ORDER BY {}'.format(quote(table_name), quote(id_name)))
+    columns = [desc[0] for desc in cur.description]
+    id_index = columns.index(id_name)
+    column_names = [column for column in columns if column != id_name]
+
+    rows = []
+    for values in cur:
+        if values[id_index] not in synced_ids:
+            rows.append((values[id_index], [value for index, value in enumerate(values)
+                                            if index != id_index]))
+    return column_names, rows
+
+
+def map_references(table_name, column_names, values, synced_ids):
+    """
+    Replaces local IDs in reference columns with central IDs
+
+    Args:
+        (string) table_name - Table name
+        (list) column_names - Data columns
+        (list) values - Data values
+        (dict) synced_ids - Central IDs by local ID, by table name
+    Returns:
+        (list) values - Data values with central IDs
+    """
+
+    references = REFERENCE_COLUMNS.get(table_name, {})
+    mapped = list(values)
+    for index, column_name in enumerate(column_names):
+        if column_name in references and mapped[index] is not None:
+            referenced_ids = synced_ids[references[column_name]]
+            if mapped[index] not in referenced_ids:
+                raise ValueError('{} refers to unknown {} row {}'.format(
+                    table_name, references[column_name], mapped[index]))
+            mapped[index] = referenced_ids[mapped[index]]
+    return mapped
+
+
+def sync_local(filename, batch_size=1000):
+    """
+    Pushes rows of an SQLite file to the central database in one transaction
+
+    New rows are inserted in batches with new central IDs, and synced rows
+    modified since the last sync are updated. The central IDs are kept in
+    the SQLite file, so the file can be synced again after more work.
+
+    Args:
+        (string) filename - SQLite database file name
+        (integer) batch_size - Rows in one INSERT statement
+    Returns:
+        (dict) row_counts - Inserted and updated rows by table
+    """
+
+    from bulk_import import import_rows
+
+    local = SqliteStorage(filename)
+    row_counts = {}
+    try:
+        synced_ids = {table_name: {} for table_name in ID_COLUMNS}
+        for table_name, local_id, central_id in local.conn.execute(
+                'SELECT table_name, local_id, central_id FROM sync_ids'):
+            synced_ids[table_name][local_id] = central_id
+        new_ids = {table_name: {} for table_name in ID_COLUMNS}
+
+        # The central IDs are committed locally only after the central commit,
+        # so a failed sync leaves both databases unchanged
+        with local.transaction():
+            with db.connection() as conn:
+                with conn.cursor() as cur:
+                    # Referenced tables first
+                    for table_name in ('persons', 'relationships', 'children'):
+                        column_names, rows = read_local_rows(local.conn, table_name,
+                                                             synced_ids[table_name])
+                        prepared_rows = ((local_id, column_names,
+                                          map_references(table_name, column_names, values,
+                                                         synced_ids))
+                                         for local_id, values in rows)
+                        new_ids[table_name], inserted = import_rows(
+                            cur, table_name, ID_COLUMNS[table_name], prepared_rows,
+                            batch_size)
+                        synced_ids[table_name].update(new_ids[table_name])
+                        row_counts[table_name] = {'inserted': inserted, 'updated': 0}
+
+                    updates = local.conn.execute(
+                        'SELECT table_name, local_id FROM sync_updates').fetchall()
+                    for table_name, local_id in updates:
+                        id_name = ID_COLUMNS[table_name]
+                        columns, values = local.select_row(table_name, id_name, local_id)
+                        if values is None:
+                            continue
+                        row = dict(zip(columns, values))
+                        column_names = [column for column in columns if column != id_name]
+                        mapped = map_references(table_name, column_names,
+                                                [row[column] for column in column_names],
+                                                synced_ids)
+                        cur.execute(sql.SQL('UPDATE {} SET {} WHERE {} = %s').format(
+                            sql.Identifier(table_name),
+                            sql.SQL(', ').join(sql.SQL('{} = %s').format(sql.Identifier(column))
+                                               for column in column_names),
+                            sql.Identifier(id_name)),
+                            mapped + [synced_ids[table_name][local_id]])
+                        row_counts[table_name]['updated'] += 1
+
+                for table_name, id_map in new_ids.items():
+                    local.conn.executemany(
+                        'INSERT INTO sync_ids (table_name, local_id, central_id) '
+                        'VALUES (?, ?, ?)',
+                        [(table_name, local_id, central_id)
+                         for local_id, central_id in id_map.items()])
+                local.conn.execute('DELETE FROM sync_updates')
+    finally:
+        local.close()
+
+    return row_counts
+
+
+def sync_command(args):
+    """
+    Runs the sync command
+
+    Args:
+        (Namespace) args - Command line arguments
+    """
+
+    try:
+        row_counts = sync_local(args.local_file, args.batch_size)
+    except (Exception, psycopg2.DatabaseError) as error:
+        print('Sync failed, nothing was saved: {}'.format(error))
+        return
+
+    for table_name, counts in row_counts.items():
+        print('{}: {} inserted, {} updated.'.format(table_name, counts['inserted'],
+                                                    counts['updated']))
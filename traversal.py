@@ -0,0 +1,304 @@
+from array import array
+from collections import deque
+
+import psycopg2
+
+import db
+
+# Generations followed when no limit is given (also stops cycles in bad data)
+MAX_GENERATIONS = 100
+
+# Person columns returned with traversal results
+PERSON_COLUMNS = ['person_id', 'first_names', 'last_name', 'birth_date', 'death_date']
+
+DESCENDANTS_SQL = """
+WITH RECURSIVE line(person_id, generation) AS (
+    SELECT %(person_id)s::integer, 0
+  UNION
+    SELECT c.person_id, line.generation + 1
+    FROM line
+    JOIN relationships r ON r.person_id_partner1 = line.person_id
+                         OR r.person_id_partner2 = line.person_id
+    JOIN children c ON c.relationship_id = r.relationship_id
+    WHERE line.generation < %(generations)s
+)
+SELECT p.person_id, p.first_names, p.last_name, p.birth_date, p.death_date,
+       MIN(line.generation) AS generation
+FROM line JOIN persons p ON p.person_id = line.person_id
+GROUP BY p.person_id
+ORDER BY generation, p.person_id
+"""
+
+ANCESTORS_SQL = """
+WITH RECURSIVE line(person_id, generation) AS (
+    SELECT %(person_id)s::integer, 0
+  UNION
+    SELECT parent.person_id, line.generation + 1
+    FROM line
+    JOIN children c ON c.person_id = line.person_id
+    JOIN relationships r ON r.relationship_id = c.relationship_id
+    CROSS JOIN LATERAL (VALUES (r.person_id_partner1), (r.person_id_partner2))
+        AS parent(person_id)
+    WHERE parent.person_id IS NOT NULL AND line.generation < %(generations)s
+)
+SELECT p.person_id, p.first_names, p.last_name, p.birth_date, p.death_date,
+       MIN(line.generation) AS generation
+FROM line JOIN persons p ON p.person_id = line.person_id
+GROUP BY p.person_id
+ORDER BY generation, p.person_id
+"""
+
+
+def traverse(query, person_id, generations=None):
+    """
+    Runs a recursive traversal query
+
+    Args:
+        (string) query - DESCENDANTS_SQL or ANCESTORS_SQL
+        (integer) person_id - Person ID to start from
+        (integer) generations - How many generations (all if None)
+    Returns:
+        (list) persons - Person data with generation, in generation order
+    """
+
+    if generations is None:
+        generations = MAX_GENERATIONS
+
+    columns, rows = db.fetch_all(query, {'person_id': person_id, 'generations': generations})
+
+    return [dict(zip(columns, values)) for values in rows]
+
+
+def get_descendants(person_id, generations=None):
+    """
+    Gets all descendants of a person with one recursive query
+
+    Args:
+        (integer) person_id - Person ID
+        (integer) generations - How many generations (all if None)
+    Returns:
+        (list) persons - Person data with generation (0 for the person)
+    """
+
+    return traverse(DESCENDANTS_SQL, person_id, generations)
+
+
+def get_ancestors(person_id, generations=None):
+    """
+    Gets all ancestors of a person with one recursive query
+
+    Args:
+        (integer) person_id - Person ID
+        (integer) generations - How many generations (all if None)
+    Returns:
+        (list) persons - Person data with generation (0 for the person)
+    """
+
+    return traverse(ANCESTORS_SQL, person_id, generations)
+
+
+def build_adjacency(edges, node_count):
+    """
+    Builds compact adjacency arrays (offsets and targets) from edges
+
+    Targets of node i are targets[offsets[i]:offsets[i + 1]].
+
+    Args:
+        (list) edges - (source, target) node index pairs
+        (integer) node_count - Number of nodes
+    Returns:
+        (array) offsets - Start of each node's targets
+        (array) targets - Target node indexes
+    """
+
+    offsets = array('l', [0]) * (node_count + 1)
+    for source, target in edges:
+        offsets[source + 1] += 1
+    for index in range(node_count):
+        offsets[index + 1] += offsets[index]
+
+    targets = array('l', [0]) * len(edges)
+    positions = array('l', offsets[:-1])
+    for source, target in edges:
+        targets[positions[source]] = target
+        positions[source] += 1
+
+    return offsets, targets
+
+
+class FamilyGraph:
+    """
+    Parent-child graph of all persons in compact adjacency arrays
+
+    Loading takes one query; traversals after that run in memory.
+    """
+
+    def __init__(self, parent_child_pairs):
+        """
+        Args:
+            (iterable) parent_child_pairs - (parent ID, child ID) pairs
+        """
+
+        self.indexes = {} # Node index by person ID
+        self.person_ids = array('l')
+
+        edges = []
+        for parent_id, child_id in parent_child_pairs:
+            edges.append((self.index(parent_id), self.index(child_id)))
+
+        node_count = len(self.person_ids)
+        self.child_offsets, self.children = build_adjacency(edges, node_count)
+        self.parent_offsets, self.parents = build_adjacency(
+            [(child, parent) for parent, child in edges], node_count)
+
+    def index(self, person_id):
+        """
+        Returns the node index of a person, adding new persons
+
+        Args:
+            (integer) person_id - Person ID
+        Returns:
+            (int) index - Node index
+        """
+
+        index = self.indexes.get(person_id)
+        if index is None:
+            index = len(self.person_ids)
+            self.indexes[person_id] = index
+            self.person_ids.append(person_id)
+        return index
+
+    def walk(self, person_id, offsets, targets, generations=None):
+        """
+        Walks the graph breadth first computing generation numbers
+
+        Args:
+            (integer) person_id - Person ID to start from
+            (array) offsets - Adjacency offsets
+            (array) targets - Adjacency targets
+            (integer) generations - How many generations (all if None)
+        Returns:
+            (dict) generations_by_id - Generation by person ID
+        """
+
+        if generations is None:
+            generations = MAX_GENERATIONS
+
+        start = self.indexes.get(person_id)
+        if start is None:
+            return {person_id: 0}
+
+        found = {start: 0}
+        queue = deque([start])
+        while queue:
+            node = queue.popleft()
+            generation = found[node]
+            if generation >= generations:
+                continue
+            for target in targets[offsets[node]:offsets[node + 1]]:
+                if target not in found:
+                    found[target] = generation + 1
+                    queue.append(target)
+
+        return {self.person_ids[node]: generation for node, generation in found.items()}
+
+    def descendants(self, person_id, generations=None):
+        """
+        Returns descendants by generation (0 for the person)
+
+        Args:
+            (integer) person_id - Person ID
+            (integer) generations - How many generations (all if None)
+        Returns:
+            (dict) generations_by_id - Generation by person ID
+        """
+
+        return self.walk(person_id, self.child_offsets, self.children, generations)
+
+    def ancestors(self, person_id, generations=None):
+        """
+        Returns ancestors by generation (0 for the person)
+
+        Args:
+            (integer) person_id - Person ID
+            (integer) generations - How many generations (all if None)
+        Returns:
+            (dict) generations_by_id - Generation by person ID
+        """
+
+        return self.walk(person_id, self.parent_offsets, self.parents, generations)
+
+
+def load_graph():
+    """
+    Loads all parent-child links into a FamilyGraph with one query
+
+    Returns:
+        (FamilyGraph) graph - Family graph
+    """
+
+    columns, rows = db.fetch_all("""
+        SELECT parent.person_id, c.person_id
+        FROM children c
+        JOIN relationships r ON r.relationship_id = c.relationship_id
+        CROSS JOIN LATERAL (VALUES (r.person_id_partner1), (r.person_id_partner2))
+            AS parent(person_id)
+        WHERE parent.person_id IS NOT NULL
+    """)
+
+    return FamilyGraph(rows)
+
+
+def get_persons(generations_by_id):
+    """
+    Reads person data for traversal results with one query
+
+    Args:
+        (dict) generations_by_id - Generation by person ID
+    Returns:
+        (list) persons - Person data with generation, in generation order
+    """
+
+    columns, rows = db.fetch_all(
+        'SELECT {} FROM persons WHERE person_id = ANY(%s)'.format(', '.join(PERSON_COLUMNS)),
+        (list(generations_by_id),))
+
+    persons = []
+    for values in rows:
+        person = dict(zip(columns, values))
+        person['generation'] = generations_by_id[person['person_id']]
+        persons.append(person)
+
+    persons.sort(key=lambda person: (person['generation'], person['person_id']))
+    return persons
+
+
+def traversal_command(args):
+    """
+    Runs the descendants and ancestors commands
+
+    Args:
+        (Namespace) args - Command line arguments
+    """
+
+    from extract_genealogy import format_person
+
+    try:
+        if args.graph:
+            graph = load_graph()
+            if args.command == 'descendants':
+                generations_by_id = graph.descendants(args.person_id, args.generations)
+            else:
+                generations_by_id = graph.ancestors(args.person_id, args.generations)
+            persons = get_persons(generations_by_id)
+        elif args.command == 'descendants':
+            persons = get_descendants(args.person_id, args.generations)
+        else:
+            persons = get_ancestors(args.person_id, args.generations)
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+        return
+
+    for person in persons:
+        print('{}{} [{}]'.format('  ' * person['generation'], format_person(person),
+                                 person['person_id']))